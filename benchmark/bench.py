@@ -0,0 +1,1455 @@
+#!/usr/bin/env python3.10
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------------
+"""
+Offline end-to-end benchmark of git_backup
+
+Starts local stand-ins for the GitHub REST/GraphQL and migrations API, the
+migration archive storage, Google's token endpoint and the Drive v3 API,
+then runs python -m git_backup against them as a subprocess. Reports
+wall-clock time, archive bytes per second, peak RSS, peak disk use, the
+number of calls made to each endpoint and the cold start - the time from
+starting the process to its first API call, checked against a budget.
+
+Latency, 5xx errors, rate-limit responses and a bandwidth cap can be
+injected into the hot paths - repo listing, migration status checks,
+archive downloads and Drive chunk uploads.
+
+Arguments after -- are passed on to git_backup, for example:
+    python benchmark/bench.py --repos 500 -- --stream --workers 8
+"""
+# ---------------------------------------------------------------------------
+
+import argparse
+import base64
+import email.parser
+import gzip
+import hashlib
+import hmac
+import json
+import lzma
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep, time
+from urllib.parse import parse_qs, urlparse
+from xml.etree import ElementTree
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORG = "bench"
+RECOMPRESSED = (".tar.zst", ".tar.xz")
+EXCLUDES = (
+    "exclude_attachments", "exclude_releases", "exclude_metadata",
+    "exclude_git_data", "exclude_owner_projects"
+)
+BLOCK = 256 * 1024
+
+argparser = argparse.ArgumentParser(
+    description="Benchmark git_backup against local fake services"
+)
+argparser.add_argument(
+    "--repos", help="Number of repos in the org. Default 250",
+    type=int, default=250,
+)
+argparser.add_argument(
+    "--repo-mb", help="Reported size of each repo in MB. Default 50",
+    type=float, default=50,
+)
+argparser.add_argument(
+    "--archive-mb", help="Size of each migration archive in MB. Default 20",
+    type=float, default=20,
+)
+argparser.add_argument(
+    "--compressible",
+    help="Fraction of each archive that is text rather than random bytes, \
+        for --recompress. Default 0",
+    type=float, default=0,
+)
+argparser.add_argument(
+    "--orgs",
+    help="Number of orgs backed up at once with --org, each with its own \
+        token and archive folder. Each lists the same fake repos. \
+        Default 1",
+    type=int, default=1,
+)
+argparser.add_argument(
+    "--members",
+    help="Number of repos in each archive. Default 8",
+    type=int, default=8,
+)
+argparser.add_argument(
+    "--sinks",
+    help="Also copy every archive to a local directory and a fake S3 \
+        bucket with --sink, and check both copies",
+    action="store_true",
+)
+argparser.add_argument(
+    "--tiers",
+    help="Export odd numbered repos with a --tier leaving out their \
+        attachments, releases and metadata, and count the migrations \
+        asked to",
+    action="store_true",
+)
+argparser.add_argument(
+    "--mirror",
+    help="Back up with --engine mirror from local bare repos of \
+        --mirror-kb each, then change two of them, run an incremental \
+        backup and restore both, comparing their refs",
+    action="store_true",
+)
+argparser.add_argument(
+    "--mirror-kb",
+    help="Size in KB of the random file in each bare repo. Default 256",
+    type=int, default=256,
+)
+argparser.add_argument(
+    "--restore",
+    help="After each run, restore one repo from the first archive with \
+        git_backup restore and check it",
+    action="store_true",
+)
+argparser.add_argument(
+    "--export-delay",
+    help="Seconds each migration takes to export. Default 5",
+    type=float, default=5,
+)
+argparser.add_argument(
+    "--latency", help="Milliseconds added to every request. Default 0",
+    type=float, default=0,
+)
+argparser.add_argument(
+    "--bandwidth",
+    help="Per connection cap on archive downloads and uploads in MB/s. \
+        Default 0, no cap",
+    type=float, default=0,
+)
+argparser.add_argument(
+    "--error-rate",
+    help="Fraction of hot path requests that fail. Archive downloads are \
+        cut short, the rest get a 503. Default 0",
+    type=float, default=0,
+)
+argparser.add_argument(
+    "--rate-limit-rate",
+    help="Fraction of hot path requests answered with 429 and \
+        Retry-After. Default 0",
+    type=float, default=0,
+)
+argparser.add_argument(
+    "--stale-files",
+    help="Files older than any retention policy placed in the archive \
+        folder before the run. Default 0",
+    type=int, default=0,
+)
+argparser.add_argument(
+    "--startup-budget",
+    help="Milliseconds allowed from starting git_backup to its first API \
+        call. The benchmark exits with status 1 when a run is over. \
+        Default 500",
+    type=float, default=500,
+)
+argparser.add_argument(
+    "--stream-rss-budget",
+    help="Peak RSS in MB allowed for each --workers transfer of a run \
+        with --stream, on top of 80MB for the process itself. The \
+        benchmark exits with status 1 when a run is over. Default 40",
+    type=float, default=40,
+)
+argparser.add_argument(
+    "--runs", help="Number of runs, each against fresh services. Default 1",
+    type=int, default=1,
+)
+argparser.add_argument(
+    "--json", help="Also write the results to this file", type=str,
+)
+argparser.add_argument(
+    "--keep", help="Keep the working directories", action="store_true",
+)
+argparser.add_argument(
+    "backup_args", nargs=argparse.REMAINDER,
+    help="Arguments for git_backup, after --",
+)
+
+
+def now_iso(offset=0):
+    """RFC 3339 timestamp as the Google and GitHub APIs write them"""
+    moment = datetime.now(timezone.utc) - timedelta(seconds=offset)
+    return moment.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class Stats:
+    """Call counts and byte totals shared by the request handlers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.faults = {}
+        self.first_call = None
+
+    def count(self, route, table=None):
+        with self._lock:
+            if table is None and self.first_call is None:
+                self.first_call = monotonic()
+            table = self.calls if table is None else table
+            table[route] = table.get(route, 0) + 1
+
+
+class Faults:
+    """Injected latency, bandwidth cap, errors and rate limits"""
+
+    def __init__(self, bench_args, stats):
+        self.latency = bench_args.latency / 1000
+        self.bandwidth = bench_args.bandwidth * 1048576
+        self.error_rate = bench_args.error_rate
+        self.rate_limit_rate = bench_args.rate_limit_rate
+        self.stats = stats
+
+    def pick(self, route, rate_limit=True):
+        """None, "error" or "rate_limit" for one hot path request"""
+        roll = random.random()
+        if roll < self.error_rate:
+            fault = "error"
+        elif rate_limit and roll < self.error_rate + self.rate_limit_rate:
+            fault = "rate_limit"
+        else:
+            return None
+        self.stats.count(f"{route} {fault}", self.stats.faults)
+        return fault
+
+    def throttle(self, size):
+        if self.bandwidth:
+            sleep(size / self.bandwidth)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Common plumbing for the fake services - keep-alive, JSON replies,
+    request bodies and fault injection"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *_):
+        pass
+
+    @property
+    def bench(self):
+        return self.server.bench
+
+    def body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def reply(self, status, data=None, headers=None, raw=None):
+        content = raw if raw is not None else (
+            json.dumps(data).encode() if data is not None else b""
+        )
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if content and "Content-Type" not in (headers or {}):
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def enter(self, route, hot=False):
+        """Count the call, add latency and maybe answer with a fault
+        Returns True when a fault was sent instead of the real reply"""
+        self.bench.stats.count(route)
+        faults = self.bench.faults
+        if faults.latency:
+            sleep(faults.latency)
+        fault = faults.pick(route) if hot else None
+        if fault == "rate_limit":
+            self.reply(429, {"message": "rate limited"},
+                       self.rate_headers({"Retry-After": "1"}))
+            return True
+        if fault == "error":
+            self.reply(503, {"message": "injected error"})
+            return True
+        return False
+
+    def rate_headers(self, headers=None):
+        return headers or {}
+
+
+class GitHub:
+    """State of the fake GitHub org and its migrations"""
+
+    def __init__(self, bench_args, blob):
+        self.lock = threading.Lock()
+        self.repos = [
+            {
+                "full_name": f"{ORG}/repo-{n:05d}",
+                "size": int(bench_args.repo_mb * 1024),
+                "pushed_at": "2026-01-01T00:00:00Z",
+                "updated_at": "2026-01-01T00:00:00Z",
+                "archived": False,
+            }
+            for n in range(bench_args.repos)
+        ]
+        self.migrations = {}
+        self.export_delay = bench_args.export_delay
+        self.blob = blob
+        self.started = time()
+        self.base = None
+
+
+class GitHubHandler(Handler):
+    """Fake GitHub REST, GraphQL and migrations API plus archive storage"""
+
+    def rate_headers(self, headers=None):
+        # A fresh 5000 an hour window, used up one call at a time
+        headers = dict(headers or {})
+        calls = sum(self.bench.stats.calls.values())
+        headers.setdefault("X-RateLimit-Limit", "5000")
+        headers.setdefault("X-RateLimit-Remaining", str(max(5000 - calls, 0)))
+        headers.setdefault(
+            "X-RateLimit-Reset", str(int(self.bench.github.started + 3600))
+        )
+        return headers
+
+    def send_json(self, status, data, headers=None):
+        self.reply(status, data, self.rate_headers(headers))
+
+    def migration(self, item):
+        github = self.bench.github
+        exported = time() >= item["created"] + github.export_delay
+        return {
+            "id": item["id"],
+            "url": f"{github.base}/orgs/{ORG}/migrations/{item['id']}",
+            "state": "exported" if exported else "exporting",
+            "created_at": item["created_at"],
+            "repositories": [{"full_name": i} for i in item["repos"]],
+            **{i: item[i] for i in EXCLUDES},
+        }
+
+    def do_GET(self):
+        github = self.bench.github
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        if url.path == "/user":
+            self.enter("github user")
+            return self.send_json(200, {"login": ORG})
+        if url.path == f"/orgs/{ORG}/repos":
+            if self.enter("github repos", hot=True):
+                return None
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            last = max(1, -(-len(github.repos) // per_page))
+            links = [f'<{github.base}{url.path}?per_page={per_page}\
+&page={last}>; rel="last"']
+            if page < last:
+                links.insert(0, f'<{github.base}{url.path}?per_page=\
+{per_page}&page={page + 1}>; rel="next"')
+            start = (page - 1) * per_page
+            return self.send_json(
+                200,
+                github.repos[start:start + per_page],
+                {"Link": ", ".join(links)}
+            )
+        if url.path == f"/orgs/{ORG}/migrations":
+            self.enter("github migrations list")
+            with github.lock:
+                items = [self.migration(i) for i in github.migrations.values()]
+            return self.send_json(200, items)
+        if len(parts) == 4 and parts[2] == "migrations":
+            if self.enter("github migration status", hot=True):
+                return None
+            item = github.migrations.get(parts[3])
+            if item is None:
+                return self.send_json(404, {"message": "Not Found"})
+            return self.send_json(200, self.migration(item))
+        if len(parts) == 5 and parts[4] == "archive":
+            self.enter("github archive redirect")
+            item = github.migrations.get(parts[3])
+            if item is None or self.migration(item)["state"] != "exported":
+                return self.send_json(404, {"message": "Not Found"})
+            return self.send_json(
+                302, {},
+                {"Location": f"{github.base}/storage/{parts[3]}.tar.gz"}
+            )
+        if parts[0] == "storage":
+            return self.storage()
+        self.enter("github unknown")
+        return self.send_json(404, {"message": "Not Found"})
+
+    def storage(self):
+        """Serve the archive blob with Range support
+        An injected error cuts the body short and drops the connection"""
+        self.bench.stats.count("archive download")
+        faults = self.bench.faults
+        if faults.latency:
+            sleep(faults.latency)
+        size = os.path.getsize(self.bench.github.blob)
+        start = 0
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                return self.reply(416, raw=b"",
+                                  headers={"Content-Range": f"bytes */{size}"})
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{size - 1}/{size}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        cut = None
+        if faults.pick("archive download", rate_limit=False):
+            cut = start + (size - start) // 2
+            self.close_connection = True
+        with open(self.bench.github.blob, "rb") as blob:
+            blob.seek(start)
+            sent = start
+            while sent < size:
+                block = blob.read(BLOCK)
+                if cut is not None and sent + len(block) > cut:
+                    self.wfile.write(block[:cut - sent])
+                    return None
+                faults.throttle(len(block))
+                self.wfile.write(block)
+                sent += len(block)
+        self.bench.count_bytes("downloaded", size - start)
+        return None
+
+    def do_POST(self):
+        github = self.bench.github
+        url = urlparse(self.path)
+        body = self.body()
+        if url.path == f"/orgs/{ORG}/migrations":
+            self.enter("github migration start")
+            request = json.loads(body)
+            with github.lock:
+                key = str(len(github.migrations) + 1)
+                github.migrations[key] = {
+                    "id": int(key),
+                    "repos": request["repositories"],
+                    **{i: bool(request.get(i)) for i in EXCLUDES},
+                    "created": time(),
+                    "created_at": now_iso(),
+                }
+                data = self.migration(github.migrations[key])
+            # An injected error comes after the export was started, so a
+            # client that blindly retries starts a duplicate
+            if self.bench.faults.pick("github migration start", False):
+                return self.send_json(502, {"message": "injected error"})
+            data["state"] = "pending"
+            return self.send_json(201, data)
+        if url.path == "/graphql":
+            if self.enter("github graphql", hot=True):
+                return None
+            variables = json.loads(body)["variables"]
+            start = int(variables.get("cursor") or 0)
+            nodes = [
+                {
+                    "nameWithOwner": i["full_name"],
+                    "diskUsage": i["size"],
+                    "pushedAt": i["pushed_at"],
+                    "updatedAt": i["updated_at"],
+                    "isArchived": i["archived"],
+                }
+                for i in github.repos[start:start + 100]
+            ]
+            more = start + 100 < len(github.repos)
+            return self.send_json(200, {"data": {"organization": {
+                "repositories": {
+                    "pageInfo": {
+                        "hasNextPage": more,
+                        "endCursor": str(start + 100),
+                    },
+                    "nodes": nodes,
+                }
+            }}})
+        self.enter("github unknown")
+        return self.send_json(404, {"message": "Not Found"})
+
+
+class Drive:
+    """State of the fake Drive - file metadata, small file contents and
+    open resumable upload sessions. Archive bytes are hashed, not kept"""
+
+    def __init__(self, bench_args):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.contents = {}
+        # Archive bytes are only kept for --restore and --mirror
+        self.keep = bench_args.restore or bench_args.mirror
+        self.sessions = {}
+        self.next_id = 0
+        self.base = None
+        for n in range(bench_args.stale_files):
+            self.add("git-archive-stale-set-" + str(n) + ".tar.gz",
+                     archive_folder(bench_args, 1), 0, "",
+                     offset=86400 * (400 + n))
+
+    def add(self, name, parent, size, md5, offset=0):
+        with self.lock:
+            self.next_id += 1
+            file_id = f"file-{self.next_id}"
+            self.files[file_id] = {
+                "id": file_id,
+                "name": name,
+                "parents": [parent],
+                "createdTime": now_iso(offset),
+                "size": str(size),
+                "md5Checksum": md5,
+            }
+        return self.files[file_id]
+
+
+class DriveHandler(Handler):
+    """Fake Google token endpoint and Drive v3 files API"""
+
+    def do_POST(self):
+        drive = self.bench.drive
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.body()
+        if url.path == "/token":
+            self.enter("google token")
+            return self.reply(200, {
+                "access_token": "bench-token",
+                "expires_in": 3600,
+                "token_type": "Bearer",
+            })
+        if url.path == "/batch/drive/v3":
+            self.enter("drive batch")
+            return self.batch(body)
+        if url.path == "/upload/drive/v3/files":
+            upload_type = query.get("uploadType", [""])[0]
+            if upload_type == "resumable":
+                self.enter("drive upload start")
+                metadata = json.loads(body or b"{}")
+                with drive.lock:
+                    drive.next_id += 1
+                    session = str(drive.next_id)
+                    drive.sessions[session] = {
+                        "metadata": metadata,
+                        "received": 0,
+                        "md5": hashlib.md5(),
+                    }
+                    if drive.keep:
+                        drive.sessions[session]["data"] = []
+                    if metadata.get("name", "").endswith(RECOMPRESSED):
+                        drive.sessions[session]["tar"] = TarDigest(
+                            metadata["name"]
+                        )
+                return self.reply(200, {}, {
+                    "Location": f"{drive.base}/upload/drive/v3/files\
+?uploadType=resumable&upload_id={session}"
+                })
+            self.enter("drive upload multipart")
+            message = email.parser.BytesParser().parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode()
+                + b"\r\n\r\n" + body
+            )
+            metadata_part, media_part = message.get_payload()
+            metadata = json.loads(metadata_part.get_payload())
+            content = media_part.get_payload(decode=True)
+            item = drive.add(
+                metadata["name"], metadata["parents"][0], len(content),
+                hashlib.md5(content).hexdigest()
+            )
+            drive.contents[item["id"]] = content
+            return self.reply(200, item)
+        self.enter("drive unknown")
+        return self.reply(404, {"error": {"code": 404}})
+
+    def do_PUT(self):
+        """One chunk of a resumable upload, or a status query"""
+        drive = self.bench.drive
+        query = parse_qs(urlparse(self.path).query)
+        session = drive.sessions.get(query.get("upload_id", [""])[0])
+        length = int(self.headers.get("Content-Length", 0))
+        blocks = []
+        remaining = length
+        while remaining:
+            blocks.append(self.rfile.read(min(BLOCK, remaining)))
+            remaining -= len(blocks[-1])
+            self.bench.faults.throttle(len(blocks[-1]))
+        if self.enter("drive upload chunk", hot=length > 0):
+            return None
+        if session is None:
+            return self.reply(404, {"error": {"code": 404}})
+        content_range = self.headers.get("Content-Range", "")
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", content_range)
+        total = content_range.rsplit("/", 1)[-1]
+        # Anything else is a status query, or a chunk the session
+        # cannot take, and only gets the committed range back
+        if match and int(match.group(1)) == session["received"]:
+            for block in blocks:
+                session["md5"].update(block)
+                if "tar" in session:
+                    session["tar"].update(block)
+                if "data" in session:
+                    session["data"].append(block)
+            session["received"] += length
+            self.bench.count_bytes("uploaded", length)
+        if total.isdigit() and session["received"] == int(total):
+            if "file" not in session:
+                metadata = session["metadata"]
+                session["file"] = drive.add(
+                    metadata.get("name", "untitled"),
+                    metadata.get("parents", ["root"])[0],
+                    session["received"],
+                    session["md5"].hexdigest()
+                )
+                if "tar" in session:
+                    session["file"]["tarMd5"] = \
+                        session["tar"].md5.hexdigest()
+                if "data" in session:
+                    drive.contents[session["file"]["id"]] = \
+                        b"".join(session.pop("data"))
+            return self.reply(200, session["file"])
+        headers = {}
+        if session["received"]:
+            headers["Range"] = f"bytes=0-{session['received'] - 1}"
+        return self.reply(308, raw=b"", headers=headers)
+
+    def do_GET(self):
+        drive = self.bench.drive
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/drive/v3/files":
+            self.enter("drive list")
+            return self.list_files(query)
+        file_id = url.path.rsplit("/", 1)[-1]
+        item = drive.files.get(file_id)
+        if item is None:
+            self.enter("drive get")
+            return self.reply(404, {"error": {"code": 404}})
+        if query.get("alt") == ["media"]:
+            self.enter("drive download")
+            content = drive.contents.get(file_id, b"")
+            match = re.match(r"bytes=(\d+)-(\d*)",
+                             self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2) or len(content) - 1)
+                content = content[start:end + 1]
+                self.bench.count_bytes("restored", len(content))
+                return self.reply(206, raw=content, headers={
+                    "Content-Type": "application/octet-stream",
+                    "Content-Range": f"bytes {start}-{end}/{item['size']}",
+                })
+            return self.reply(200, raw=content,
+                              headers={"Content-Type": "application/json"})
+        self.enter("drive get")
+        return self.reply(200, item)
+
+    def do_DELETE(self):
+        self.enter("drive delete")
+        file_id = urlparse(self.path).path.rsplit("/", 1)[-1]
+        with self.bench.drive.lock:
+            found = self.bench.drive.files.pop(file_id, None)
+        return self.reply(204 if found else 404, raw=b"")
+
+    def list_files(self, query):
+        q = query.get("q", [""])[0]
+        name = re.search(r"name = '([^']*)'", q)
+        parent = re.search(r"'([^']*)' in parents", q)
+        with self.bench.drive.lock:
+            files = [
+                i for i in self.bench.drive.files.values()
+                if (name is None or i["name"] == name.group(1))
+                and (parent is None or parent.group(1) in i["parents"])
+            ]
+        if "createdTime desc" in query.get("orderBy", [""])[0]:
+            files.sort(key=lambda i: i["createdTime"], reverse=True)
+        start = int(query.get("pageToken", ["0"])[0])
+        size = int(query.get("pageSize", ["100"])[0])
+        data = {"files": files[start:start + size]}
+        if start + size < len(files):
+            data["nextPageToken"] = str(start + size)
+        return self.reply(200, data)
+
+    def batch(self, body):
+        """Answer a multipart/mixed batch of deletes"""
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + self.headers["Content-Type"].encode()
+            + b"\r\n\r\n" + body
+        )
+        boundary = "batch_bench"
+        answer = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            if isinstance(request, list):
+                request = request[0].as_string()
+            method, target = request.split(" ", 2)[:2]
+            file_id = urlparse(target).path.rsplit("/", 1)[-1]
+            status = "404 Not Found"
+            if method == "DELETE":
+                self.bench.stats.count("drive batch delete")
+                with self.bench.drive.lock:
+                    if self.bench.drive.files.pop(file_id, None):
+                        status = "204 No Content"
+            content_id = part["Content-ID"].strip("<>")
+            answer.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n\r\n\r\n"
+            )
+        answer.append(f"--{boundary}--\r\n")
+        return self.reply(200, raw="".join(answer).encode(), headers={
+            "Content-Type": f"multipart/mixed; boundary={boundary}"
+        })
+
+
+class S3:
+    """State of the fake S3 bucket - the MD5 of every object and the
+    parts of open multipart uploads"""
+
+    ACCESS_KEY = "bench-access"
+    SECRET_KEY = "bench-secret"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.next_id = 0
+        self.base = None
+
+
+class S3Handler(Handler):
+    """Fake S3 object, multipart upload and Signature Version 4 checks
+    The signature is worked out again from the request as received"""
+
+    def signed(self):
+        match = re.match(
+            r"AWS4-HMAC-SHA256 Credential=([^/]+)/([^,]+), "
+            r"SignedHeaders=([^,]+), Signature=(\w+)",
+            self.headers.get("Authorization", "")
+        )
+        if not match or match.group(1) != S3.ACCESS_KEY:
+            return False
+        scope, names, signature = match.group(2, 3, 4)
+        url = urlparse(self.path)
+        canonical = "\n".join([
+            self.command,
+            url.path,
+            url.query,
+            "".join(
+                f"{i}:{self.headers.get(i, '').strip()}\n"
+                for i in names.split(";")
+            ),
+            names,
+            self.headers.get("x-amz-content-sha256", ""),
+        ])
+        key = ("AWS4" + S3.SECRET_KEY).encode()
+        for part in scope.split("/"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        expected = hmac.new(key, "\n".join([
+            "AWS4-HMAC-SHA256",
+            self.headers.get("x-amz-date", ""),
+            scope,
+            hashlib.sha256(canonical.encode()).hexdigest(),
+        ]).encode(), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+
+    def error(self, status, code):
+        return self.reply(status, raw=f"<Error><Code>{code}</Code>\
+</Error>".encode(), headers={"Content-Type": "application/xml"})
+
+    def xml(self, body):
+        return self.reply(200, raw=body.encode(),
+                          headers={"Content-Type": "application/xml"})
+
+    def checked_body(self):
+        """Request body, or None if it does not match its Content-MD5"""
+        body = self.body()
+        md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+        if body and self.headers.get("Content-MD5") != md5:
+            return None
+        return body
+
+    def do_PUT(self):
+        s3 = self.bench.s3
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        key = url.path.split("/", 2)[2]
+        # Read first, so a fault leaves nothing behind on the connection
+        body = self.checked_body()
+        if self.enter("s3 part" if "uploadId" in query else "s3 put",
+                      hot=True):
+            return None
+        if not self.signed():
+            return self.error(403, "SignatureDoesNotMatch")
+        if body is None:
+            return self.error(400, "BadDigest")
+        self.bench.faults.throttle(len(body))
+        self.bench.count_bytes("sinks", len(body))
+        md5 = hashlib.md5(body).hexdigest()
+        if "uploadId" in query:
+            with s3.lock:
+                upload = s3.uploads.get(query["uploadId"][0])
+                if upload is None:
+                    return self.error(404, "NoSuchUpload")
+                upload[int(query["partNumber"][0])] = body
+        else:
+            with s3.lock:
+                s3.objects[key] = {"md5": md5, "size": len(body)}
+        return self.reply(200, raw=b"", headers={"ETag": f'"{md5}"'})
+
+    def do_POST(self):
+        s3 = self.bench.s3
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        key = url.path.split("/", 2)[2]
+        if "uploads" in query:
+            self.enter("s3 start")
+            if not self.signed():
+                return self.error(403, "SignatureDoesNotMatch")
+            with s3.lock:
+                s3.next_id += 1
+                upload_id = f"upload-{s3.next_id}"
+                s3.uploads[upload_id] = {}
+            return self.xml(f"<InitiateMultipartUploadResult>\
+<Key>{key}</Key><UploadId>{upload_id}</UploadId>\
+</InitiateMultipartUploadResult>")
+        body = self.checked_body()
+        self.enter("s3 complete")
+        if not self.signed():
+            return self.error(403, "SignatureDoesNotMatch")
+        if body is None:
+            return self.error(400, "BadDigest")
+        with s3.lock:
+            upload = s3.uploads.pop(query.get("uploadId", [""])[0], None)
+        if upload is None:
+            return self.error(404, "NoSuchUpload")
+        numbers = [
+            int(i.text) for i in ElementTree.fromstring(body).iter()
+            if i.tag == "PartNumber"
+        ]
+        data = b"".join(upload[i] for i in numbers)
+        etag = hashlib.md5(
+            b"".join(hashlib.md5(upload[i]).digest() for i in numbers)
+        ).hexdigest() + f"-{len(numbers)}"
+        with s3.lock:
+            s3.objects[key] = {
+                "md5": hashlib.md5(data).hexdigest(), "size": len(data)
+            }
+        return self.xml(f"<CompleteMultipartUploadResult><Key>{key}</Key>\
+<ETag>&quot;{etag}&quot;</ETag></CompleteMultipartUploadResult>")
+
+
+class Bench:
+    """Fake services for one run"""
+
+    def __init__(self, bench_args, blob):
+        self.stats = Stats()
+        self.faults = Faults(bench_args, self.stats)
+        self.github = GitHub(bench_args, blob)
+        self.drive = Drive(bench_args)
+        self.s3 = S3()
+        self.bytes = {
+            "downloaded": 0, "uploaded": 0, "restored": 0, "sinks": 0
+        }
+        self._lock = threading.Lock()
+        self.servers = []
+        for handler, state in (
+            (GitHubHandler, self.github),
+            (DriveHandler, self.drive),
+            (S3Handler, self.s3)
+        ):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+            server.daemon_threads = True
+            server.bench = self
+            state.base = f"http://127.0.0.1:{server.server_address[1]}"
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+
+    def count_bytes(self, key, size):
+        with self._lock:
+            self.bytes[key] += size
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+class TarDigest:
+    """MD5 of the tar inside a --recompress upload, fed as it arrives
+    The archive is a run of zstd frames or xz streams"""
+
+    def __init__(self, name):
+        self.zstd = name.endswith(".zst")
+        self.md5 = hashlib.md5()
+        self.decompressor = self.new()
+
+    def new(self):
+        if self.zstd:
+            import zstandard
+            return zstandard.ZstdDecompressor().decompressobj()
+        return lzma.LZMADecompressor()
+
+    def update(self, data):
+        while data:
+            self.md5.update(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            data = self.decompressor.unused_data
+            self.decompressor = self.new()
+
+
+def blob_member(number):
+    """Path of one repo's data in the archive, laid out as GitHub does"""
+    return f"repositories/{ORG}/repo-{number:05d}.git/objects/pack.bin"
+
+
+def make_blob(directory, size, compressible=0, members=1):
+    """A real .tar.gz close to size bytes, of random data with the
+    given fraction of text made of a small vocabulary, split over
+    members repos"""
+    blob = os.path.join(directory, "archive.tar.gz")
+    data_file = os.path.join(directory, "repo.bin")
+    words = [os.urandom(4).hex()[:random.randint(2, 8)] for _ in range(512)]
+    with tarfile.open(blob, "w:gz", compresslevel=1) as tar:
+        for number in range(members):
+            with open(data_file, "wb") as data:
+                remaining = size // members
+                while remaining > 0:
+                    length = min(BLOCK * 4, remaining)
+                    text = int(length * compressible)
+                    if text:
+                        chunk = " ".join(random.choices(words, k=text // 4))
+                        data.write(chunk.encode()[:text].ljust(text))
+                    data.write(os.urandom(length - text))
+                    remaining -= length
+            tar.add(data_file, arcname=blob_member(number))
+    os.remove(data_file)
+    return blob
+
+
+def service_account_key(token_uri):
+    """Service account file with a throwaway key - the fake token
+    endpoint accepts any signature"""
+    import rsa
+    _, private_key = rsa.newkeys(2048)
+    return {
+        "type": "service_account",
+        "project_id": "bench",
+        "private_key_id": "bench",
+        "private_key": private_key.save_pkcs1().decode(),
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "client_id": "1",
+        "token_uri": token_uri,
+    }
+
+
+def archive_folder(bench_args, number):
+    """Drive folder of org number, counting from 1"""
+    if bench_args.orgs == 1:
+        return "archive-folder"
+    return f"archive-folder-{number}"
+
+
+def org_args(bench_args, orgs=None):
+    """--org arguments for the first orgs orgs, or for them all"""
+    if bench_args.orgs == 1:
+        return []
+    return [
+        i for n in range(1, (orgs or bench_args.orgs) + 1)
+        for i in ("--org", f"git-org{n}:drive-org{n}")
+    ]
+
+
+def sink_args(bench_args):
+    if not bench_args.sinks:
+        return []
+    return ["--sink", "sink-disk", "--sink", "sink-s3"]
+
+
+def mirror_args(bench_args):
+    if not bench_args.mirror:
+        return []
+    return ["--engine", "mirror"]
+
+
+def tier_args(bench_args):
+    if not bench_args.tiers:
+        return []
+    return ["--tier", "tier-git"]
+
+
+def sink_check(bench, work, archives):
+    """Compare the copy of every archive in each sink with Drive's"""
+    copies = 0
+    intact = 0
+    for item in archives:
+        if item["name"].endswith(".parts.json"):
+            name = item["name"][:-len(".parts.json")]
+            md5 = json.loads(bench.drive.contents[item["id"]])["md5"]
+        else:
+            name = item["name"]
+            md5 = item["md5Checksum"]
+        local = os.path.join(work, "sink-disk", name)
+        if os.path.exists(local):
+            copies += 1
+            with open(local, "rb") as copy:
+                intact += hashlib.md5(copy.read()).hexdigest() == md5
+        found = bench.s3.objects.get("git_backup/" + name)
+        if found:
+            copies += 1
+            intact += found["md5"] == md5
+    return {
+        "copies": copies,
+        "intact": intact,
+        "s3_bytes": bench.bytes["sinks"],
+    }
+
+
+def write_setup(work, bench, key, bench_args):
+    with open(os.path.join(work, "config.ini"), "w", encoding="utf-8") as ini:
+        for n in range(1, bench_args.orgs + 1):
+            section = "prod" if bench_args.orgs == 1 else f"org{n}"
+            token = "bench-token" if bench_args.orgs == 1 \
+                else f"bench-token-{n}"
+            ini.write(f"""[git-{section}]
+user = {ORG}
+token = {token}
+url = {bench.github.base}/orgs/{ORG}/
+api = {bench.github.base}
+""")
+            if bench_args.mirror:
+                ini.write(f"clone_url = {work}/origins/{{repo}}.git\n")
+            ini.write(f"""[drive-{section}]
+folder = {archive_folder(bench_args, n)}
+logfolder = log-folder
+api = {bench.drive.base}/
+""")
+        if bench_args.sinks:
+            # 5 MB parts, so archives go up as S3 multipart uploads
+            ini.write(f"""[sink-disk]
+type = local
+path = sink-disk
+[sink-s3]
+type = s3
+endpoint = {bench.s3.base}
+bucket = bench-bucket
+prefix = git_backup/
+access_key = {S3.ACCESS_KEY}
+secret_key = {S3.SECRET_KEY}
+part_mb = 5
+""")
+        if bench_args.tiers:
+            ini.write(f"""[tier-git]
+repos = {ORG}/repo-*[13579]
+exclude_attachments = true
+exclude_releases = true
+exclude_metadata = true
+""")
+    key = dict(key, token_uri=f"{bench.drive.base}/token")
+    with open(os.path.join(work, "client_secret.json"), "w",
+              encoding="utf-8") as key_file:
+        json.dump(key, key_file)
+
+
+def seed_timings(work, bench_args):
+    """Export history matching --export-delay, so git_backup checks
+    the fake migrations as soon as they could be done rather than on
+    its defaults for real GitHub exports
+    The fake exports take the same time at any size, so the history
+    spans set sizes for the fit to find that out"""
+    mb = bench_args.repo_mb
+    samples = [[count, size, bench_args.export_delay]
+               for count, size in ((100, 100 * mb), (50, 100 * mb),
+                                   (10, 5 * mb))]
+    with open(os.path.join(work, "export_timings.json"), "w",
+              encoding="utf-8") as timings:
+        json.dump(samples, timings)
+
+
+def origin(work, number):
+    return os.path.join(work, "origins", ORG, f"repo-{number:05d}.git")
+
+
+def fast_import(directory, commands):
+    """Add commits to a bare repo with git fast-import"""
+    subprocess.run(
+        ["git", "-C", directory, "fast-import", "--quiet"],
+        input=commands, capture_output=True, check=True
+    )
+
+
+def commit(ref, message, data, parent=None):
+    """fast-import commands of a commit adding one file to ref"""
+    when = int(time())
+    return b"".join([
+        f"commit {ref}\ncommitter Bench <bench@example.com> {when} +0000\n"
+        f"data {len(message)}\n{message}\n".encode(),
+        f"from {parent}\n".encode() if parent else b"",
+        f"M 644 inline {message}.bin\ndata {len(data)}\n".encode(),
+        data, b"\n",
+    ])
+
+
+def make_origins(work, bench_args):
+    """Bare repos for --mirror, each a main branch of two commits and a
+    tag, standing in for the org's repos on GitHub"""
+    for number in range(bench_args.repos):
+        directory = origin(work, number)
+        subprocess.run(
+            ["git", "init", "--quiet", "--bare", directory], check=True
+        )
+        fast_import(directory, b"".join([
+            commit("refs/heads/main", "first",
+                   os.urandom(bench_args.mirror_kb * 1024)),
+            commit("refs/heads/main", "second", os.urandom(4096)),
+            b"reset refs/tags/v1\nfrom refs/heads/main\n\n",
+        ]))
+        subprocess.run(
+            ["git", "-C", directory, "symbolic-ref", "HEAD",
+             "refs/heads/main"], check=True
+        )
+
+
+def repo_refs(directory):
+    """Refs and HEAD of a repo, to compare a restore with its origin"""
+    return subprocess.run(
+        ["git", "-C", directory, "for-each-ref",
+         "--format=%(objectname) %(refname)"],
+        capture_output=True, text=True, check=True
+    ).stdout + subprocess.run(
+        ["git", "-C", directory, "symbolic-ref", "HEAD"],
+        capture_output=True, text=True, check=False
+    ).stdout
+
+
+def archive_bytes(bench, names=None):
+    """Bytes of the archives in Drive, only those not in names if given"""
+    return sum(
+        int(i["size"]) for i in bench.drive.files.values()
+        if i["name"].endswith((".tar.gz", ".parts.json"))
+        and "stale" not in i["name"]
+        and i["id"] not in (names or ())
+    )
+
+
+def mirror_check(bench, bench_args, work, env, output, backup_args):
+    """Commit to one repo and branch another without new commits, back
+    up again with --incremental and restore both with git_backup restore
+    The second run has to start in a later minute, as archive names go
+    down to the minute"""
+    first = set(bench.drive.files)
+    first_bytes = archive_bytes(bench)
+    fast_import(origin(work, 0), commit(
+        "refs/heads/main", "third", os.urandom(16384), "refs/heads/main^0"
+    ))
+    subprocess.run(
+        ["git", "-C", origin(work, 1), "branch", "feature", "main~1"],
+        check=True
+    )
+    with bench.github.lock:
+        for number in (0, 1):
+            bench.github.repos[number]["pushed_at"] = now_iso()
+    sleep(61 - datetime.now().second)
+    started = monotonic()
+    child = subprocess.run(
+        [sys.executable, "-m", "git_backup", "--level", "INFO"]
+        + org_args(bench_args, 1) + mirror_args(bench_args)
+        + backup_args + ["--incremental"],
+        cwd=work, env=env, stdout=output, stderr=subprocess.STDOUT,
+        check=False
+    )
+    seconds = monotonic() - started
+    intact = 0
+    for number in (0, 1):
+        repo = f"{ORG}/repo-{number:05d}"
+        subprocess.run(
+            [sys.executable, "-m", "git_backup", "--level", "INFO"]
+            + org_args(bench_args, 1) + ["restore", "--repo", repo],
+            cwd=work, env=env, stdout=output, stderr=subprocess.STDOUT,
+            check=False
+        )
+        restored = os.path.join(work, "restore", "repositories", repo + ".git")
+        intact += os.path.isdir(restored) \
+            and repo_refs(restored) == repo_refs(origin(work, number))
+    return {
+        "exit_code": child.returncode,
+        "seconds": round(seconds, 2),
+        "full_bytes": first_bytes,
+        "incremental_bytes": archive_bytes(bench, first),
+        "restored_intact": intact,
+    }
+
+
+def disk_use(directory):
+    total = 0
+    for folder, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(folder, name))
+            except OSError:
+                pass
+    return total
+
+
+def peak_rss(pid):
+    """High water mark of a process's resident memory in bytes"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def restore_check(bench, bench_args, blob, work, env, output):
+    """Restore the middle repo of the first org's first archive with
+    git_backup restore and compare it with the blob"""
+    names = sorted(
+        i["name"] for i in bench.drive.files.values()
+        if i["name"].endswith((".tar.gz", ".parts.json") + RECOMPRESSED)
+        and "stale" not in i["name"]
+        and archive_folder(bench_args, 1) in i["parents"]
+    )
+    if not names:
+        return None
+    name = names[0].removesuffix(".parts.json")
+    with tarfile.open(blob) as tar:
+        members = tar.getnames()
+        member = members[len(members) // 2]
+        expected = hashlib.md5(tar.extractfile(member).read()).hexdigest()
+    repo = member.split("/")[2].removesuffix(".git")
+    archive_bytes = sum(
+        int(i["size"]) for i in bench.drive.files.values()
+        if i["name"] == name or i["name"].startswith(name + ".part0")
+    )
+
+    bench.bytes["restored"] = 0
+    started = monotonic()
+    child = subprocess.run(
+        [sys.executable, "-m", "git_backup", "--level", "INFO"]
+        + org_args(bench_args, 1)
+        + ["restore", "--archive", name, "--repo", f"{ORG}/{repo}"],
+        cwd=work, env=env, stdout=output, stderr=subprocess.STDOUT,
+        check=False
+    )
+    seconds = monotonic() - started
+    restored = os.path.join(work, "restore", member)
+    intact = False
+    if os.path.exists(restored):
+        with open(restored, "rb") as restored_file:
+            intact = hashlib.md5(restored_file.read()).hexdigest() \
+                == expected
+    return {
+        "archive": name,
+        "member": member,
+        "exit_code": child.returncode,
+        "seconds": round(seconds, 2),
+        "intact": intact,
+        "bytes_fetched": bench.bytes["restored"],
+        "archive_bytes": archive_bytes,
+    }
+
+
+def run_once(bench_args, blob, key, scratch, number):
+    bench = Bench(bench_args, blob)
+    work = tempfile.mkdtemp(prefix=f"run{number}-", dir=scratch)
+    write_setup(work, bench, key, bench_args)
+    seed_timings(work, bench_args)
+    if bench_args.mirror:
+        make_origins(work, bench_args)
+    backup_args = [i for i in bench_args.backup_args if i != "--"]
+    env = dict(
+        os.environ, NO_PROXY="127.0.0.1,localhost", PYTHONPATH=ROOT_DIR
+    )
+    baseline = disk_use(work)
+    peaks = {"rss": 0, "disk": 0}
+    output = open(os.path.join(scratch, f"run{number}.out"), "wb")
+    started = monotonic()
+    child = subprocess.Popen(
+        [sys.executable, "-m", "git_backup", "--level", "INFO"]
+        + org_args(bench_args) + sink_args(bench_args)
+        + tier_args(bench_args) + mirror_args(bench_args) + backup_args,
+        cwd=work, env=env, stdout=output, stderr=subprocess.STDOUT
+    )
+    while child.poll() is None:
+        peaks["rss"] = max(peaks["rss"], peak_rss(child.pid))
+        peaks["disk"] = max(peaks["disk"], disk_use(work) - baseline)
+        sleep(0.05)
+    wall = monotonic() - started
+    mirror = None
+    if bench_args.mirror and child.returncode == 0:
+        mirror = mirror_check(
+            bench, bench_args, work, env, output, backup_args
+        )
+    restore = None
+    if bench_args.restore and child.returncode == 0 \
+            and not bench_args.mirror:
+        restore = restore_check(
+            bench, bench_args, blob, work, env, output
+        )
+    output.close()
+    bench.stop()
+
+    with open(blob, "rb") as blob_file:
+        blob_md5 = hashlib.md5(blob_file.read()).hexdigest()
+    with gzip.open(blob, "rb") as blob_file:
+        tar_md5 = hashlib.md5(blob_file.read()).hexdigest()
+    archives = [
+        i for i in bench.drive.files.values()
+        if i["name"].endswith((".tar.gz", ".parts.json") + RECOMPRESSED)
+        and "stale" not in i["name"]
+    ]
+    result = {
+        "run": number,
+        "exit_code": child.returncode,
+        "wall_seconds": round(wall, 2),
+        "first_call_ms": round((bench.stats.first_call - started) * 1000)
+        if bench.stats.first_call else None,
+        "migrations": len(bench.github.migrations),
+        "migrations_excluding": sum(
+            any(i[j] for j in EXCLUDES)
+            for i in bench.github.migrations.values()
+        ),
+        "archives_uploaded": len(archives),
+        # Parts of a --recompress archive can not be checked
+        "archives_intact": sum(
+            json.loads(bench.drive.contents[i["id"]])["md5"] == blob_md5
+            if i["name"].endswith(".parts.json")
+            else i.get("tarMd5") == tar_md5
+            if i["name"].endswith(RECOMPRESSED)
+            else i["md5Checksum"] == blob_md5
+            for i in archives
+        ),
+        "bytes_downloaded": bench.bytes["downloaded"],
+        "bytes_uploaded": bench.bytes["uploaded"],
+        "upload_bytes_per_second": round(bench.bytes["uploaded"] / wall),
+        "peak_rss_bytes": peaks["rss"],
+        "peak_disk_bytes": peaks["disk"],
+        "calls": dict(sorted(bench.stats.calls.items())),
+        "faults": dict(sorted(bench.stats.faults.items())),
+    }
+    if restore:
+        result["restore"] = restore
+    if mirror:
+        result["mirror"] = mirror
+    if bench_args.sinks:
+        result["sinks"] = sink_check(bench, work, archives)
+    # Per-phase timings from git_backup's own run report
+    for name in os.listdir(work):
+        if name.startswith("git_backup_report_"):
+            with open(os.path.join(work, name), encoding="utf-8") as run:
+                result["phases"] = json.load(run)["phases"]
+    if not bench_args.keep:
+        shutil.rmtree(work, ignore_errors=True)
+    return result
+
+
+def report(results):
+    for result in results:
+        print(f"Run {result['run']}: exit {result['exit_code']}, \
+{result['wall_seconds']}s, \
+{round(result['upload_bytes_per_second'] / 1048576, 2)} MB/s uploaded, \
+{result['archives_intact']}/{result['migrations']} archives intact, \
+{result['migrations_excluding']} leaving data out")
+        print(f"    peak RSS {round(result['peak_rss_bytes'] / 1048576)} MB, \
+peak disk {round(result['peak_disk_bytes'] / 1048576)} MB, \
+first API call after {result['first_call_ms']} ms")
+        restore = result.get("restore")
+        if restore:
+            print(f"    restore of {restore['member']}: exit \
+{restore['exit_code']}, {restore['seconds']}s, \
+{'intact' if restore['intact'] else 'NOT intact'}, fetched \
+{round(restore['bytes_fetched'] / 1048576, 1)} of \
+{round(restore['archive_bytes'] / 1048576, 1)} MB")
+        mirror = result.get("mirror")
+        if mirror:
+            print(f"    mirror: full {round(mirror['full_bytes'] / 1024)} KB, \
+incremental {round(mirror['incremental_bytes'] / 1024)} KB in \
+{mirror['seconds']}s, exit {mirror['exit_code']}, \
+{mirror['restored_intact']}/2 restores intact")
+        sinks = result.get("sinks")
+        if sinks:
+            print(f"    sinks: {sinks['intact']}/{sinks['copies']} copies \
+intact, {round(sinks['s3_bytes'] / 1048576, 1)} MB sent to S3")
+        for phase, item in result.get("phases", {}).items():
+            print(f"    {phase}: {item['seconds']}s over {item['count']}")
+        for route, count in result["calls"].items():
+            print(f"    {route}: {count}")
+        for route, count in result["faults"].items():
+            print(f"    injected {route}: {count}")
+    if len(results) > 1:
+        walls = [i["wall_seconds"] for i in results]
+        print(f"Median wall time {statistics.median(walls)}s over \
+{len(results)} runs")
+
+
+def over_budget(results, budget):
+    """Runs that took longer than budget milliseconds to make a call"""
+    return [
+        i["run"] for i in results
+        if i["first_call_ms"] is None or i["first_call_ms"] > budget
+    ]
+
+
+def over_rss(results, bench_args):
+    """Runs with --stream whose peak RSS was over the --stream-rss-budget
+    of their --workers transfers"""
+    backup_args = [i for i in bench_args.backup_args if i != "--"]
+    if "--stream" not in backup_args:
+        return [], None
+    workers = 4
+    for index, arg in enumerate(backup_args):
+        if arg in ("--workers", "-w") and index + 1 < len(backup_args):
+            workers = int(backup_args[index + 1])
+        elif arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+    budget = 80 + workers * bench_args.stream_rss_budget
+    return [
+        i["run"] for i in results
+        if i["peak_rss_bytes"] > budget * 1048576
+    ], budget
+
+
+def main():
+    bench_args = argparser.parse_args()
+    scratch = tempfile.mkdtemp(prefix="git-backup-bench-")
+    blob = make_blob(
+        scratch, int(bench_args.archive_mb * 1048576),
+        bench_args.compressible, bench_args.members
+    )
+    key = service_account_key("")
+    results = [
+        run_once(bench_args, blob, key, scratch, number)
+        for number in range(1, bench_args.runs + 1)
+    ]
+    report(results)
+    if bench_args.json:
+        with open(bench_args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=2)
+    if bench_args.keep:
+        print(f"Working directories and git_backup output are in {scratch}")
+    else:
+        shutil.rmtree(scratch, ignore_errors=True)
+    slow = over_budget(results, bench_args.startup_budget)
+    if slow:
+        print(f"Cold start over the {bench_args.startup_budget} ms budget \
+in runs {slow}")
+    heavy, budget = over_rss(results, bench_args)
+    if heavy:
+        print(f"Peak RSS over the {round(budget)} MB --stream budget \
+in runs {heavy}")
+    if slow or heavy:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
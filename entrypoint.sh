@@ -1,5 +1,5 @@
 #!/bin/bash
 
-python "/git_backup/git_backup.py"
+cd /git_backup && python -m git_backup
 
 tail -f $(ls -t | grep git_backup_ | head -1)
\ No newline at end of file
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3.10
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Created By  : Dani Westlake
+# Created Date: 2022-05-25
+# version ='1.0'
+# ---------------------------------------------------------------------------
+"""
+Created to pull an archive of the Brainlabs organisation
+from Github and save to googledrive
+
+Run with python -m git_backup, or call git_backup.main(argv)
+Importing the package has no side effects - arguments, logging and config
+are only set up by main(), and the Google client libraries are only
+imported once a run first talks to Google Drive
+
+TODO:
+- Error handling
+"""
+# ---------------------------------------------------------------------------
+from time import monotonic
+
+# Start of the run, for the startup time in the run report
+STARTED = monotonic()
+
+
+def main(argv=None):
+    """Run a backup - see git_backup.cli.main()"""
+    from .cli import main as cli_main
+    return cli_main(argv)
@@ -0,0 +1,7 @@
+"""python -m git_backup [options] [restore ...]"""
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,319 @@
+"""Backup catalog - which repo is in which archive from which run
+Kept as a SQLite database beside the run journal, with a copy in the
+archive folder so a fresh container starts from the full history"""
+
+from contextlib import closing
+from datetime import date, datetime, timedelta
+import json
+import logging
+from os import path, remove, replace, utime
+import sqlite3
+from time import monotonic
+
+from . import settings
+from .settings import args, current_org, drive_config, ROOT_DIR
+from .settings import CHUNK_SIZE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started TEXT NOT NULL,
+    incremental INTEGER NOT NULL,
+    finished TEXT
+);
+CREATE TABLE IF NOT EXISTS archives (
+    run_id TEXT NOT NULL REFERENCES runs,
+    set_key INTEGER NOT NULL,
+    archive TEXT NOT NULL,
+    file_id TEXT,
+    bytes INTEGER,
+    sha256 TEXT,
+    md5 TEXT,
+    migration_id INTEGER,
+    tier TEXT,
+    PRIMARY KEY (run_id, set_key)
+);
+CREATE INDEX IF NOT EXISTS archives_archive ON archives (archive);
+CREATE INDEX IF NOT EXISTS archives_file_id ON archives (file_id);
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    set_key INTEGER NOT NULL,
+    pushed_at TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (repo, run_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS repos_run ON repos (run_id, set_key);
+"""
+
+COLUMNS = (
+    "run_id", "started", "repo", "set_key", "archive", "file_id", "bytes",
+    "sha256", "md5", "migration_id", "tier"
+)
+
+
+def migration_id(mig_url):
+    """ID at the end of a migration's API URL, or None"""
+    last = str(mig_url or "").rstrip("/").rsplit("/", 1)[-1]
+    return int(last) if last.isdigit() else None
+
+
+def run_bound(day, after=False):
+    """Lowest run ID on day, or with after the lowest run ID after it
+    Run IDs are rundates, so they sort as text"""
+    day = date.fromisoformat(day)
+    if after:
+        day += timedelta(1)
+    return day.strftime("%Y-%m-%d")
+
+
+class Catalog:
+    """Every archive set uploaded, its repos, Drive file and digests
+    Repos are keyed by name then run, so a lookup reads only the rows of
+    the repos asked for whatever the number of runs"""
+
+    NAME = "git_backup_catalog.db"
+
+    def __init__(self, file, file_id=None):
+        self.file = file
+        self.file_id = file_id
+        self.db = sqlite3.connect(file)
+        self.db.executescript(SCHEMA)
+        # Catalogs from before tiers lack the column
+        columns = [i[1] for i in self.db.execute(
+            "PRAGMA table_info(archives)"
+        )]
+        if "tier" not in columns:
+            with self.db:
+                self.db.execute("ALTER TABLE archives ADD COLUMN tier TEXT")
+
+    @classmethod
+    def load(cls, refresh=True):
+        """Open the local catalog, first replacing it with the copy in
+        Google Drive when that is newer. Without refresh Drive is only
+        used when there is no local catalog
+        A missing or unreadable Drive copy leaves the local one"""
+        file = path.join(ROOT_DIR, current_org().file(args.catalog))
+        if not refresh and path.exists(file):
+            return cls(file)
+        from googleapiclient.http import MediaIoBaseDownload
+        from .drive import drive_service, GoogleErrors
+        folder = drive_config()["folder"]
+        try:
+            service = drive_service()
+            response = service.files().list(
+                q=f"name = '{current_org().file(cls.NAME)}' \
+and '{folder}' in parents and trashed = false",
+                orderBy="createdTime desc",
+                fields="files(id, createdTime)",
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ).execute()
+            files = response.get("files", [])
+            if not files:
+                logging.info("No backup catalog found in Google Drive")
+                return cls(file)
+            created = datetime.fromisoformat(
+                files[0]["createdTime"].replace("Z", "+00:00")
+            ).timestamp()
+            if path.exists(file) and path.getmtime(file) >= created:
+                return cls(file, files[0]["id"])
+            with open(file + ".download", "wb") as download:
+                downloader = MediaIoBaseDownload(
+                    download,
+                    service.files().get_media(
+                        fileId=files[0]["id"], supportsAllDrives=True
+                    ),
+                    chunksize=CHUNK_SIZE
+                )
+                done = False
+                while not done:
+                    _, done = downloader.next_chunk()
+            replace(file + ".download", file)
+            return cls(file, files[0]["id"])
+        except (GoogleErrors.Error, OSError) as error:
+            logging.warning("Backup catalog could not be fetched")
+            logging.warning(error)
+            if path.exists(file + ".download"):
+                remove(file + ".download")
+            return cls(file)
+
+    def add_run(self, run_id, started, incremental):
+        """Note a run - a resumed run keeps its first start time"""
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO runs (run_id, started, incremental) \
+VALUES (?, ?, ?)",
+                (run_id, started, int(incremental))
+            )
+
+    def add_set(self, run_id, key, archive, digest, mig_url, records,
+                tier="full"):
+        """Note an uploaded archive set, the repos in it and the tier it
+        was exported with"""
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO archives VALUES \
+(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run_id, key, archive, digest.get("file_id"),
+                    digest.get("bytes"), digest.get("sha256"),
+                    digest.get("md5"), migration_id(mig_url), tier
+                )
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        i["full_name"], run_id, key, i.get("pushed_at"),
+                        i.get("updated_at")
+                    )
+                    for i in records
+                ]
+            )
+
+    def finish_run(self, run_id, finished):
+        with self.db:
+            self.db.execute(
+                "UPDATE runs SET finished = ? WHERE run_id = ?",
+                (finished, run_id)
+            )
+
+    def query(self, repo=None, since=None, until=None, archive=None,
+              latest=False):
+        """Archive sets holding repo (a name or glob), in runs from since
+        to until (dates, both included), in the archive named or with
+        the Drive file ID archive. Newest run first for each repo
+        With latest only each repo's newest match is returned"""
+        where = []
+        values = []
+        if repo is not None:
+            where.append(
+                "repos.repo GLOB ?" if "*" in repo else "repos.repo = ?"
+            )
+            values.append(repo)
+        if since is not None:
+            where.append("repos.run_id >= ?")
+            values.append(run_bound(since))
+        if until is not None:
+            where.append("repos.run_id < ?")
+            values.append(run_bound(until, after=True))
+        if latest:
+            # Found on the primary key, without reading older runs
+            where = [
+                "(repos.repo, repos.run_id) IN (SELECT repo, MAX(run_id) \
+FROM repos" + (" WHERE " + " AND ".join(where) if where else "")
+                + " GROUP BY repo)"
+            ]
+        if archive is not None:
+            where.append("(archives.archive = ? OR archives.file_id = ?)")
+            values += [archive, archive]
+        rows = self.db.execute(
+            "SELECT repos.run_id, runs.started, repos.repo, repos.set_key, \
+archives.archive, archives.file_id, archives.bytes, archives.sha256, \
+archives.md5, archives.migration_id, archives.tier FROM repos \
+JOIN archives USING (run_id, set_key) JOIN runs USING (run_id)"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY repos.repo, repos.run_id DESC",
+            values
+        )
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def save(self):
+        """Upload a new copy of the catalog and remove the old one
+        A fresh copy each run keeps it clear of retention cleanup"""
+        from .drive import drive_service, GoogleErrors, MediaIoBaseUpload
+        self.db.close()
+        try:
+            service = drive_service()
+            with open(self.file, "rb") as catalog_file:
+                response = service.files().create(
+                    body={
+                        "name": current_org().file(self.NAME),
+                        "parents": [drive_config()["folder"]]
+                    },
+                    media_body=MediaIoBaseUpload(
+                        catalog_file,
+                        mimetype="application/vnd.sqlite3",
+                        chunksize=CHUNK_SIZE,
+                        resumable=True
+                    ),
+                    supportsAllDrives=True,
+                    fields="id"
+                ).execute()
+            if self.file_id is not None:
+                service.files().delete(
+                    fileId=self.file_id, supportsAllDrives=True
+                ).execute()
+            self.file_id = response["id"]
+            # Newer than the copy just made, so the next load() of a
+            # process that stays running keeps the local catalog
+            utime(self.file)
+            logging.info("Backup catalog saved")
+        except (GoogleErrors.Error, OSError) as error:
+            logging.error("Backup catalog could not be saved")
+            logging.error(error)
+
+
+def record_run(repos, uploaded, incremental):
+    """Add the run's uploaded archive sets to the catalog and save it"""
+    from .transfers import archive_name
+    org = current_org()
+    catalog = Catalog.load()
+    try:
+        catalog.add_run(
+            org.rundate,
+            settings.today.isoformat(timespec="seconds"),
+            incremental
+        )
+        for key in uploaded:
+            catalog.add_set(
+                org.rundate,
+                key,
+                archive_name(key),
+                org.digests.get(archive_name(key), {}),
+                repos[key]['mig_url'],
+                repos[key]['records'],
+                repos[key]['tier']
+            )
+        catalog.finish_run(
+            org.rundate, datetime.now().isoformat(timespec="seconds")
+        )
+    except sqlite3.Error as error:
+        logging.error("Backup catalog could not be updated")
+        logging.error(error)
+        return
+    catalog_message = f"Backup catalog updated with {len(uploaded)} \
+archive sets"
+    logging.info(catalog_message)
+    catalog.save()
+
+
+def query_catalog():
+    """catalog query subcommand - print the matching archive sets
+    Returns 0 if anything matched, 1 otherwise"""
+    try:
+        catalog = Catalog.load(refresh=args.refresh)
+        started = monotonic()
+        with closing(catalog.db):
+            matches = catalog.query(
+                args.repo, args.since, args.until, args.archive, args.latest
+            )
+    except (sqlite3.Error, ValueError) as error:
+        logging.critical("catalog - Query failed")
+        logging.critical(error)
+        return 1
+    catalog_message = f"{len(matches)} matches in \
+{round((monotonic() - started) * 1000, 1)} ms"
+    logging.info(catalog_message)
+    for match in matches:
+        if args.json:
+            print(json.dumps(match))
+        else:
+            print("\t".join(
+                str(match[i]) for i in (
+                    "run_id", "repo", "archive", "file_id", "bytes",
+                    "sha256", "tier"
+                )
+            ))
+    return 0 if matches else 1
@@ -0,0 +1,399 @@
+"""Command line entry point - python -m git_backup [options]"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import cProfile
+import logging
+from time import sleep, monotonic
+import tracemalloc
+
+from . import logs, settings, state, STARTED
+from .catalog import record_run
+from .github import git_login, list_repos, show_plan, find_migrations
+from .github import start_archive, check_archive
+from .metrics import metrics, save_profile, write_report
+from .retention import remove_old_archives_and_logs
+from .settings import args, config, current_org, in_org, ROOT_DIR
+from .state import Journal, resume_run, Manifest, ExportModel
+from .state import ExportScheduler
+from .transfers import archive_name, pull_archive, upload_digests
+
+log = logging.getLogger(__name__)
+
+
+def collect_transfers(transfers, results):
+    """Record the outcome of finished download/upload workers
+    pull_archive() returns None once the set is in Google Drive
+    Returns the number of transfers that finished"""
+    finished = [f for f in transfers if f.done()]
+    for future in finished:
+        key = transfers.pop(future)
+        try:
+            outcome = future.result()
+        except Exception as error:
+            outcome = error
+        if outcome is None:
+            results["uploaded"].append(key)
+            state.journal().write("uploaded", key=key)
+        else:
+            collect_message = f'Archive set {key} transfer failed - {outcome}'
+            logging.error(collect_message)
+            results["failed"].append(key)
+            state.journal().write("failed", key=key, reason=str(outcome))
+    return len(finished)
+
+
+def transfer_status(check, transfers, results):
+    """Log one line summarising the state of every archive set
+    The counts are kept on the org for the serve progress endpoint"""
+    running = len([f for f in transfers if f.running()])
+    current_org().progress = {
+        "exporting": len(check),
+        "queued": len(transfers) - running,
+        "transferring": running,
+        "uploaded": len(results["uploaded"]),
+        "failed": len(results["failed"]),
+    }
+    status_message = f'Archive status - {len(check)} exporting, \
+{len(transfers) - running} queued, {running} transferring, \
+{len(results["uploaded"])} uploaded, {len(results["failed"])} failed'
+    logging.info(status_message)
+
+
+def backup(pool):
+    """Back up the current org
+    Check GitHub login is OK`
+    Gather list of repos
+    Start archive process
+    Wait for completion
+    Download archive and send to Google Drive, on the transfer threads
+    of pool
+    Returns the org's backup manifest, or None if the backup failed"""
+    journal = state.journal()
+    git_ok = git_login() == "Success"
+    # The Google client libraries are slow to import - loading them
+    # only now keeps them from delaying the first GitHub call
+    from .drive import google_login
+
+    if git_ok:
+        logging.info("Git login OK")
+        if google_login() == "Success":
+            logging.info("Google login OK")
+            try:
+                page = 1
+                manifest = Manifest.load()
+                if args.engine == "mirror":
+                    from .mirror import mirror_backup
+                    return mirror_backup(pool, manifest)
+                previous = journal.last_run() if args.resume else None
+                uploaded = []
+                if previous and not previous["finished"]:
+                    # The archive names of the run it picks up are reused
+                    current_org().rundate = previous["rundate"]
+                    incremental = previous["incremental"]
+                    repos, uploaded = resume_run(previous)
+                    journal.write("resumed")
+                else:
+                    if args.resume and previous:
+                        main_message = f'Last run {previous["rundate"]} \
+finished - Starting a new run'
+                        logging.info(main_message)
+                    elif args.resume:
+                        logging.info("No run in the journal - \
+Looking for exports to reuse")
+                    incremental = args.incremental
+                    # Both are calendar days - files older than the daily
+                    # retention only survive in the weekly/monthly tiers
+                    if incremental and args.full_every >= settings.retention:
+                        main_message = f'--full-every of {args.full_every} \
+days is not inside the {settings.retention} day retention period - \
+unchanged repos may have no archive left in Google Drive'
+                        logging.warning(main_message)
+                    if incremental and manifest.full_due(args.full_every):
+                        main_message = f'Last full backup was \
+{manifest.last_full} - Running a full backup'
+                        logging.info(main_message)
+                        incremental = False
+                    logging.info("Listing Repos")
+                    with metrics.timer("listing"):
+                        repos = list_repos(
+                            page, manifest if incremental else None
+                        )
+                    if args.dry_run:
+                        show_plan(repos)
+                        return None
+                    journal.start(current_org().rundate, incremental)
+                    for key, item in repos.items():
+                        journal.write(
+                            "set",
+                            key=key,
+                            records=item['records'],
+                            tier=item['tier']
+                        )
+                    # Exports found after a finished run would be that
+                    # run's own, and uploading them again backs up stale data
+                    if args.resume and not previous:
+                        for key, item in find_migrations(repos).items():
+                            repos[key]['mig_url'] = item
+                            journal.write("started", key=key, mig_url=item)
+                for key, item in repos.items():
+                    metrics.tiered(key, item['tier'])
+                logging.info("Starting Archive Process")
+                to_start = {
+                    key: item for key, item in repos.items()
+                    if not item['mig_url'] and key not in uploaded
+                }
+                resumed = [
+                    key for key, item in repos.items() if item['mig_url']
+                ]
+                for key, item in start_archive(to_start).items():
+                    repos[key]['mig_url'] = item
+                    if str(item).startswith("http"):
+                        journal.write("started", key=key, mig_url=item)
+                check = {}
+                for key, item in repos.items():
+                    if key in uploaded:
+                        continue
+                    main_message = f'Archive set {key} URL - {item["mig_url"]}'
+                    log.info(main_message)
+                    check[key] = {}
+                    check[key]['mig_url'] = item['mig_url']
+                transfers = {}
+                results = {"uploaded": uploaded, "failed": []}
+                for key in list(check):
+                    if not str(check[key]['mig_url']).startswith("http"):
+                        main_message = f'Archive set {key} could not be \
+started - Skipping'
+                        logging.error(main_message)
+                        results["failed"].append(key)
+                        journal.write(
+                            "failed",
+                            key=key,
+                            reason=str(check[key]['mig_url'] or "not started")
+                        )
+                        del check[key]
+                scheduler = ExportScheduler(
+                    ExportModel(ROOT_DIR + "/export_timings.json")
+                )
+                for key in check:
+                    scheduler.add(
+                        key,
+                        repos[key]['count'],
+                        repos[key]['size'],
+                        resumed=key in resumed
+                    )
+                log.info('Checking archive status...')
+                while check or transfers:
+                    due = scheduler.due()
+                    status = check_archive(
+                        {key: check[key] for key in due}
+                    )
+                    for key in due:
+                        value = status.get(key)
+                        if value == "exported":
+                            metrics.observe(
+                                "export_wait", scheduler.exported(key), key
+                            )
+                            journal.write("exported", key=key)
+                            main_message = f'Archive set {key} \
+is exported - queued for download'
+                            logging.info(main_message)
+                            future = pool.submit(
+                                in_org(pull_archive),
+                                key,
+                                repos[key]['mig_url']
+                            )
+                            transfers[future] = key
+                            del check[key]
+                        elif value == "failed" and \
+                                repos[key]['retry_count'] < 3:
+                            repos[key]['retry_count'] += 1
+                            main_message = f'Archive set \
+{key} failed - Attempting retry {repos[key]["retry_count"]}'
+                            logging.info(main_message)
+                            retry_repo = {}
+                            retry_repo[key] = repos[key]
+                            retry_url = start_archive(retry_repo).get(key)
+                            if str(retry_url).startswith("http"):
+                                journal.write(
+                                    "started", key=key, mig_url=retry_url
+                                )
+                            repos[key]['mig_url'] = retry_url
+                            check[key]['mig_url'] = retry_url
+                            main_message = f'Archive set {key} \
+URL is now - {retry_url}'
+                            logging.error(main_message)
+                            if str(retry_url).startswith("http"):
+                                scheduler.add(
+                                    key,
+                                    repos[key]['count'],
+                                    repos[key]['size']
+                                )
+                            else:
+                                results["failed"].append(key)
+                                journal.write(
+                                    "failed",
+                                    key=key,
+                                    reason=str(retry_url or "not started")
+                                )
+                                scheduler.remove(key)
+                                del check[key]
+                        elif value == "failed":
+                            main_message = f'Maximum retries for \
+set {key} reached - Try again later'
+                            logging.error(main_message)
+                            results["failed"].append(key)
+                            journal.write(
+                                "failed", key=key, reason="export failed"
+                            )
+                            scheduler.remove(key)
+                            del check[key]
+                        else:
+                            scheduler.checked(key)
+                    finished = collect_transfers(transfers, results)
+                    if due or finished:
+                        transfer_status(check, transfers, results)
+                    timeout = scheduler.next_in()
+                    if timeout is not None:
+                        main_message = f'Next status check in \
+{round(timeout)} seconds'
+                        logging.debug(main_message)
+                    if transfers:
+                        wait(
+                            transfers,
+                            timeout=timeout,
+                            return_when=FIRST_COMPLETED
+                        )
+                    elif timeout:
+                        sleep(timeout)
+                logging.info("Uploads complete")
+                metrics.add("sets_total", len(repos))
+                metrics.add("sets_uploaded", len(results["uploaded"]))
+                metrics.add("sets_failed", len(results["failed"]))
+                upload_digests()
+                for key in results["uploaded"]:
+                    manifest.record(repos[key]['records'], archive_name(key))
+                # A run of only some repos is not a full backup
+                if not incremental and not results["failed"] \
+                        and not args.only:
+                    manifest.last_full = current_org().rundate
+                manifest.save()
+                with metrics.timer("catalog"):
+                    record_run(repos, results["uploaded"], incremental)
+                journal.write("finished")
+                return manifest
+            except Exception as error:
+                logging.critical("Archive process failed")
+                logging.critical(error)
+        elif git_login() != "Success" and google_login() == "Success":
+            logging.critical("Git login failed - Aborting archive process")
+        else:
+            logging.critical("Google login failed")
+    else:
+        logging.critical("Git login Failed")
+    return None
+
+
+def backup_orgs(pool=None):
+    """Back up every org at the same time
+    Each org logs in, lists, exports and checks its archive sets on a
+    thread of its own. Their downloads and uploads share the --workers
+    transfer threads of pool, made for the run if not given, and the
+    --drive-uploads and --drive-mbps limits
+    Old files are then cleaned up and the log uploaded to every org's
+    folders
+    Returns each org's backup manifest, None where its backup failed"""
+    orgs = settings.orgs
+    if pool is None:
+        with ThreadPoolExecutor(
+            max_workers=args.workers,
+            thread_name_prefix="transfer"
+        ) as pool:
+            return backup_orgs(pool)
+    if len(orgs) == 1:
+        manifests = [in_org(backup, orgs[0])(pool)]
+    else:
+        with ThreadPoolExecutor(
+            max_workers=len(orgs),
+            thread_name_prefix="org"
+        ) as org_pool:
+            manifests = list(org_pool.map(
+                lambda org: in_org(backup, org)(pool), orgs
+            ))
+    if args.dry_run:
+        return manifests
+    from .drive import upload_logfile
+
+    # Orgs sharing folders are cleaned up together, and only once every
+    # one of them has its manifest to protect its archives with
+    groups = {}
+    for org, manifest in zip(orgs, manifests):
+        folders = tuple(
+            config.get(org.googledrive, i, fallback=None)
+            for i in ("folder", "logfolder")
+        )
+        groups.setdefault(folders, []).append((org, manifest))
+    for group in groups.values():
+        if any(manifest is None for _, manifest in group):
+            continue
+        logging.info("Cleaning up old archives and logs")
+        with metrics.timer("cleanup"):
+            in_org(remove_old_archives_and_logs, group[0][0])(
+                [manifest for _, manifest in group]
+            )
+
+    if args.level.upper() == "DEBUG":
+        logging.info("Logging was set to DEBUG - \
+Log will be uploaded with DEBUG messages removed")
+    else:
+        logging.info("Uploading logs to Google Drive")
+    for org in settings.logfolder_orgs():
+        in_org(upload_logfile, org)()
+    return manifests
+
+
+def run(pool=None):
+    """Back up every org, under cProfile and tracemalloc with --profile,
+    then write the run report
+    Returns each org's backup manifest, None where its backup failed"""
+    if args.profile:
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        try:
+            manifests = profiler.runcall(backup_orgs, pool)
+        finally:
+            save_profile(profiler)
+    else:
+        manifests = backup_orgs(pool)
+    write_report()
+    return manifests
+
+
+def main(argv=None):
+    """Run a backup, or the restore, catalog or serve subcommand, with
+    the given command line arguments
+    Returns the exit status"""
+    configfile = settings.configure(argv)
+    logging.info(logs.setup_logging())
+    log_message = f"logfile is {settings.LOGFILE}"
+    logging.info(log_message)
+    log_message = f"Config file being used - {configfile}"
+    logging.debug(log_message)
+    for org in settings.orgs:
+        if config.has_section(org.gitenv):
+            logs.listener.add_secret(config[org.gitenv].get("token"))
+    for section in args.sinks or []:
+        logs.listener.add_secret(config[section].get("secret_key"))
+    if args.command == "restore":
+        from .restore import restore
+        return restore()
+    if args.command == "catalog":
+        from .catalog import query_catalog
+        return query_catalog()
+    for org in settings.orgs:
+        org.journal = Journal(ROOT_DIR + "/" + org.file(args.journal))
+    if args.command == "serve":
+        from .serve import serve
+        return serve()
+    metrics.observe("startup", monotonic() - STARTED)
+    run()
+    return 0
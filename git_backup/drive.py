@@ -0,0 +1,619 @@
+"""Google Drive uploads
+The Google client libraries take most of a second to import, so this
+module is only imported once a run first needs Google Drive"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import io
+import json
+import logging
+from math import ceil
+from os import path
+import socket
+import threading
+from time import sleep, monotonic
+
+# Import Google Auth and Google Drive
+import httplib2
+from google.oauth2 import service_account
+from google.auth import exceptions as AuthErrors
+from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient import errors as GoogleErrors
+from googleapiclient.http import MediaFileUpload, MediaUpload, build_http
+from googleapiclient.http import MediaIoBaseUpload
+
+from . import logs, settings
+from .logs import Progress
+from .metrics import metrics
+from .settings import args, drive_config, in_org, ROOT_DIR
+from .settings import CHUNK_SIZE, UPLOAD_QUANTUM
+from .settings import MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, CHUNK_SECONDS
+from .settings import CHUNK_RTTS, MIN_PART_SIZE, MAX_STREAM_CHUNK_SIZE
+from .transfers import ArchiveDigest, ArchiveStream, pump_archive
+from .transfers import load_checkpoint, save_checkpoint, clear_checkpoint
+
+
+# Content type of a --recompress archive
+MIMETYPES = {"zstd": "application/zstd", "xz": "application/x-xz"}
+
+# Discovery documents are kept for each Drive endpoint orgs point at
+_drive = {"credentials": None, "documents": {}}
+_drive_lock = threading.Lock()
+# httplib2.Http is not thread-safe so every thread gets its own service
+_drive_local = threading.local()
+
+
+def drive_service():
+    """Return the Drive v3 service for the current thread and org
+    client_secret.json is read and the discovery document parsed once per
+    run - each thread only wraps them in its own authorised Http
+    The shared token is refreshed under a lock once it has expired"""
+    # Optional - point the client at another Drive endpoint,
+    # such as the local stand-in used by benchmark/bench.py
+    root = drive_config().get("api")
+    with _drive_lock:
+        if _drive["credentials"] is None:
+            # allow Google API to upload large files without timing out
+            socket.setdefaulttimeout(60 * 30)
+            service_account_info = ROOT_DIR + "/" + args.driveauth
+            scopes = ["https://www.googleapis.com/auth/drive"]
+            _drive["credentials"] = (
+                service_account.Credentials.from_service_account_file(
+                    service_account_info, scopes=scopes
+                )
+            )
+        document = _drive["documents"].get(root)
+        if document is None:
+            document = json.loads(get_static_doc("drive", "v3"))
+            if root:
+                document["rootUrl"] = root.rstrip("/") + "/"
+                document["baseUrl"] = document["rootUrl"] + \
+                    document["servicePath"]
+            _drive["documents"][root] = document
+        creds = _drive["credentials"]
+        if not creds.valid:
+            logging.debug("drive_service - Refreshing Google token")
+            creds.refresh(Request())
+
+    if getattr(_drive_local, "http", None) is None:
+        # build_http() stops httplib2 treating the 308 Drive sends
+        # for an unfinished resumable upload as a redirect
+        _drive_local.http = AuthorizedHttp(creds, http=build_http())
+        _drive_local.services = {}
+    service = _drive_local.services.get(root)
+    if service is None:
+        service = build_from_document(document, http=_drive_local.http)
+        _drive_local.services[root] = service
+    return service
+
+
+def drive_http():
+    """Authorised Http behind the current thread's Drive service
+    For raw requests the discovery API does not cover"""
+    drive_service()
+    return _drive_local.http
+
+
+def google_cloud_logging():
+    """Send INFO and above to GCP Cloud Logging as well
+    The Cloud Logging client library is only imported here, as it takes
+    longer to import than the Drive client"""
+    import google.cloud.logging
+
+    service_account_info = ROOT_DIR + "/" + args.driveauth
+    scopes = ["https://www.googleapis.com/auth/logging.write"]
+
+    creds = service_account.Credentials.from_service_account_file(
+        service_account_info, scopes=scopes
+    )
+
+    # Instantiates a GCP logging client
+    client = google.cloud.logging.Client(credentials=creds)
+
+    # Retrieves a Cloud Logging handler based on the environment
+    # you're running in. It is fed by the log listener thread, so
+    # Cloud Logging calls never hold up a transfer
+    handler = client.get_default_handler()
+    handler.setLevel(logging.INFO)
+    logs.listener.add_handler(handler)
+
+
+def google_login():
+    """Function to test Google Auth is working"""
+    try:
+        drive_service()
+
+        return "Success"
+    except FileNotFoundError as error:
+        logging.critical("google_login - Login failed")
+        logging.critical(error)
+    except AuthErrors.GoogleAuthError as error:
+        logging.critical("google_login - Login failed")
+        logging.critical(error)
+    except GoogleErrors.Error as error:
+        logging.critical("google_login - Login failed")
+        logging.critical(error)
+
+
+def verify_upload(file, uploaded, digest):
+    """Compare the MD5 Drive computed for an upload with our own
+    A copy that does not match is removed from Drive"""
+    expected = digest.md5.hexdigest()
+    if "md5Checksum" not in uploaded:
+        # Sessions opened before a restart may not have asked for it
+        try:
+            uploaded = drive_service().files().get(
+                fileId=uploaded["id"],
+                supportsAllDrives=True,
+                fields="id, md5Checksum"
+            ).execute()
+        except GoogleErrors.Error as error:
+            logging.error(error)
+    if uploaded.get("md5Checksum") == expected:
+        verify_message = f'{file} verified - MD5 {expected}'
+        logging.info(verify_message)
+        return True
+    metrics.count("errors", "drive checksum")
+    verify_message = f'{file} failed verification - Drive has MD5 \
+{uploaded.get("md5Checksum")} but {expected} was sent - Removing the upload'
+    logging.error(verify_message)
+    try:
+        drive_service().files().delete(
+            fileId=uploaded["id"], supportsAllDrives=True
+        ).execute()
+    except GoogleErrors.Error as error:
+        logging.error(error)
+    return False
+
+
+def upload_json(name, data, folder="folder", indent=2):
+    """Upload a JSON document to the archive folder, or the log folder
+    with folder="logfolder". indent=None keeps large documents compact
+    Returns the Drive file ID"""
+    return drive_service().files().create(
+        body={
+            "name": name,
+            "parents": [drive_config()[folder]]
+        },
+        media_body=MediaIoBaseUpload(
+            io.BytesIO(json.dumps(data, indent=indent).encode("utf-8")),
+            mimetype="application/json"
+        ),
+        supportsAllDrives=True,
+        fields="id"
+    ).execute()["id"]
+
+
+class ChunkTuner:
+    """Picks the size of each Drive upload chunk from the chunks sent so far
+    Fits seconds = rtt + bytes / rate to the last few chunks, then aims for
+    chunks of CHUNK_SECONDS that are also CHUNK_RTTS round trips long.
+    The size at most halves or doubles each chunk and stays a multiple
+    of 256KB, as Drive requires for every chunk but the last
+    largest caps the size - streamed chunks are held in memory"""
+
+    def __init__(self, size=CHUNK_SIZE, largest=MAX_CHUNK_SIZE):
+        self.size = min(size, largest)
+        self.largest = largest
+        self._samples = deque(maxlen=8)
+
+    def _fit(self):
+        """Returns the throughput in bytes per second and the RTT"""
+        count = len(self._samples)
+        mean_x = sum(x for x, _ in self._samples) / count
+        mean_y = sum(y for _, y in self._samples) / count
+        sxx = sum((x - mean_x) ** 2 for x, _ in self._samples)
+        if sxx:
+            slope = sum(
+                (x - mean_x) * (y - mean_y) for x, y in self._samples
+            ) / sxx
+            rtt = mean_y - slope * mean_x
+            if slope > 0 and rtt >= 0:
+                return 1 / slope, rtt
+        # Not enough spread in chunk sizes to separate the RTT out
+        return mean_x / mean_y, 0
+
+    def record(self, sent, seconds):
+        """Note a chunk of sent bytes that took seconds to commit"""
+        if sent <= 0 or seconds <= 0:
+            return
+        self._samples.append((sent, seconds))
+        rate, rtt = self._fit()
+        target = rate * max(CHUNK_SECONDS, CHUNK_RTTS * rtt)
+        target = min(max(target, self.size / 2), self.size * 2)
+        target = int(target) // UPLOAD_QUANTUM * UPLOAD_QUANTUM
+        self.size = min(max(target, MIN_CHUNK_SIZE), self.largest)
+        tuner_message = f'Upload at {round(rate / 1048576, 1)} MB/s, \
+RTT {round(rtt * 1000)} ms - Chunk size {self.size // 1048576} MB'
+        logging.debug(tuner_message)
+
+
+class Bandwidth:
+    """Upload rate cap shared by every upload
+    Each chunk is given the next free slot of time at rate bytes a
+    second and held back until it starts"""
+
+    def __init__(self, rate):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._next = monotonic()
+
+    def acquire(self, size):
+        with self._lock:
+            now = monotonic()
+            start = max(self._next, now)
+            self._next = start + size / self._rate
+        if start > now:
+            sleep(start - now)
+
+
+# --drive-mbps and --drive-uploads limits, made by the first upload
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+@contextmanager
+def upload_slot(size):
+    """Wait until the --drive-mbps cap allows size more bytes, then
+    hold one of the --drive-uploads slots while they are sent
+    Both are shared by the uploads of every org"""
+    with _limits_lock:
+        if not _limits:
+            _limits["bandwidth"] = Bandwidth(args.drive_mbps * 1048576) \
+                if args.drive_mbps else None
+            _limits["slots"] = threading.BoundedSemaphore(
+                args.drive_uploads
+            ) if args.drive_uploads else nullcontext()
+    if _limits["bandwidth"] is not None:
+        _limits["bandwidth"].acquire(size)
+    with _limits["slots"]:
+        yield
+
+
+class ArchiveMediaUpload(MediaUpload):
+    """Resumable Drive media upload of all or part of a local archive
+    The chunk size comes from a ChunkTuner and can change between chunks.
+    With a digest, the bytes read are hashed in order as they are sent"""
+
+    def __init__(self, file, start, length, tuner, digest=None):
+        self._file = file
+        self._start = start
+        self._length = length
+        self._tuner = tuner
+        self._digest = digest
+
+    def chunksize(self):
+        return self._tuner.size
+
+    def mimetype(self):
+        return MIMETYPES.get(args.recompress, "application/gzip")
+
+    def size(self):
+        return self._length
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        length = min(length, self._length - begin)
+        with open(self._file, "rb") as local_file:
+            local_file.seek(self._start + begin)
+            data = local_file.read(length)
+        digest = self._digest
+        if digest is not None:
+            if begin > digest.bytes:
+                # Resumed part way through - catch up from the file
+                digest.read(
+                    self._file,
+                    self._start + digest.bytes,
+                    begin - digest.bytes
+                )
+            if begin + len(data) > digest.bytes:
+                digest.update(data[digest.bytes - begin:])
+        return data
+
+    def has_stream(self):
+        return False
+
+
+def upload_session_status(uri, size):
+    """Ask Drive how much of a resumable upload it has committed
+    Returns ("active", offset), ("complete", file) or ("expired", None)
+    Drive keeps an unfinished upload session for about a week"""
+    response, content = drive_http().request(
+        uri,
+        method="PUT",
+        headers={"Content-Length": "0", "Content-Range": f"bytes */{size}"}
+    )
+    if response.status == 308:
+        if "range" in response:
+            return "active", int(response["range"].split("-")[1]) + 1
+        return "active", 0
+    if response.status in (200, 201):
+        return "complete", json.loads(content)
+    return "expired", None
+
+
+def upload_archive(file, name=None, start=0, length=None, digest=None):
+    """Upload to G-Drive in chunks sized by a ChunkTuner
+    Called inside pull_archive() function
+    client_secret.json pulled from Google developers console
+    Specific to service account
+    Folder in Google Drive needs to be shared with service account
+    name, start and length upload one part of the file instead of it all
+    The upload session URI and committed offset are checkpointed after
+    every chunk so a retry, or a restarted run, carries on from there
+    Returns the Drive file ID and md5Checksum"""
+
+    name = name or file
+    if length is None:
+        length = path.getsize(file) - start
+    try:
+        service = drive_service()
+
+        file_body = {
+            "name": name,
+            "parents": [drive_config()["folder"]]
+        }
+        upload_message = f'file body: {file_body}'
+        logging.debug(upload_message)
+
+        tuner = ChunkTuner()
+        media = ArchiveMediaUpload(file, start, length, tuner, digest)
+        size = media.size()
+
+        upload_data = service.files().create(
+            body=file_body,
+            media_body=media,
+            supportsAllDrives=True,
+            fields="id, md5Checksum"
+            )
+
+        checkpoint = load_checkpoint(name)
+        if checkpoint.get("uri") and checkpoint.get("size") == size:
+            state, value = upload_session_status(checkpoint["uri"], size)
+            if state == "complete":
+                upload_archive_message = f"Archive was already uploaded \
+as {name} - with ID: {value['id']}"
+                logging.info(upload_archive_message)
+                return value
+            if state == "active":
+                upload_data.resumable_uri = checkpoint["uri"]
+                upload_data.resumable_progress = value
+                upload_message = f'Resuming upload of {name} \
+at {round(value / size * 100)}%'
+                logging.info(upload_message)
+            else:
+                logging.info("Upload session expired - Starting again")
+
+        logging.info(
+            "upload archive - \
+Uploading archive to Google Drive"
+        )
+        response = None
+        logging.info('Beginning upload...')
+        progress = Progress(name, "upload", size)
+        while response is None:
+            offset = upload_data.resumable_progress
+            with upload_slot(min(tuner.size, size - offset)):
+                started = monotonic()
+                _, response = upload_data.next_chunk(num_retries=3)
+            sent = (size if response else upload_data.resumable_progress)
+            tuner.record(sent - offset, monotonic() - started)
+            metrics.add_bytes("uploaded", sent - offset)
+            save_checkpoint(
+                name,
+                uri=upload_data.resumable_uri,
+                offset=upload_data.resumable_progress,
+                size=size
+            )
+            progress.update(sent)
+        logging.info('Upload complete')
+        logging.debug(response)
+        upload_archive_message = f"Archive uploaded \
+as {name} - with ID: {response['id']}"
+        logging.info(upload_archive_message)
+        return response
+    except GoogleErrors.Error as error:
+        metrics.count("errors", "drive upload")
+        logging.error("upload_archive - \
+    An error occourred while uploading the archive")
+        logging.error(error)
+        raise
+
+
+def upload_part(file, name, start, length, archive_md5):
+    """Upload and verify one part of an archive for upload_parts()
+    A part verified by an earlier attempt is not sent again"""
+    checkpoint = load_checkpoint(name)
+    if checkpoint.get("archive") != archive_md5:
+        # Left by an upload of a different archive
+        clear_checkpoint(name)
+        save_checkpoint(name, archive=archive_md5)
+    elif checkpoint.get("done"):
+        return checkpoint["done"]
+    digest = ArchiveDigest()
+    uploaded = upload_archive(file, name, start, length, digest)
+    if digest.bytes < length:
+        # Nothing read this time - the part was committed by an earlier run
+        digest.read(file, start + digest.bytes, length - digest.bytes)
+    if not verify_upload(name, uploaded, digest):
+        save_checkpoint(name, uri=None)
+        return None
+    done = {
+        "name": name,
+        "file_id": uploaded["id"],
+        "offset": start,
+        "bytes": length,
+        "md5": digest.md5.hexdigest(),
+    }
+    save_checkpoint(name, done=done)
+    return done
+
+
+def upload_parts(file, digest):
+    """Upload a local archive as --parts parts in parallel
+    Each part is its own Drive file, named <archive>.partNNN. The parts
+    manifest <archive>.parts.json lists them in order with their MD5s
+    so they can be joined back together on restore
+    Returns the Drive ID of the manifest, or None if a part failed
+    verification"""
+    size = digest.bytes
+    part_size = ceil(size / args.parts / UPLOAD_QUANTUM) * UPLOAD_QUANTUM
+    part_size = max(part_size, MIN_PART_SIZE)
+    offsets = range(0, size, part_size)
+    names = [f"{file}.part{n:03d}" for n in range(1, len(offsets) + 1)]
+    lengths = [min(part_size, size - offset) for offset in offsets]
+    parts_message = f'Uploading {file} as {len(names)} parts \
+of {round(part_size / 1048576)} MB'
+    logging.info(parts_message)
+
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        parts = list(pool.map(
+            in_org(upload_part),
+            [file] * len(names),
+            names,
+            offsets,
+            lengths,
+            [digest.md5.hexdigest()] * len(names)
+        ))
+    if None in parts:
+        return None
+
+    manifest = dict(digest.result(), archive=file, parts=parts)
+    file_id = upload_json(file + ".parts.json", manifest)
+    for name in names:
+        clear_checkpoint(name)
+    parts_message = f'Parts manifest uploaded as {file}.parts.json \
+- with ID: {file_id}'
+    logging.info(parts_message)
+    return {"id": file_id}
+
+
+class StreamingMediaUpload(MediaUpload):
+    """Resumable Drive media upload fed from an ArchiveStream"""
+
+    def __init__(self, stream, mimetype, tuner):
+        self._stream = stream
+        self._mimetype = mimetype
+        self._tuner = tuner
+
+    def chunksize(self):
+        return self._tuner.size
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._stream.size(self._tuner.size)
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        return self._stream.getbytes(begin, length)
+
+    def has_stream(self):
+        return False
+
+
+def stream_archive(download, file, digest):
+    """Upload to G-Drive while the archive is still downloading
+    Called inside pull_archive() function when --stream is set
+    Nothing is written to local disk
+    Returns the Drive file ID and md5Checksum, or None if the
+    transfer failed"""
+
+    stream = ArchiveStream()
+    pump = threading.Thread(
+        target=in_org(pump_archive),
+        args=(download, stream, digest),
+        daemon=True
+    )
+    pump.start()
+
+    try:
+        service = drive_service()
+
+        file_body = {
+            "name": file,
+            "parents": [drive_config()["folder"]]
+        }
+        upload_message = f'file body: {file_body}'
+        logging.debug(upload_message)
+
+        tuner = ChunkTuner(largest=MAX_STREAM_CHUNK_SIZE)
+        media = StreamingMediaUpload(stream, "application/gzip", tuner)
+
+        upload_data = service.files().create(
+            body=file_body,
+            media_body=media,
+            supportsAllDrives=True,
+            fields="id, md5Checksum"
+            )
+
+        response = None
+        logging.info('Beginning streaming upload...')
+        # The archive size is only known once the download ends
+        progress = Progress(file, "upload")
+        while response is None:
+            offset = stream.tell()
+            with upload_slot(tuner.size):
+                started = monotonic()
+                _, response = upload_data.next_chunk(num_retries=3)
+            tuner.record(stream.tell() - offset, monotonic() - started)
+            metrics.add_bytes("uploaded", stream.tell() - offset)
+            progress.update(stream.tell())
+        logging.info('Upload complete')
+        logging.debug(response)
+        upload_archive_message = f"Archive uploaded \
+as {file} - with ID: {response['id']}"
+        logging.info(upload_archive_message)
+        return response
+    except (GoogleErrors.Error, httplib2.HttpLib2Error, IOError) as error:
+        metrics.count("errors", "drive stream upload")
+        logging.error("stream_archive - \
+An error occourred while streaming the archive")
+        logging.error(error)
+    finally:
+        # Lets the download thread exit if the upload gave up early
+        stream.abort()
+
+
+def upload_logfile():
+    """Upload log file to Google Drive"""
+    logs.listener.flush()
+    try:
+        service = drive_service()
+
+        # Have to split the name otherwise it uploads as
+        # "/git_backup/git_backup_YYYY-MM-DD.log"
+        log_name = settings.LOGFILE.split("/")[-1]
+
+        file_body = {
+            "name": log_name,
+            "parents": [drive_config()["logfolder"]]
+            }
+
+        media = MediaFileUpload(
+            settings.LOGFILE, mimetype="text/plain", resumable=True
+        )
+
+        upload_message = f"Log file name- {log_name}"
+        logging.debug(upload_message)
+
+        upload_log = service.files().create(
+            body=file_body, media_body=media, supportsAllDrives=True, fields="*"
+        )
+
+        with metrics.timer("log_upload"):
+            return upload_log.execute()["id"]
+    except GoogleErrors.Error as error:
+        logging.error("upload_archive - \
+An error occourred while uploading the archive")
+        logging.error(error)
+        raise
@@ -0,0 +1,704 @@
+"""GitHub API client, repo listing and organisation migrations"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+import heapq
+import json
+import logging
+from math import ceil
+import random
+import threading
+from time import sleep, time, monotonic
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+from . import settings
+from .metrics import metrics, endpoint_name
+from .settings import args, config, git_config, in_org, EXCLUDES, WEEKDAYS
+
+# Share of the rate limit kept back before calls to GitHub are paced
+PACE_RESERVE = 0.1
+
+
+class RateLimiter:
+    """Thread-safe token bucket for GitHub API calls
+    While plenty of the rate limit is left the bucket holds all of it
+    but a reserve, so calls go out unpaced. Once the calls left fall
+    to the reserve they are spread over what is left of the window,
+    following the X-RateLimit-* headers
+    limit caps the rate in calls per second, to leave some of a token's
+    budget to other users of it - calls are then always paced"""
+
+    def __init__(self, burst=10, rate=5000 / 3600, limit=None):
+        self._lock = threading.Lock()
+        self._burst = burst
+        self._capacity = burst
+        self._tokens = burst
+        self._paced = limit is not None
+        self._limit = limit or rate
+        self._rate = min(rate, self._limit)
+        self._updated = monotonic()
+        self._blocked_until = 0
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._updated) * self._rate
+                )
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = max(
+                    self._blocked_until - now,
+                    (1 - self._tokens) / self._rate
+                )
+            sleep(delay)
+
+    def update(self, response):
+        """Adjust the bucket from a GitHub response"""
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        limit = response.headers.get("X-RateLimit-Limit", "5000")
+        retry_after = response.headers.get("Retry-After")
+        with self._lock:
+            now = monotonic()
+            if remaining is not None and reset is not None:
+                window = max(int(reset) - time(), 1)
+                self._rate = min(
+                    max(int(remaining), 1) / window, self._limit
+                )
+                # A share of the calls the window has left at the
+                # limit's average rate, so it shrinks towards the reset
+                reserve = (
+                    int(limit) * PACE_RESERVE * min(window, 3600) / 3600
+                )
+                if not self._paced and int(remaining) > reserve + 1:
+                    self._capacity = int(remaining) - reserve
+                    self._tokens = self._capacity
+                else:
+                    self._capacity = self._burst
+                    self._tokens = min(
+                        self._tokens, self._capacity, int(remaining)
+                    )
+                if int(remaining) == 0:
+                    self._tokens = 0
+                    self._blocked_until = max(
+                        self._blocked_until, now + window
+                    )
+            if retry_after is not None and retry_after.isdigit():
+                self._blocked_until = max(
+                    self._blocked_until, now + int(retry_after)
+                )
+
+
+class GitHubClient:
+    """Shared GitHub API client
+    One pooled keep-alive session for every call, with exponential
+    backoff and jitter on connection errors, timeouts and 5xx responses
+    of idempotent calls
+    Safe to share between the transfer worker threads"""
+
+    RETRY_STATUSES = (500, 502, 503, 504)
+    IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+    def __init__(self, token, api_url, retries=5, backoff=2, pool_size=10,
+                 budget=None):
+        self.api_url = api_url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.limiter = RateLimiter(limit=budget and budget / 3600)
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Accept": "application/vnd.github.v3+json",
+            "Authorization": f"token {token}",
+        })
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _rate_limited(self, response):
+        """GitHub signals secondary rate limits with 403 or 429"""
+        return response.status_code in (403, 429) and (
+            "Retry-After" in response.headers
+            or response.headers.get("X-RateLimit-Remaining") == "0"
+        )
+
+    def _delay(self, attempt, response=None):
+        """Seconds to wait before the next attempt"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return int(retry_after)
+        return random.uniform(0, min(300, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        """Send a request, retrying transient failures
+        A failed POST may still have taken effect, so only rate limit
+        refusals are retried unless the caller says it is idempotent
+        The last response is returned once retries run out so callers
+        can still raise_for_status() as before"""
+        kwargs.setdefault("timeout", (10, 300))
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT
+        endpoint = "github " + endpoint_name(method, url)
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            metrics.count("requests", endpoint)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout
+            ) as error:
+                if attempt == self.retries or not idempotent:
+                    metrics.count("errors", endpoint)
+                    raise
+                retry_message = f'GitHub {method} {url} failed - {error}'
+                delay = self._delay(attempt)
+            else:
+                self.limiter.update(response)
+                if attempt == self.retries or not (
+                    idempotent
+                    and response.status_code in self.RETRY_STATUSES
+                    or self._rate_limited(response)
+                ):
+                    if response.status_code >= 400:
+                        metrics.count("errors", endpoint)
+                    return response
+                retry_message = f'GitHub {method} {url} returned \
+{response.status_code}'
+                delay = self._delay(attempt, response)
+                response.close()
+            metrics.count("retries", endpoint)
+            retry_message += f' - Retrying in {round(delay, 1)}s - \
+Attempt {attempt + 1} of {self.retries}'
+            logging.warning(retry_message)
+            sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+# One client for each token, so orgs sharing a token share its budget
+_github = {}
+_github_lock = threading.Lock()
+
+
+def github_client():
+    """Return the GitHub client of the current org's token
+    The optional budget key of the git section caps the calls an hour
+    made with the token"""
+    section = git_config()
+    key = (section["token"], section.get("api", "https://api.github.com"))
+    with _github_lock:
+        if key not in _github:
+            _github[key] = GitHubClient(
+                *key,
+                pool_size=args.workers * 2 + 2,
+                budget=section.getint("budget")
+            )
+        return _github[key]
+
+
+def git_login():
+    """Function to test Github login is working"""
+    token = git_config()["token"]
+    url = github_client().api_url + "/user"
+    login_log_message = f"git_login - GitHub token is {token}"
+    logging.debug(login_log_message)
+    login_log_message = f"git_login - Github URL is {url}"
+    logging.debug(login_log_message)
+    try:
+        response = github_client().get(url)
+        response.raise_for_status()
+        if response.status_code == requests.codes.ok:
+            return "Success"
+    except requests.exceptions.RequestException as error:
+        logging.critical("git_login - Login failed")
+        logging.critical(error)
+
+
+def repo_record(name, size, pushed_at, updated_at, archived):
+    """Structured record of one repo from either listing API
+    size is in KB"""
+    return {
+        "full_name": name,
+        "size": size or 0,
+        "pushed_at": pushed_at,
+        "updated_at": updated_at,
+        "archived": archived,
+    }
+
+
+def fetch_repo_page(page):
+    """Fetch one page of the org's repos from the REST API"""
+    url = git_config()["url"] + "repos"
+    params = (
+        ("per_page", "100"),
+        ("page", page)
+    )
+    response = github_client().get(url, params=params)
+    response.raise_for_status()
+    return response
+
+
+def list_repos_rest(page):
+    """List repos with the REST API
+    The Link header of the first page gives the last page number
+    so the remaining pages are fetched concurrently, on no more
+    threads than the client has pooled connections"""
+    responses = [fetch_repo_page(page)]
+    last = responses[0].links.get("last", {}).get("url")
+    last_page = last and int(parse_qs(urlparse(last).query)["page"][0])
+    if last_page and last_page > page:
+        list_message = f"Fetching repo pages {page + 1} to {last_page}"
+        logging.info(list_message)
+        with ThreadPoolExecutor(
+            max_workers=min(8, last_page - page, github_client().pool_size),
+            thread_name_prefix="list"
+        ) as pool:
+            responses += pool.map(
+                in_org(fetch_repo_page), range(page + 1, last_page + 1)
+            )
+    found = []
+    for response in responses:
+        for i in response.json():
+            found.append(repo_record(
+                i["full_name"],
+                i.get("size"),
+                i.get("pushed_at"),
+                i.get("updated_at"),
+                i.get("archived", False)
+            ))
+    return found
+
+
+GRAPHQL_REPOS = """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { nameWithOwner diskUsage pushedAt updatedAt isArchived }
+    }
+  }
+}
+"""
+
+
+def list_repos_graphql():
+    """List repos with the GraphQL API
+    Returns only the fields the backup needs, 100 repos per query"""
+    org = git_config().get(
+        "org", git_config()["url"].rstrip("/").split("/")[-1]
+    )
+    url = github_client().api_url + "/graphql"
+    found = []
+    cursor = None
+    while True:
+        # A query changes nothing so it is safe to retry
+        response = github_client().post(url, idempotent=True, json={
+            "query": GRAPHQL_REPOS,
+            "variables": {"org": org, "cursor": cursor},
+        })
+        response.raise_for_status()
+        r_json = response.json()
+        if r_json.get("errors"):
+            raise requests.exceptions.RequestException(
+                f"GraphQL errors - {r_json['errors']}"
+            )
+        repositories = r_json["data"]["organization"]["repositories"]
+        for i in repositories["nodes"]:
+            found.append(repo_record(
+                i["nameWithOwner"],
+                i["diskUsage"],
+                i["pushedAt"],
+                i["updatedAt"],
+                i["isArchived"]
+            ))
+        if not repositories["pageInfo"]["hasNextPage"]:
+            return found
+        cursor = repositories["pageInfo"]["endCursor"]
+
+
+def find_repos(page, manifest=None):
+    """Records of the repos under the named Org
+    With --only just the repos matching it are kept. When a manifest is
+    given only repos changed since their last backup are kept"""
+    if args.graphql:
+        found = list_repos_graphql()
+    else:
+        found = list_repos_rest(page)
+    for i in found:
+        list_log_message = f"list_repos - \
+Found {i['full_name']} - Adding to repos list"
+        logging.info(list_log_message)
+    logging.info("No more repos found")
+    list_message = f"Total repos found : {len(found)}"
+    logging.info(list_message)
+    if args.only:
+        found = [
+            i for i in found
+            if any(fnmatchcase(i["full_name"], j) for j in args.only)
+        ]
+        list_message = f"Repos matching --only : {len(found)}"
+        logging.info(list_message)
+    if manifest is not None:
+        found = manifest.changed(found)
+        list_message = f"Repos changed since their last backup : \
+{len(found)}"
+        logging.info(list_message)
+    return found
+
+
+def list_repos(page, manifest=None):
+    """Create list of repos under the named Org, split into archive sets
+    See find_repos() for the repos kept"""
+    try:
+        repos = tiered_sets(find_repos(page, manifest))
+        list_message = f'This will create {len(repos)} archive files'
+        logging.info(list_message)
+        return repos
+    except requests.exceptions.RequestException as error:
+        logging.error("An error occoured")
+        logging.error(error)
+
+
+def repo_tier(name):
+    """The first --tier covering the repo today, or "full" for none
+    A tier covers the repos matching one of its comma separated repos
+    globs, on the weekdays in its days when it has them"""
+    weekday = WEEKDAYS[settings.today.weekday()]
+    for section in args.tiers or []:
+        tier = config[section]
+        days = settings.split_list(tier.get("days", "").lower())
+        if days and weekday not in days:
+            continue
+        patterns = settings.split_list(tier.get("repos", "*"))
+        if any(fnmatchcase(name, i) for i in patterns):
+            return section
+    return "full"
+
+
+def tier_options(tier):
+    """Migration API exclude options of a tier, none for the full tier"""
+    if tier == "full":
+        return {}
+    return {
+        i: config.getboolean(tier, i, fallback=False) for i in EXCLUDES
+    }
+
+
+def tiered_sets(records):
+    """Archive sets of the repo records, each set holding repos of one
+    tier. Sets are numbered from 1, largest first"""
+    tiers = {}
+    for i in records:
+        tiers.setdefault(repo_tier(i["full_name"]), []).append(i)
+    if args.tiers:
+        for tier, members in tiers.items():
+            list_message = f"Tier {tier} : {len(members)} repos"
+            logging.info(list_message)
+    sets = [
+        new_set(item["records"], tier)
+        for tier, members in tiers.items()
+        for item in make_sets(members).values()
+    ]
+    sets.sort(key=lambda item: item["size"], reverse=True)
+    return {key: item for key, item in enumerate(sets, start=1)}
+
+
+def make_sets(records, budget=None, max_repos=None):
+    """Split repo records into archive sets of roughly equal size
+    Largest repos are placed first, each into the smallest set with room
+    A set only goes over the byte budget (GB) when one repo is bigger
+    than the budget on its own
+    Sets are numbered from 1, largest first"""
+    budget = (budget or args.set_size) * 1024 * 1024
+    max_repos = max_repos or args.set_repos
+    total = sum(i["size"] for i in records)
+    count = max(
+        ceil(total / budget),
+        ceil(len(records) / max_repos)
+    )
+    # (size KB, repo count, set index) of each set being filled
+    sets = [(0, 0, n) for n in range(count)]
+    members = [[] for n in range(count)]
+    for i in sorted(records, key=lambda i: i["size"], reverse=True):
+        if sets and (sets[0][0] == 0 or sets[0][0] + i["size"] <= budget):
+            size, repo_count, n = heapq.heappop(sets)
+        else:
+            # Not even the smallest set has room - start another
+            size, repo_count, n = 0, 0, len(members)
+            members.append([])
+        members[n].append(i)
+        if repo_count + 1 < max_repos:
+            heapq.heappush(sets, (size + i["size"], repo_count + 1, n))
+    # A few huge repos can leave some of the starting sets empty
+    members = [chunk for chunk in members if chunk]
+    members.sort(key=lambda chunk: sum(i["size"] for i in chunk),
+                 reverse=True)
+
+    return {
+        key: new_set(chunk) for key, chunk in enumerate(members, start=1)
+    }
+
+
+def new_set(records, tier="full"):
+    """Archive set holding the given repo records, exported with the
+    options of tier"""
+    return {
+        "records": records,
+        "tier": tier,
+        "retry_count": 0,
+        "mig_url": "",
+        # Repo count and size (KB) are used to estimate export time
+        "count": len(records),
+        "size": sum(i["size"] for i in records),
+    }
+
+
+def show_plan(repos):
+    """Print the planned archive sets for --dry-run"""
+    total = 0
+    for key, item in repos.items():
+        total += item["size"]
+        print(f'Set {key}: {item["count"]} repos, \
+{round(item["size"] / 1048576, 2)} GB estimated, tier {item["tier"]}')
+        for i in item["records"]:
+            print(f'    {i["full_name"]} ({round(i["size"] / 1024, 1)} MB)')
+    print(f'{len(repos)} sets, {round(total / 1048576, 2)} GB estimated')
+
+
+def find_migrations(repos, since=None):
+    """Match archive sets to recent org migrations of the same repos
+    Used by --resume when the journal has nothing to go on, and by
+    start_archive after a failed request
+    Only migrations created after since count - GitHub deletes
+    exported archives after seven days
+    Every page of the org's migrations is read, following the Link
+    header"""
+    url = git_config()["url"] + "migrations"
+    params = (("per_page", "100"),)
+    cutoff = since or datetime.now(timezone.utc) - timedelta(days=6)
+    found = {}
+    try:
+        migrations = {}
+        while url:
+            response = github_client().get(url, params=params)
+            response.raise_for_status()
+            for i in response.json():
+                created = datetime.fromisoformat(
+                    i["created_at"].replace("Z", "+00:00")
+                )
+                if i["state"] == "failed" or created < cutoff:
+                    continue
+                # Exports of the same repos with other options do not match
+                names = frozenset(
+                    repo["full_name"] for repo in i.get("repositories", [])
+                ) | {option for option in EXCLUDES if i.get(option)}
+                known = migrations.get(names)
+                if known is None or created > known[0]:
+                    migrations[names] = (created, i["url"])
+            # The next page's URL carries the query already
+            url = response.links.get("next", {}).get("url")
+            params = None
+        for key, item in repos.items():
+            options = tier_options(item["tier"])
+            match = migrations.get(
+                frozenset(repo["full_name"] for repo in item["records"])
+                | {option for option in options if options[option]}
+            )
+            if match:
+                found[key] = match[1]
+                resume_message = f'Archive set {key} - \
+Reusing migration {match[1]}'
+                logging.info(resume_message)
+    except requests.exceptions.RequestException as error:
+        logging.error("Could not list existing migrations")
+        logging.error(error)
+    return found
+
+
+def post_migration(key, item, url, payload):
+    """Start the migration of one archive set
+    A 5xx or a dropped connection can come after GitHub started the
+    export, so the set's migrations are looked up before trying again
+    rather than starting a duplicate
+    Returns the response, or the URL of the migration found"""
+    client = github_client()
+    # Leaves some room for the clocks of GitHub and this host to differ
+    since = datetime.now(timezone.utc) - timedelta(seconds=60)
+    for attempt in range(client.retries + 1):
+        try:
+            response = client.post(url, data=payload)
+            if response.status_code not in client.RETRY_STATUSES:
+                return response
+            failure = f'returned {response.status_code}'
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout
+        ) as error:
+            if attempt == client.retries:
+                raise
+            failure = f'failed - {error}'
+        if attempt == client.retries:
+            return response
+        found = find_migrations({key: item}, since=since)
+        if key in found:
+            return found[key]
+        delay = client._delay(attempt)
+        retry_message = f'start_archive - Archive set {key} {failure} - \
+No migration was started - Retrying in {round(delay, 1)}s - \
+Attempt {attempt + 1} of {client.retries}'
+        logging.warning(retry_message)
+        sleep(delay)
+
+
+def start_archive(repos):
+    """Function to start a new archive process"""
+    all_arc_url = {}
+    for i in list(repos.keys()):
+        start_archive_message = f'Attempting to archive repo set {i}'
+        logging.info(start_archive_message)
+        url = git_config()["url"] + "migrations"
+        payload = json.dumps({
+            "lock_repositories": False,
+            "repositories": [
+                repo["full_name"] for repo in repos[i]['records']
+            ],
+            **tier_options(repos[i]['tier']),
+        })
+
+        try:
+            response = post_migration(i, repos[i], url, payload)
+            if isinstance(response, str):
+                all_arc_url[i] = response
+                continue
+            if response.status_code == 404:
+                logging.warning(
+                    "start_archive - \
+returned 404 - Not Found"
+                )
+                all_arc_url[i] = "404"
+                continue
+            if response.status_code == 422:
+                logging.warning(
+                    "start_archive - \
+returned 422 - Validation Failed"
+                )
+                all_arc_url[i] = "422"
+                continue
+            response.raise_for_status()
+            if response.status_code == 201:
+                logging.info(
+                    "start_archive - \
+returned 201 - Created"
+                )
+                all_arc_url[i] = response.json()["url"]
+        except requests.exceptions.RequestException as error:
+            logging.error("An error occoured")
+            logging.error(error)
+    return all_arc_url
+
+
+def check_set(key, mig_url):
+    """Return the migration state of one archive set
+    Called for several sets at once by check_archive()"""
+    try:
+        response = github_client().get(mig_url)
+        response.raise_for_status()
+        arc_state = response.json()["state"]
+        check_archive_message = f'check_archive - \
+Archive set {key} status : {arc_state}'
+        logging.debug(check_archive_message)
+        if arc_state == "exported":
+            check_archive_message = f'Archive set \
+{key} is ready for download'
+            logging.info(check_archive_message)
+        return arc_state
+    except requests.exceptions.RequestException as error:
+        logging.error("An error occoured")
+        logging.error(error)
+    except (ValueError, KeyError) as error:
+        check_archive_message = f'check_archive - \
+Unexpected response for archive set {key} - {error}'
+        logging.error(check_archive_message)
+
+
+def check_archive(url):
+    """Check archive status
+    Cannot be downloaded unless status is "Exported"
+    Sets are checked concurrently - sets that could not be checked
+    are left out of the result"""
+
+    all_arc_state = {}
+    if not url:
+        return all_arc_state
+    with ThreadPoolExecutor(
+        max_workers=min(8, len(url)),
+        thread_name_prefix="check"
+    ) as pool:
+        states = pool.map(
+            in_org(check_set),
+            url.keys(),
+            [i['mig_url'] for i in url.values()]
+        )
+        for i, arc_state in zip(url.keys(), states):
+            if arc_state is not None:
+                all_arc_state[i] = arc_state
+
+    return all_arc_state
+
+
+def unlock_repo(url, repos):
+    """Unlock repos after archive is pulled
+    No longer used - Kept for reference"""
+    lock_url = url + "/repos/"
+
+    for i in repos:
+        name = i.split("/")
+        full_url = lock_url + name[1] + "/lock"
+        try:
+            response = github_client().delete(full_url)
+            response.raise_for_status()
+            if response.status_code == 204:
+                unlock_log_message = f"Lock for {i} removed"
+                logging.info(unlock_log_message)
+        except requests.exceptions.RequestException as error:
+            unlock_log_message = f"Unlock returned unexpected\
+                HTTP code {response.status_code}"
+            logging.error(unlock_log_message)
+            logging.error(error)
+
+
+def delete_archive(url):
+    """To remove archive after use
+    Not tested or used at present"""
+
+    arc_url = url + "/archive"
+
+    try:
+        response = github_client().delete(arc_url)
+        response.raise_for_status()
+        if response.status_code == requests.codes.ok:
+            return response.status_code
+    except requests.exceptions.RequestException as error:
+        logging.error("An error occoured")
+        logging.error(error)
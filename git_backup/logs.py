@@ -0,0 +1,160 @@
+"""Logging for a run
+Records are put on a queue and written to the console, the logfile
+and Cloud Logging by a listener thread, with known secrets masked"""
+
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import re
+import threading
+from time import monotonic
+
+from . import settings
+from .settings import args, PROGRESS_SECONDS, PROGRESS_PERCENT
+
+# Set by setup_logging()
+listener = None
+
+
+class RedactingListener(QueueListener):
+    """Writes queued log records to the real handlers on its own thread
+    Secrets are masked here, so callers only pay for putting a record
+    on the queue however slow the terminal, file or Cloud Logging are"""
+
+    PATTERNS = re.compile(
+        r"(gh[pousr]_[A-Za-z0-9]{20,}"
+        r"|(?<=token )[A-Za-z0-9_.\-]{20,}"
+        r"|(?<=Bearer )[A-Za-z0-9_.\-]{20,})"
+    )
+
+    def __init__(self, log_queue, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.secrets = set()
+        self._lock = threading.Lock()
+
+    def add_secret(self, secret):
+        if secret:
+            self.secrets.add(secret)
+
+    def add_handler(self, handler):
+        """Send records to another handler from now on"""
+        with self._lock:
+            self.handlers = self.handlers + (handler,)
+
+    def redact(self, message):
+        for secret in self.secrets:
+            message = message.replace(secret, "[REDACTED]")
+        return self.PATTERNS.sub("[REDACTED]", message)
+
+    def prepare(self, record):
+        record.msg = self.redact(record.getMessage())
+        record.args = None
+        return record
+
+    def flush(self):
+        """Wait for every queued record to be written"""
+        with self._lock:
+            self.stop()
+            self.start()
+
+
+class OrgFilter(logging.Filter):
+    """Starts each message with the org it is about when a run backs up
+    several. Runs on the thread that logs, where the org is known"""
+
+    def filter(self, record):
+        org = settings.working_org.get(None)
+        if org is not None and len(settings.orgs) > 1:
+            record.msg = f"[{org.name}] {record.getMessage()}"
+            record.args = None
+        return True
+
+
+def setup_logging():
+    """Send the log to the console and the run's logfile
+    Returns the message saying which level is set"""
+    global listener
+    # Logging defaults
+    if args.level.upper() == "DEBUG":
+        log_level = logging.DEBUG
+        message = "Logging set to DEBUG - Known secrets are redacted"
+    elif args.level.upper() == "INFO":
+        log_level = logging.INFO
+        message = "Logging set to INFO - Processes will be explained"
+    else:
+        log_level = logging.WARN
+        message = "Logging set to WARN - Only warnings and errors will be \
+logged"
+
+    fileformat = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+
+    console = logging.StreamHandler()
+    console.setLevel(log_level)
+    console.setFormatter(fileformat)
+
+    filelogger = logging.FileHandler(settings.LOGFILE, encoding="utf-8")
+    if args.level.upper() == "DEBUG":
+        filelogger.setLevel(logging.INFO)
+    else:
+        filelogger.setLevel(log_level)
+    filelogger.setFormatter(fileformat)
+
+    root = logging.getLogger('')
+    # main() may run more than once in a process, such as under tests,
+    # and serve starts a new logfile for every run
+    secrets = set()
+    if listener is not None:
+        atexit.unregister(listener.stop)
+        listener.stop()
+        secrets = listener.secrets
+        for handler in listener.handlers:
+            handler.close()
+        for handler in root.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                root.removeHandler(handler)
+
+    # An unbounded queue, so logging never blocks the thread that logs
+    log_queue = queue.SimpleQueue()
+    listener = RedactingListener(log_queue, console, filelogger)
+    listener.secrets |= secrets
+    listener.start()
+    atexit.register(listener.stop)
+
+    root.setLevel(log_level)
+    handler = QueueHandler(log_queue)
+    handler.addFilter(OrgFilter())
+    root.addHandler(handler)
+    return message
+
+
+class Progress:
+    """Rate-limited progress messages for one transfer
+    Logs once PROGRESS_PERCENT more of the transfer is done or
+    PROGRESS_SECONDS have passed, whichever is first, and at the end"""
+
+    def __init__(self, name, action, total=None):
+        self.name = name
+        self.action = action
+        self.total = total
+        self._logged_at = monotonic()
+        self._logged_percent = 0
+
+    def update(self, done):
+        now = monotonic()
+        percent = done / self.total * 100 if self.total else None
+        finished = self.total is not None and done >= self.total
+        if not finished \
+                and now - self._logged_at < PROGRESS_SECONDS \
+                and (percent is None
+                     or percent - self._logged_percent < PROGRESS_PERCENT):
+            return
+        self._logged_at = now
+        if percent is None:
+            progress_message = f'{self.name} {self.action} : \
+{round(done / 1048576)} MB'
+        else:
+            self._logged_percent = percent
+            progress_message = f'{self.name} {self.action} : \
+{round(percent)}%'
+        logging.info(progress_message)
@@ -0,0 +1,321 @@
+"""Run metrics, the JSON run report and Prometheus output"""
+
+from contextlib import contextmanager
+import io
+import json
+import logging
+from os import replace
+import pstats
+import re
+import threading
+from time import time, monotonic
+import tracemalloc
+from urllib.parse import urlparse
+
+import requests
+
+from . import settings
+from .settings import args, in_org, ROOT_DIR
+
+
+class Metrics:
+    """Timers, byte counters and retry/error counters for one run
+    Updated from every thread. Written out at the end of the run as a
+    JSON report and, optionally, as Prometheus text"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start again for a new run"""
+        with self._lock:
+            self.started = monotonic()
+            # Phase name to count, summed seconds and longest single timing
+            self.phases = {}
+            # Seconds of each phase for every archive set
+            self.sets = {}
+            # Uploads to Google Drive, sinks counted apart
+            self.bytes = {"downloaded": 0, "uploaded": 0, "sinks": 0}
+            # Counter name to {endpoint: count}
+            self.counters = {"requests": {}, "retries": {}, "errors": {}}
+            self.values = {}
+            # --recompress sizes and CPU seconds of every archive set
+            self.recompress = {}
+            # --tier each archive set was exported with
+            self.tiers = {}
+
+    @contextmanager
+    def timer(self, phase, key=None):
+        """Time a block of code as one run of phase"""
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(phase, monotonic() - started, key)
+
+    def observe(self, phase, seconds, key=None):
+        with self._lock:
+            item = self.phases.setdefault(
+                phase, {"count": 0, "seconds": 0, "max_seconds": 0}
+            )
+            item["count"] += 1
+            item["seconds"] += seconds
+            item["max_seconds"] = max(item["max_seconds"], seconds)
+            if key is not None:
+                timings = self.sets.setdefault(
+                    settings.current_org().label(key), {}
+                )
+                timings[phase] = timings.get(phase, 0) + seconds
+
+    def add_bytes(self, direction, size):
+        with self._lock:
+            self.bytes[direction] += size
+
+    def count(self, name, endpoint):
+        with self._lock:
+            counter = self.counters[name]
+            counter[endpoint] = counter.get(endpoint, 0) + 1
+
+    def recompressed(self, key, result):
+        with self._lock:
+            self.recompress[settings.current_org().label(key)] = result
+
+    def tiered(self, key, tier):
+        with self._lock:
+            self.tiers[settings.current_org().label(key)] = tier
+
+    def set(self, name, value):
+        """Record a single value for the report"""
+        with self._lock:
+            self.values[name] = value
+
+    def add(self, name, value):
+        """Add to a value for the report, such as set totals summed over
+        every org"""
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def report(self):
+        with self._lock:
+            wall = monotonic() - self.started
+            throughput = {
+                "run_bytes_per_second": round(
+                    (self.bytes["downloaded"] + self.bytes["uploaded"])
+                    / max(wall, 1e-9)
+                ),
+            }
+            # Average rate of one transfer - phases overlap across workers
+            for direction, phase in (
+                ("downloaded", "download"),
+                ("uploaded", "upload")
+            ):
+                seconds = sum(
+                    self.phases.get(i, {}).get("seconds", 0)
+                    for i in (phase, "stream")
+                )
+                if seconds:
+                    throughput[f"{phase}_bytes_per_second"] = round(
+                        self.bytes[direction] / seconds
+                    )
+            recompress = {}
+            if self.recompress:
+                totals = {
+                    k: sum(i[k] for i in self.recompress.values())
+                    for k in ("gzip_bytes", "tar_bytes", "bytes")
+                }
+                recompress["recompress"] = dict(
+                    totals,
+                    ratio=self._ratio(totals),
+                    cpu_seconds=round(sum(
+                        i["cpu_seconds"] for i in self.recompress.values()
+                    ), 3),
+                    sets={
+                        key: dict(
+                            item,
+                            ratio=self._ratio(item),
+                            cpu_seconds=round(item["cpu_seconds"], 3)
+                        )
+                        for key, item in self.recompress.items()
+                    },
+                )
+            return {
+                "rundate": settings.rundate,
+                "wall_seconds": round(wall, 3),
+                "phases": {
+                    phase: {k: round(v, 3) for k, v in item.items()}
+                    for phase, item in self.phases.items()
+                },
+                "sets": {
+                    key: {k: round(v, 3) for k, v in item.items()}
+                    for key, item in self.sets.items()
+                },
+                "bytes": dict(self.bytes),
+                "throughput": throughput,
+                "counters": {
+                    name: dict(counter)
+                    for name, counter in self.counters.items()
+                },
+                **recompress,
+                "tiers": dict(self.tiers),
+                **self.values,
+            }
+
+    @staticmethod
+    def _ratio(item):
+        """How many times smaller --recompress made the gzip archive"""
+        return round(item["gzip_bytes"] / max(item["bytes"], 1), 3)
+
+    @staticmethod
+    def _label(value):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        return value.replace("\n", "\\n")
+
+    def prometheus(self, report):
+        """Prometheus text exposition of a report()"""
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP git_backup_{name} {help_text}")
+            lines.append(f"# TYPE git_backup_{name} gauge")
+            for labels, value in samples:
+                label = ",".join(
+                    f'{k}="{self._label(v)}"' for k, v in labels.items()
+                )
+                label = "{" + label + "}" if label else ""
+                lines.append(f"git_backup_{name}{label} {value}")
+
+        metric("run_seconds", "Wall time of the run",
+               [({}, report["wall_seconds"])])
+        metric("last_run_timestamp_seconds", "When the run finished",
+               [({}, round(time()))])
+        metric("phase_seconds", "Seconds spent in each phase, summed \
+over archive sets",
+               [({"phase": k}, v["seconds"])
+                for k, v in report["phases"].items()])
+        metric("phase_max_seconds", "Longest single timing of each phase",
+               [({"phase": k}, v["max_seconds"])
+                for k, v in report["phases"].items()])
+        metric("phase_count", "Number of timings of each phase",
+               [({"phase": k}, v["count"])
+                for k, v in report["phases"].items()])
+        metric("bytes", "Archive bytes transferred",
+               [({"direction": k}, v) for k, v in report["bytes"].items()])
+        metric("bytes_per_second", "Archive throughput",
+               [({"measure": k}, v)
+                for k, v in report["throughput"].items()])
+        for name, counter in report["counters"].items():
+            metric(name, f"GitHub and Drive {name} by endpoint",
+                   [({"endpoint": k}, v) for k, v in counter.items()])
+        if "recompress" in report:
+            recompress = report["recompress"]
+            metric("recompress_ratio", "Size of the gzip archives over \
+their size after --recompress",
+                   [({}, recompress["ratio"])])
+            metric("recompress_cpu_seconds", "CPU seconds spent on \
+--recompress",
+                   [({}, recompress["cpu_seconds"])])
+            metric("recompress_bytes", "Archive bytes before and after \
+--recompress",
+                   [({"format": k}, recompress[f"{k}_bytes"])
+                    for k in ("gzip", "tar")]
+                   + [({"format": "recompressed"}, recompress["bytes"])])
+        tiers = {}
+        for tier in report["tiers"].values():
+            tiers[tier] = tiers.get(tier, 0) + 1
+        metric("sets_by_tier", "Archive sets exported with each --tier",
+               [({"tier": k}, v) for k, v in tiers.items()])
+        for name in ("sets_total", "sets_uploaded", "sets_failed"):
+            if name in report:
+                metric(name, f"Archive {name.replace('_', ' ')}",
+                       [({}, report[name])])
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def endpoint_name(method, url):
+    """Metric label for a request - ids in the path are replaced
+    so every call to the same endpoint is counted together"""
+    parsed = urlparse(url)
+    endpoint = re.sub(r"/\d+(?=/|$)", "/{id}", parsed.path.rstrip("/"))
+    return f"{method} {endpoint}"
+
+
+def save_profile(profiler):
+    """Save the --profile results and log the top entries"""
+    profile_file = f"{ROOT_DIR}/git_backup_{settings.rundate}.prof"
+    profiler.dump_stats(profile_file)
+    top = io.StringIO()
+    pstats.Stats(profiler, stream=top).sort_stats("cumulative") \
+        .print_stats(20)
+    logging.info("Profile - top 20 by cumulative time")
+    logging.info(top.getvalue())
+    _, peak = tracemalloc.get_traced_memory()
+    logging.info("Profile - top 10 memory allocations")
+    for stat in tracemalloc.take_snapshot().statistics("lineno")[:10]:
+        logging.info(str(stat))
+    tracemalloc.stop()
+    metrics.set("profile", {
+        "file": profile_file,
+        "peak_traced_bytes": peak,
+    })
+
+
+def upload_report(name, report):
+    """Upload the run report to every org's log folder
+    The same folders as the run log, which backup_orgs() uploads"""
+    from .drive import upload_json, GoogleErrors, AuthErrors
+    for org in settings.logfolder_orgs():
+        try:
+            in_org(upload_json, org)(name, report, "logfolder")
+        except (
+            GoogleErrors.Error, AuthErrors.GoogleAuthError, OSError
+        ) as error:
+            logging.warning("Run report could not be uploaded")
+            logging.warning(error)
+
+
+def write_report():
+    """Write the run metrics to the JSON run report, upload it to every
+    org's log folder and write or push the Prometheus metrics if asked to
+    A --dry-run only writes the local report, leaving Drive untouched"""
+    report = metrics.report()
+    report_name = args.report or \
+        f"git_backup_report_{settings.rundate}.json"
+    try:
+        with open(ROOT_DIR + "/" + report_name, "w",
+                  encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+        report_message = f"Run report written to {report_name}"
+        logging.info(report_message)
+    except OSError as error:
+        logging.warning("Run report could not be written")
+        logging.warning(error)
+    if not args.dry_run:
+        upload_report(report_name.split("/")[-1], report)
+
+    text = metrics.prometheus(report)
+    if args.prometheus:
+        # The textfile collector may read at any time - never half a file
+        temp_file = ROOT_DIR + "/" + args.prometheus + ".tmp"
+        try:
+            with open(temp_file, "w", encoding="utf-8") as prometheus:
+                prometheus.write(text)
+            replace(temp_file, ROOT_DIR + "/" + args.prometheus)
+        except OSError as error:
+            logging.warning("Prometheus textfile could not be written")
+            logging.warning(error)
+    if args.pushgateway:
+        try:
+            response = requests.put(
+                args.pushgateway.rstrip("/") + "/metrics/job/git_backup",
+                data=text.encode("utf-8"),
+                headers={"Content-Type": "text/plain; version=0.0.4"},
+                timeout=30
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as error:
+            logging.warning("Metrics could not be pushed to the Pushgateway")
+            logging.warning(error)
@@ -0,0 +1,359 @@
+"""Git mirror engine - --engine mirror backs repos up as git bundles
+instead of GitHub migration archives
+A cache of git clone --mirror copies is brought up to date with git fetch
+on a process pool. Each run uploads bundles of only the refs and objects
+new since a repo's last bundle, so the bytes sent follow the day's
+changes rather than the size of the org"""
+
+import base64
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import json
+import logging
+from math import ceil
+import multiprocessing
+from os import environ, makedirs, path, remove, rename
+import random
+import shutil
+import subprocess
+import tarfile
+from time import sleep
+
+import requests
+
+from . import state
+from .catalog import record_run
+from .github import find_repos, make_sets, new_set, show_plan
+from .metrics import metrics
+from .settings import args, current_org, git_config, in_org, ROOT_DIR
+from .transfers import ArchiveDigest, archive_name, upload_local
+from .transfers import upload_digests, clear_checkpoint
+
+# git bundle refuses to write a bundle with nothing in it
+EMPTY_BUNDLE = "Refusing to create empty bundle"
+
+
+def clone_url(repo):
+    """URL the mirror of repo is cloned from
+    The optional clone_url key of the git section is a template with
+    {repo} for owner/name, such as /srv/git/{repo}.git. By default it is
+    the GitHub web host of the section's api"""
+    section = git_config()
+    template = section.get("clone_url")
+    if template is None:
+        api = section.get("api", "https://api.github.com").rstrip("/")
+        web = "https://github.com" if api == "https://api.github.com" \
+            else api.removesuffix("/api/v3")
+        template = web + "/{repo}.git"
+    return template.format(repo=repo)
+
+
+def git_env():
+    """Environment of the git processes - the org's token goes in an
+    HTTP header set through the environment, never in a URL or on the
+    command line, and git never stops to ask for a password
+    GIT_CONFIG_PARAMETERS is what git -c sets - unlike GIT_CONFIG_COUNT
+    it works with the git 2.30 of the container image"""
+    credentials = base64.b64encode(
+        f"x-access-token:{git_config()['token']}".encode("utf-8")
+    ).decode("ascii")
+    return dict(
+        environ,
+        GIT_TERMINAL_PROMPT="0",
+        GIT_CONFIG_PARAMETERS=f"'http.extraHeader=Authorization: Basic \
+{credentials}'",
+    )
+
+
+def git(directory, *arguments, env=None, stdin=None, check=True):
+    """Run git in directory, returning what it printed"""
+    command = ["git"] + (["-C", directory] if directory else [])
+    return subprocess.run(
+        command + list(arguments),
+        env=env,
+        input=stdin,
+        capture_output=True,
+        text=True,
+        check=check
+    ).stdout
+
+
+def git_error(error):
+    """Last line git wrote to stderr, or the error itself"""
+    stderr = getattr(error, "stderr", None) or ""
+    lines = stderr.strip().splitlines()
+    return lines[-1] if lines else str(error)
+
+
+def read_refs(directory):
+    """Every ref of a mirror with the object it points to, and HEAD"""
+    refs = {}
+    for line in git(
+        directory, "for-each-ref", "--format=%(objectname) %(refname)"
+    ).splitlines():
+        sha, ref = line.split(" ", 1)
+        refs[ref] = sha
+    head = git(directory, "symbolic-ref", "-q", "HEAD", check=False)
+    return refs, head.strip() or None
+
+
+def update_mirror(url, directory, env):
+    """Clone url to the mirror directory, or fetch into the mirror when
+    it is there. Run on the process pool
+    Returns the mirror's refs, HEAD and the error of the last attempt"""
+    for attempt in range(4):
+        if attempt:
+            sleep(2 ** attempt + random.random())
+        try:
+            if path.isdir(directory):
+                git(directory, "remote", "set-url", "origin", url, env=env)
+                git(directory, "fetch", "--prune", "--quiet", "origin",
+                    env=env)
+            else:
+                # A clone cut short never looks like a mirror
+                partial = directory + ".partial"
+                shutil.rmtree(partial, ignore_errors=True)
+                makedirs(path.dirname(directory), exist_ok=True)
+                git(None, "clone", "--mirror", "--quiet", url, partial,
+                    env=env)
+                rename(partial, directory)
+            return read_refs(directory) + (None,)
+        except (subprocess.CalledProcessError, OSError) as error:
+            reason = git_error(error)
+    return {}, None, reason
+
+
+def bundle_repo(directory, file, since):
+    """Write the bundle of a mirror's refs and the objects not reachable
+    from since, the objects its refs pointed to at the last bundle.
+    Those missing from the mirror are left out, which only makes the
+    bundle bigger. Run on the process pool
+    Returns the objects the bundle needs, None when there is nothing new
+    to bundle, and the error if it failed"""
+    try:
+        known = []
+        if since:
+            checked = git(
+                directory, "cat-file", "--batch-check",
+                stdin="".join(i + "\n" for i in sorted(set(since)))
+            )
+            known = [
+                line.split()[0] for line in checked.splitlines()
+                if not line.endswith(" missing")
+            ]
+        makedirs(path.dirname(file), exist_ok=True)
+        result = subprocess.run(
+            ["git", "-C", directory, "bundle", "create", "--quiet", file,
+             "--all", "--stdin"],
+            input="".join(f"^{i}\n" for i in known),
+            capture_output=True,
+            text=True
+        )
+        if result.returncode and EMPTY_BUNDLE in result.stderr:
+            return None, None
+        if result.returncode:
+            raise subprocess.CalledProcessError(
+                result.returncode, "git bundle", stderr=result.stderr
+            )
+        return known, None
+    except (subprocess.CalledProcessError, OSError) as error:
+        return None, git_error(error)
+
+
+def pack_set(file, staging, records):
+    """Write the archive of an archive set - each repo's bundle and refs
+    under repositories/ as owner/name.bundle and owner/name.refs.json
+    Bundles are already compressed, so gzip only runs at level 1
+    Returns the ArchiveDigest of the archive"""
+    with tarfile.open(file, "w:gz", compresslevel=1) as tar:
+        for i in records:
+            for extension in (".bundle", ".refs.json"):
+                member = f"repositories/{i['full_name']}{extension}"
+                if path.exists(path.join(staging, member)):
+                    tar.add(path.join(staging, member), member)
+    return ArchiveDigest.from_file(file)
+
+
+def mirror_backup(pool, manifest):
+    """Back up the current org with --engine mirror
+    Fetch every repo listed into its mirror, bundle what changed since
+    the repo's last bundle and upload the bundles in archive sets, on
+    the transfer threads of pool
+    Returns the org's backup manifest, or None if the backup failed"""
+    from .cli import collect_transfers, transfer_status
+    org = current_org()
+    journal = state.journal()
+    incremental = args.incremental
+    if incremental and manifest.full_due(args.full_every):
+        mirror_message = f'Last full backup was {manifest.last_full} - \
+Bundling every repo in full'
+        logging.info(mirror_message)
+        incremental = False
+    logging.info("Listing Repos")
+    try:
+        with metrics.timer("listing"):
+            found = find_repos(1, manifest if incremental else None)
+    except requests.exceptions.RequestException as error:
+        logging.error("An error occoured")
+        logging.error(error)
+        return None
+    if args.dry_run:
+        show_plan({
+            key: new_set(item["records"], "mirror")
+            for key, item in make_sets(found).items()
+        })
+        return None
+
+    # Orgs given with --org can hold repos of the same name
+    cache = path.join(ROOT_DIR, args.mirror_cache, org.name)
+    staging = path.join(
+        ROOT_DIR, org.file("git-archive") + "-" + org.rundate + "-bundles"
+    )
+    shutil.rmtree(staging, ignore_errors=True)
+    # Spawned rather than forked - the transfer and org threads may hold
+    # locks a forked child would inherit
+    with ProcessPoolExecutor(
+        max_workers=args.fetch_workers,
+        mp_context=multiprocessing.get_context("spawn")
+    ) as processes:
+        mirror_message = f"Fetching {len(found)} repos into {cache}"
+        logging.info(mirror_message)
+        env = git_env()
+        with metrics.timer("fetch"):
+            fetched = list(processes.map(
+                update_mirror,
+                [clone_url(i["full_name"]) for i in found],
+                [path.join(cache, i["full_name"] + ".git") for i in found],
+                [env] * len(found)
+            ))
+        bundled = {}
+        to_bundle = []
+        failures = 0
+        for i, (refs, head, error) in zip(found, fetched):
+            name = i["full_name"]
+            entry = manifest.repos.get(name, {})
+            if error is not None:
+                mirror_message = f"{name} could not be fetched - {error}"
+                logging.error(mirror_message)
+                failures += 1
+            elif incremental and entry.get("refs") == refs \
+                    and entry.get("head") == head:
+                # Nothing new - only the listing dates move on
+                entry.update(
+                    pushed_at=i["pushed_at"], updated_at=i["updated_at"]
+                )
+                metrics.add("mirror_repos_unchanged", 1)
+            else:
+                # Without refs from a bundle the repo starts a new chain
+                since = entry.get("refs", {}) if incremental else {}
+                bundled[name] = {
+                    "refs": refs,
+                    "head": head,
+                    "full": not since,
+                    "chain": entry.get("chain", []) if since else [],
+                }
+                to_bundle.append((i, since))
+        mirror_message = f"{len(bundled)} repos to bundle"
+        logging.info(mirror_message)
+        with metrics.timer("bundle"):
+            results = processes.map(
+                bundle_repo,
+                [
+                    path.join(cache, i["full_name"] + ".git")
+                    for i, _ in to_bundle
+                ],
+                [
+                    path.join(staging, f"repositories/{i['full_name']}.bundle")
+                    for i, _ in to_bundle
+                ],
+                [list(since.values()) for _, since in to_bundle]
+            )
+            records = []
+            for (i, _), (prerequisites, error) in zip(to_bundle, results):
+                name = i["full_name"]
+                if error is not None:
+                    mirror_message = f"{name} could not be bundled - {error}"
+                    logging.error(mirror_message)
+                    failures += 1
+                    del bundled[name]
+                    continue
+                bundle = path.join(staging, f"repositories/{name}.bundle")
+                size = path.getsize(bundle) if prerequisites is not None \
+                    else 0
+                metrics.add("mirror_bundle_bytes", size)
+                # Refs moved or deleted with no new objects still count
+                with open(
+                    path.join(staging, f"repositories/{name}.refs.json"), "w",
+                    encoding="utf-8"
+                ) as refs_file:
+                    json.dump({
+                        "repo": name,
+                        "refs": bundled[name]["refs"],
+                        "head": bundled[name]["head"],
+                        "full": bundled[name]["full"],
+                        "bundle": prerequisites is not None,
+                        "prerequisites": prerequisites or [],
+                    }, refs_file)
+                # Sets are filled by bundle size, in KB as GitHub sizes are
+                records.append(dict(i, size=ceil(size / 1024)))
+    metrics.add("mirror_repos_fetched", len(found) - failures)
+    metrics.add("mirror_repos_bundled", len(records))
+    metrics.add("mirror_repos_failed", failures)
+
+    repos = {
+        key: new_set(item["records"], "mirror")
+        for key, item in make_sets(records).items()
+    }
+    journal.start(org.rundate, incremental)
+    for key, item in repos.items():
+        journal.write(
+            "set", key=key, records=item['records'], tier=item['tier']
+        )
+        metrics.tiered(key, item['tier'])
+    transfers = {}
+    results = {"uploaded": [], "failed": []}
+    try:
+        for key, item in repos.items():
+            file = archive_name(key)
+            with metrics.timer("pack", key):
+                digest = pack_set(file, staging, item["records"])
+            mirror_message = f'Archive set {key} - {item["count"]} repos \
+in {round(digest.bytes / 1048576, 1)} MB - queued for upload'
+            logging.info(mirror_message)
+            future = pool.submit(in_org(upload_local), key, file, digest)
+            transfers[future] = key
+            collect_transfers(transfers, results)
+        while transfers:
+            wait(transfers, return_when=FIRST_COMPLETED)
+            collect_transfers(transfers, results)
+            transfer_status({}, transfers, results)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    logging.info("Uploads complete")
+    metrics.add("sets_total", len(repos))
+    metrics.add("sets_uploaded", len(results["uploaded"]))
+    metrics.add("sets_failed", len(results["failed"]))
+    for key in results["failed"]:
+        # Left out of the manifest, so the next run bundles it again
+        if path.exists(archive_name(key)):
+            remove(archive_name(key))
+        clear_checkpoint(archive_name(key))
+    upload_digests()
+    for key in results["uploaded"]:
+        archive = archive_name(key)
+        manifest.record(repos[key]['records'], archive)
+        for i in repos[key]['records']:
+            entry = bundled[i["full_name"]]
+            manifest.repos[i["full_name"]].update(
+                refs=entry["refs"],
+                head=entry["head"],
+                # Archives a restore needs, oldest first
+                chain=entry["chain"] + [archive],
+            )
+    if not incremental and not results["failed"] and not failures \
+            and not args.only:
+        manifest.last_full = org.rundate
+    manifest.save()
+    with metrics.timer("catalog"):
+        record_run(repos, results["uploaded"], incremental)
+    journal.write("finished")
+    return manifest
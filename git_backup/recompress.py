@@ -0,0 +1,188 @@
+"""Recompression of GitHub's gzip archives with zstd or xz before upload
+The tar is cut into RECOMPRESS_BLOCK blocks compressed on a thread per
+core. Each block is a complete zstd frame or xz stream, and the zstd and
+xz tools read the concatenated blocks back as one tar. As every block can
+be decompressed alone, the archive index lets restore fetch one member"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import logging
+import lzma
+import os
+from os import path
+import tarfile
+import threading
+from time import thread_time
+
+from .settings import args, RECOMPRESS_BLOCK
+
+# Default level of each codec, as used by the zstd and xz tools
+LEVELS = {"zstd": 3, "xz": 6}
+
+_pool = None
+_pool_lock = threading.Lock()
+# zstd compressors are reused, but only by the thread that made them
+_local = threading.local()
+
+
+def recompress_pool():
+    """Threads shared by every archive being recompressed, one per core"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                thread_name_prefix="recompress"
+            )
+        return _pool
+
+
+def compress_block(codec, level, block):
+    """Compress one block, run on the recompress pool
+    Both codecs release the GIL while they work
+    Returns the compressed block and the CPU seconds it took"""
+    started = thread_time()
+    if codec == "zstd":
+        if getattr(_local, "level", None) != level:
+            import zstandard
+            _local.zstd = zstandard.ZstdCompressor(level=level)
+            _local.level = level
+        data = _local.zstd.compress(block)
+    else:
+        data = lzma.compress(block, preset=level)
+    return data, thread_time() - started
+
+
+class BlockWriter:
+    """Cuts the tar into RECOMPRESS_BLOCK blocks, compresses them on the
+    recompress pool and writes them to output in order
+    At most one block per core is held in memory for each archive"""
+
+    def __init__(self, output, digest, codec, level):
+        self.output = output
+        self.digest = digest
+        self.codec = codec
+        self.level = level
+        self.pool = recompress_pool()
+        self.window = os.cpu_count() or 1
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.tar_bytes = 0
+        self.cpu_seconds = 0
+        # Offset and length of every block in output and in the tar
+        self.blocks = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= RECOMPRESS_BLOCK:
+            self._submit(bytes(self.buffer[:RECOMPRESS_BLOCK]))
+            del self.buffer[:RECOMPRESS_BLOCK]
+
+    def _submit(self, block):
+        self.pending.append((
+            self.tar_bytes,
+            len(block),
+            self.pool.submit(compress_block, self.codec, self.level, block)
+        ))
+        self.tar_bytes += len(block)
+        while len(self.pending) >= self.window:
+            self._write_next()
+
+    def _write_next(self):
+        tar_offset, tar_length, future = self.pending.popleft()
+        data, seconds = future.result()
+        self.cpu_seconds += seconds
+        self.blocks.append(
+            [self.digest.bytes, len(data), tar_offset, tar_length]
+        )
+        self.output.write(data)
+        self.digest.update(data)
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self._write_next()
+
+
+class TarTee(io.RawIOBase):
+    """Reads the tar from source for tarfile, handing every byte read
+    on to write as well"""
+
+    def __init__(self, source, write):
+        self.source = source
+        self.write_to = write
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        self.write_to(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def tar_members(tar_stream):
+    """Name, header offset, size and type of every member of a tar
+    Returns None for something tarfile can not read"""
+    members = []
+    try:
+        with tarfile.open(fileobj=tar_stream, mode="r|") as tar:
+            for member in tar:
+                members.append([
+                    member.name,
+                    member.offset,
+                    member.size,
+                    member.type.decode("ascii", "replace")
+                ])
+    except tarfile.TarError as error:
+        index_message = f"Archive could not be indexed - {error}"
+        logging.warning(index_message)
+        return None
+    return members
+
+
+def recompress_archive(source, target, digest):
+    """Recompress the gzip archive source to target with --recompress
+    The tar's members are listed on the way through for the index
+    restore uses to fetch single members. digest is updated with target
+    as it is written
+    Returns the sizes and the CPU seconds spent, gzip decompression
+    included, and the index - None if the tar could not be read"""
+    codec = args.recompress
+    level = args.recompress_level
+    if level is None:
+        level = LEVELS[codec]
+    started = thread_time()
+    with gzip.open(source, "rb") as archive, \
+            open(target, "wb") as output:
+        writer = BlockWriter(output, digest, codec, level)
+        tee = TarTee(archive, writer.write)
+        members = tar_members(tee)
+        # Anything after the end of archive marker
+        while tee.read(RECOMPRESS_BLOCK):
+            pass
+        writer.close()
+    result = {
+        "codec": codec,
+        "level": level,
+        "tar_bytes": writer.tar_bytes,
+        "bytes": digest.bytes,
+        "cpu_seconds": writer.cpu_seconds + thread_time() - started,
+    }
+    index = None
+    if members is not None:
+        index = {
+            "archive": path.basename(target),
+            "codec": codec,
+            "tar_bytes": writer.tar_bytes,
+            # [offset, length, tar offset, tar length]
+            "blocks": writer.blocks,
+            # [name, header offset in the tar, size, tarfile type]
+            "members": members,
+        }
+    return result, index
@@ -0,0 +1,383 @@
+"""restore subcommand - extract single repos or files from an archive
+in Google Drive. With the index of a --recompress archive only the
+blocks holding them are fetched, using HTTP Range requests. Other
+archives are read from the start until everything asked for is found"""
+
+import bisect
+import gzip
+import io
+import json
+import logging
+import lzma
+from os import makedirs, path, remove
+import subprocess
+import tarfile
+import tempfile
+
+from .metrics import metrics
+from .settings import args, drive_config, ROOT_DIR, CHUNK_SIZE
+
+
+def find_file(service, folder, name):
+    """ID and size of the newest file called name in folder, or None"""
+    response = service.files().list(
+        q=f"name = '{name}' and '{folder}' in parents and trashed = false",
+        orderBy="createdTime desc",
+        fields="files(id, size)",
+        supportsAllDrives=True,
+        includeItemsFromAllDrives=True
+    ).execute()
+    files = response.get("files", [])
+    return files[0] if files else None
+
+
+def fetch_range(service, file_id, start, length):
+    """Bytes start to start + length of a Drive file"""
+    request = service.files().get_media(
+        fileId=file_id, supportsAllDrives=True
+    )
+    request.headers["Range"] = f"bytes={start}-{start + length - 1}"
+    data = request.execute(num_retries=3)
+    metrics.add_bytes("downloaded", len(data))
+    return data
+
+
+def fetch_json(service, file_id):
+    request = service.files().get_media(
+        fileId=file_id, supportsAllDrives=True
+    )
+    return json.loads(request.execute(num_retries=3))
+
+
+def open_archive(service, folder, name):
+    """Size of an archive and a function fetching a byte range of it
+    An archive uploaded with --parts is read through its parts manifest
+    Returns None if neither the archive nor its manifest is found"""
+    found = find_file(service, folder, name)
+    if found:
+        return int(found.get("size", 0)), \
+            lambda start, length: fetch_range(
+                service, found["id"], start, length
+            )
+
+    found = find_file(service, folder, name + ".parts.json")
+    if not found:
+        return None
+    parts = fetch_json(service, found["id"])["parts"]
+
+    def fetch_parts(start, length):
+        data = []
+        for part in parts:
+            end = min(start + length, part["offset"] + part["bytes"])
+            if part["offset"] <= start < end:
+                data.append(fetch_range(
+                    service, part["file_id"], start - part["offset"],
+                    end - start
+                ))
+                length -= end - start
+                start = end
+        return b"".join(data)
+
+    return sum(i["bytes"] for i in parts), fetch_parts
+
+
+def decompressor(name):
+    """Function decompressing one block of a --recompress archive"""
+    if name.endswith(".zst"):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress
+    return lzma.decompress
+
+
+class IndexedArchive(io.RawIOBase):
+    """Seekable view of the tar inside a --recompress archive
+    Reading a position fetches and decompresses only its block"""
+
+    def __init__(self, index, fetch):
+        self.blocks = index["blocks"]
+        self.starts = [i[2] for i in self.blocks]
+        self.size = index["tar_bytes"]
+        self.fetch = fetch
+        self.decompress = decompressor(index["archive"])
+        self.position = 0
+        self.cached = None
+        self.data = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        """Fills buffer across block boundaries, as tarfile takes a short
+        read for the end of the archive"""
+        done = 0
+        while done < len(buffer) and self.position < self.size:
+            block = bisect.bisect_right(self.starts, self.position) - 1
+            if self.cached != block:
+                offset, length, _, _ = self.blocks[block]
+                self.data = self.decompress(self.fetch(offset, length))
+                self.cached = block
+            start = self.position - self.starts[block]
+            data = memoryview(self.data)[start:start + len(buffer) - done]
+            buffer[done:done + len(data)] = data
+            self.position += len(data)
+            done += len(data)
+        return done
+
+
+class ArchiveStream(io.RawIOBase):
+    """The whole archive, fetched from the start in CHUNK_SIZE ranges"""
+
+    def __init__(self, size, fetch):
+        self.size = size
+        self.fetch = fetch
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        length = min(len(buffer), CHUNK_SIZE, self.size - self.position)
+        if length <= 0:
+            return 0
+        data = self.fetch(self.position, length)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def tar_stream(name, raw):
+    """The tar inside a compressed archive read from raw"""
+    archive = io.BufferedReader(raw, CHUNK_SIZE)
+    if name.endswith(".zst"):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(
+            archive, read_across_frames=True
+        )
+    if name.endswith(".xz"):
+        return lzma.LZMAFile(archive)
+    return gzip.GzipFile(fileobj=archive)
+
+
+def selected(paths):
+    """Function telling if a member is one of paths or inside one"""
+    prefixes = [i.rstrip("/") for i in paths]
+
+    def wanted(name):
+        return any(
+            name == i or name.startswith(i + "/") for i in prefixes
+        )
+    return wanted
+
+
+def extract(tar, member, output):
+    """Extract a member below output, refusing paths that leave it"""
+    if path.isabs(member.name) or ".." in member.name.split("/"):
+        restore_message = f"Skipping {member.name} - unsafe path"
+        logging.warning(restore_message)
+        return False
+    # Extraction filters came in Python 3.12 and later 3.8-3.11 releases
+    if hasattr(tarfile, "data_filter"):
+        tar.extract(member, output, filter="data")
+    else:
+        tar.extract(member, output)
+    restore_message = f"Restored {member.name}"
+    logging.debug(restore_message)
+    return True
+
+
+def restore_indexed(index, fetch, wanted, output):
+    """Extract the wanted members, fetching only their blocks"""
+    archive = IndexedArchive(index, fetch)
+    restored = 0
+    with tarfile.open(fileobj=archive, mode="r:") as tar:
+        for name, offset, _, _ in index["members"]:
+            if not wanted(name):
+                continue
+            archive.seek(offset)
+            member = tarfile.TarInfo.fromtarfile(tar)
+            restored += extract(tar, member, output)
+    return restored
+
+
+def restore_streamed(name, size, fetch, wanted, files, output):
+    """Extract the wanted members reading the archive from the start
+    Stops early once every name in files is restored as a regular file
+    Directories could have members further on, so are read to the end"""
+    restored = 0
+    remaining = set(files)
+    with tarfile.open(
+        fileobj=tar_stream(name, ArchiveStream(size, fetch)), mode="r|"
+    ) as tar:
+        for member in tar:
+            if wanted(member.name):
+                restored += extract(tar, member, output)
+                if member.isfile():
+                    remaining.discard(member.name)
+                if files and not remaining:
+                    break
+    return restored
+
+
+def restore_bundles(service, folder, repo, chain, output):
+    """Rebuild a repo backed up by --engine mirror as a bare repo below
+    output, fetching its bundles from each archive of chain, oldest
+    first, then setting its refs and HEAD to those of the last one
+    Returns the number of bundles applied"""
+    members = [f"repositories/{repo}.bundle", f"repositories/{repo}.refs.json"]
+    target = path.join(output, "repositories", repo + ".git")
+    makedirs(target, exist_ok=True)
+    subprocess.run(
+        ["git", "init", "--quiet", "--bare", target],
+        capture_output=True, check=True
+    )
+    applied = 0
+    with tempfile.TemporaryDirectory(dir=output) as scratch:
+        for name in chain:
+            archive = open_archive(service, folder, name)
+            if archive is None:
+                raise FileNotFoundError(f"{name} not found in Google Drive")
+            size, fetch = archive
+            restore_streamed(
+                name, size, fetch, selected(members), members, scratch
+            )
+            bundle = path.join(scratch, members[0])
+            if path.exists(bundle):
+                subprocess.run(
+                    ["git", "-C", target, "fetch", "--quiet", bundle,
+                     "+refs/*:refs/*"],
+                    capture_output=True, check=True
+                )
+                remove(bundle)
+                applied += 1
+            with open(path.join(scratch, members[1]),
+                      encoding="utf-8") as refs_file:
+                snapshot = json.load(refs_file)
+            restore_message = f"Applied {name} to {target}"
+            logging.info(restore_message)
+    # Refs moved or deleted with no new objects are in no bundle
+    existing = subprocess.run(
+        ["git", "-C", target, "for-each-ref", "--format=%(refname)"],
+        capture_output=True, text=True, check=True
+    ).stdout.split()
+    updates = [
+        f"update {ref} {sha}" for ref, sha in snapshot["refs"].items()
+    ] + [f"delete {ref}" for ref in existing if ref not in snapshot["refs"]]
+    subprocess.run(
+        ["git", "-C", target, "update-ref", "--stdin"],
+        input="".join(i + "\n" for i in updates),
+        capture_output=True, text=True, check=True
+    )
+    if snapshot["head"]:
+        subprocess.run(
+            ["git", "-C", target, "symbolic-ref", "HEAD", snapshot["head"]],
+            capture_output=True, check=True
+        )
+    return applied
+
+
+def restore():
+    """Extract the paths, --repo or --list asked for from one archive
+    Returns 0 on success, 1 on failure"""
+    from .drive import drive_service, GoogleErrors
+    from .state import Manifest
+
+    name = args.archive
+    paths = list(args.paths)
+    entry = {}
+    if args.repo:
+        if not name:
+            entry = Manifest.load().repos.get(args.repo, {})
+            name = entry.get("archive")
+        paths += [
+            f"repositories/{args.repo}.git",
+            f"repositories/{args.repo}.wiki.git",
+        ]
+    if not name:
+        logging.critical("restore - Give --archive, or a --repo listed \
+in the backup manifest")
+        return 1
+    if not paths and not args.list:
+        logging.critical("restore - Give paths to restore, --repo or --list")
+        return 1
+    wanted = selected(paths) if paths else (lambda member: True)
+    output = path.join(ROOT_DIR, args.output)
+    folder = drive_config()["folder"]
+
+    try:
+        service = drive_service()
+        archive = open_archive(service, folder, name)
+        if archive is None:
+            restore_message = f"restore - {name} not found in Google Drive"
+            logging.critical(restore_message)
+            return 1
+        size, fetch = archive
+        if entry.get("chain") and not args.list:
+            # Backed up by --engine mirror - a chain of bundles
+            makedirs(output, exist_ok=True)
+            applied = restore_bundles(
+                service, folder, args.repo, entry["chain"], output
+            )
+            restore_message = f'Restored {args.repo} to {output} from \
+{applied} bundles in {len(entry["chain"])} archives'
+            logging.info(restore_message)
+            return 0
+        found = find_file(service, folder, name + ".index.json")
+        index = fetch_json(service, found["id"]) if found else None
+
+        if args.list:
+            if index is None:
+                logging.info("No index - reading the whole archive")
+                with tarfile.open(
+                    fileobj=tar_stream(name, ArchiveStream(size, fetch)),
+                    mode="r|"
+                ) as tar:
+                    members = [i.name for i in tar]
+            else:
+                members = [i[0] for i in index["members"]]
+            for member in members:
+                if wanted(member):
+                    print(member)
+            return 0
+
+        makedirs(output, exist_ok=True)
+        if index is None:
+            logging.info("No index - reading the archive from the start")
+            files = [] if args.repo else [i.rstrip("/") for i in paths]
+            restored = restore_streamed(
+                name, size, fetch, wanted, files, output
+            )
+        else:
+            restored = restore_indexed(index, fetch, wanted, output)
+    except (
+        GoogleErrors.Error,
+        tarfile.TarError,
+        OSError,
+        subprocess.CalledProcessError
+    ) as error:
+        logging.critical("restore - Restore failed")
+        logging.critical(error)
+        return 1
+
+    fetched = metrics.report()["bytes"]["downloaded"]
+    restore_message = f'Restored {restored} members of {name} to \
+{output} - fetched {round(fetched / 1048576, 1)} of \
+{round(size / 1048576, 1)} MB'
+    logging.info(restore_message)
+    if not restored:
+        logging.error("restore - Nothing matched the paths given")
+        return 1
+    return 0
@@ -0,0 +1,152 @@
+"""Retention cleanup of old archives and logs in Google Drive"""
+
+from datetime import datetime, timedelta, timezone
+import logging
+import random
+import re
+from time import sleep
+
+from .settings import args, drive_config, DELETE_BATCH
+
+# Archive name of a part, parts manifest or whole archive
+ARCHIVE = re.compile(r"(\.tar\.(?:gz|zst|xz))\..*$")
+
+
+def list_folder(service, folder):
+    """Every file in a Drive folder, following nextPageToken"""
+    files = []
+    page_token = None
+    while True:
+        response = service.files().list(
+            q=f"'{folder}' in parents and trashed = false",
+            pageSize=1000,
+            pageToken=page_token,
+            fields="nextPageToken, files(id, name, createdTime)",
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True
+        ).execute()
+        files += response.get("files", [])
+        page_token = response.get("nextPageToken")
+        if page_token is None:
+            return files
+
+
+def retained_days(days, today, daily, weekly, monthly):
+    """Days to keep under a daily/weekly/monthly policy
+    days are the dates that have backups. Days less than daily days
+    before today are kept, plus the newest day of each of the last
+    weekly calendar weeks and monthly calendar months up to today
+    Ages are by the calendar, so a gap in backups does not keep older
+    ones for longer"""
+    newest = sorted(set(days), reverse=True)
+    keep = {day for day in newest if (today - day).days < daily}
+    weeks = {
+        (today - timedelta(weeks=n)).isocalendar()[:2]
+        for n in range(weekly)
+    }
+    months = {
+        divmod(today.year * 12 + today.month - 1 - n, 12)
+        for n in range(monthly)
+    }
+    for periods, period in (
+        (weeks, lambda day: day.isocalendar()[:2]),
+        (months, lambda day: divmod(day.year * 12 + day.month - 1, 12))
+    ):
+        seen = set()
+        for day in newest:
+            if period(day) in periods and period(day) not in seen:
+                seen.add(period(day))
+                keep.add(day)
+    return keep
+
+
+def delete_files(service, files):
+    """Delete Drive files with batch requests of DELETE_BATCH calls
+    Calls refused for rate limits or server errors are retried in a
+    later batch. Returns the number of files deleted"""
+    from .drive import GoogleErrors
+    deleted = 0
+    for attempt in range(4):
+        retry = []
+
+        def deleted_file(request_id, _, error):
+            nonlocal deleted
+            if error is None:
+                deleted += 1
+            elif isinstance(error, GoogleErrors.HttpError) \
+                    and error.resp.status in (403, 429, 500, 503) \
+                    and attempt < 3:
+                retry.append(files[int(request_id)])
+            else:
+                cleanup_message = f'{files[int(request_id)]["name"]} \
+could not be removed - {error}'
+                logging.error(cleanup_message)
+
+        for first in range(0, len(files), DELETE_BATCH):
+            batch = service.new_batch_http_request(callback=deleted_file)
+            for index in range(first, min(first + DELETE_BATCH, len(files))):
+                batch.add(
+                    service.files().delete(
+                        fileId=files[index]["id"], supportsAllDrives=True
+                    ),
+                    request_id=str(index)
+                )
+            batch.execute()
+        if not retry:
+            break
+        files = retry
+        sleep(2 ** attempt + random.random())
+    return deleted
+
+
+def remove_old_archives_and_logs(manifests=()):
+    """Remove old archives and logs from the current org's folders
+    Files are grouped by the day they were created and the days outside
+    the --keep-daily/--keep-weekly/--keep-monthly policy are removed.
+    Archives the backup manifests still point to are always kept - give
+    the manifest of every org backed up to the same folders"""
+    from .drive import drive_service, GoogleErrors
+    cleanup_message = f"Keeping {args.keep_daily} daily, \
+{args.keep_weekly} weekly and {args.keep_monthly} monthly backups"
+    logging.info("Removing old archives and logs")
+    logging.info(cleanup_message)
+
+    # Unchanged repos in an incremental run live on in older archives,
+    # and --engine mirror repos need every bundle since their last full one
+    protected = {
+        archive
+        for manifest in manifests for i in manifest.repos.values()
+        for archive in [i["archive"]] + i.get("chain", [])
+    }
+
+    try:
+        service = drive_service()
+        for folder in (
+            drive_config()["folder"],
+            drive_config()["logfolder"]
+        ):
+            files = list_folder(service, folder)
+            for i in files:
+                i["day"] = datetime.fromisoformat(
+                    i["createdTime"].replace("Z", "+00:00")
+                ).date()
+            keep = retained_days(
+                [i["day"] for i in files],
+                datetime.now(timezone.utc).date(),
+                # Never remove the backup that was just made
+                max(args.keep_daily, 1),
+                args.keep_weekly,
+                args.keep_monthly
+            )
+            stale = [
+                i for i in files
+                if i["day"] not in keep
+                and ARCHIVE.sub(r"\1", i["name"]) not in protected
+            ]
+            deleted = delete_files(service, stale)
+            cleanup_message = f"Removed {deleted} of {len(files)} files \
+from folder {folder}"
+            logging.info(cleanup_message)
+
+    except GoogleErrors.Error as error:
+        logging.error(error)
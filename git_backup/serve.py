@@ -0,0 +1,336 @@
+"""serve subcommand - stay running, backing up on a cron schedule and on
+request, with a local HTTP endpoint for health, progress and metrics
+The Google credentials and discovery document, the GitHub sessions, the
+transfer threads and the local catalog are kept warm between runs"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import signal
+import threading
+
+from . import logs, settings
+from .metrics import metrics
+from .settings import args, config
+
+ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+}
+# Lowest and highest value of each cron field - 7 is Sunday as well as 0
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+# Longest a schedule can go without a match, such as 0 0 29 2 1
+SEARCH_DAYS = 366 * 8
+
+# What the endpoint reports - updated by the main thread under _lock
+status = {
+    "state": "idle",
+    "started": None,
+    "next_run": None,
+    "last_run": None,
+    "runs": 0,
+}
+_lock = threading.Lock()
+# Repos asked for by POST /run, [] for all of them, None when not asked
+_requested = None
+_wake = threading.Event()
+_stopping = False
+
+
+def parse_field(field, low, high):
+    """Values of one cron field - *, */n, a, a-b, a-b/n, a/n or a list"""
+    values = set()
+    for part in field.split(","):
+        spec, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if spec == "*":
+            first, last = low, high
+        elif "-" in spec:
+            first, last = (int(i) for i in spec.split("-", 1))
+        else:
+            first = int(spec)
+            # a/n runs from a to the end of the range
+            last = high if "/" in part else first
+        if not low <= first <= last <= high or step < 1:
+            raise ValueError(f"{part} is not in {low}-{high}")
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class Cron:
+    """Five field cron expression - minute, hour, day of month, month and
+    day of week - or one of @hourly, @daily, @weekly and @monthly
+    As in cron, a day matches either day field when both are restricted"""
+
+    def __init__(self, expression):
+        fields = ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"{expression} does not have 5 fields")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_field(field, *limits)
+            for field, limits in zip(fields, FIELDS)
+        )
+        self.weekdays = {i % 7 for i in weekdays}
+        self.either_day = not fields[2].startswith("*") \
+            and not fields[4].startswith("*")
+
+    def day_matches(self, day):
+        in_month = day.day in self.days
+        in_week = day.isoweekday() % 7 in self.weekdays
+        if self.either_day:
+            return in_month or in_week
+        return in_month and in_week
+
+    def next_time(self, after):
+        """First minute after the datetime after that matches
+        Whole months, days and hours that do not match are skipped"""
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = time + timedelta(days=SEARCH_DAYS)
+        while time < limit:
+            if time.month not in self.months:
+                time = (time.replace(day=1) + timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0
+                )
+            elif not self.day_matches(time):
+                time = (time + timedelta(days=1)).replace(hour=0, minute=0)
+            elif time.hour not in self.hours:
+                time = (time + timedelta(hours=1)).replace(minute=0)
+            elif time.minute not in self.minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError("The schedule never matches a date")
+
+
+def request_run(repos):
+    """Ask for a run of repos, or of every repo when empty
+    Returns False if a run is already running or asked for"""
+    global _requested
+    with _lock:
+        if status["state"] == "running" or _requested is not None:
+            return False
+        _requested = list(repos)
+    _wake.set()
+    return True
+
+
+def progress():
+    """The run going on, or the last one - each org's archive set counts
+    and the bytes and throughput so far"""
+    report = metrics.report()
+    with _lock:
+        state = status["state"]
+    return {
+        "state": state,
+        "rundate": settings.rundate,
+        "orgs": {
+            org.name or org.gitenv: org.progress for org in settings.orgs
+        },
+        "bytes": report["bytes"],
+        "throughput": report["throughput"],
+        **{
+            name: report[name]
+            for name in ("sets_total", "sets_uploaded", "sets_failed")
+            if name in report
+        },
+    }
+
+
+def authorised(header):
+    """Whether an Authorization header may start a run
+    With a token in the serve section of the config POST /run needs
+    it as a bearer token, otherwise only the --listen address guards it"""
+    token = config.get("serve", "token", fallback=None)
+    if not token:
+        return True
+    scheme, _, given = (header or "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(
+        given.strip().encode("utf-8"), token.encode("utf-8")
+    )
+
+
+class Handler(BaseHTTPRequestHandler):
+    """GET /health, /progress and /metrics, and POST /run"""
+
+    def reply(self, code, body, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body, indent=2) + "\n"
+        data = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            with _lock:
+                health = dict(status)
+            self.reply(200, health)
+        elif self.path == "/progress":
+            self.reply(200, progress())
+        elif self.path == "/metrics":
+            self.reply(
+                200,
+                metrics.prometheus(metrics.report()),
+                "text/plain; version=0.0.4"
+            )
+        else:
+            self.reply(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/run":
+            self.reply(404, {"error": "Not found"})
+            return
+        if not authorised(self.headers.get("Authorization")):
+            self.reply(401, {"error": "A valid bearer token is needed"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            repos = body.get("repos") or []
+            if not isinstance(repos, list) \
+                    or not all(isinstance(i, str) for i in repos):
+                raise ValueError("repos must be a list of names")
+        except (ValueError, AttributeError) as error:
+            self.reply(400, {"error": str(error)})
+            return
+        if request_run(repos):
+            self.reply(202, {"requested": repos or "all"})
+        else:
+            self.reply(409, {"error": "A run is already running or asked \
+for"})
+
+    def log_message(self, format, *values):
+        logging.debug("serve - " + format % values)
+
+
+def stop(signum, frame):
+    """SIGTERM handler - stop once the run going on finishes"""
+    global _stopping
+    _stopping = True
+    _wake.set()
+
+
+def wait_until(when):
+    """Sleep until when, a POST /run or SIGTERM
+    Returns the repos asked for, [] for all, or None when stopping"""
+    global _requested
+    while not _stopping:
+        with _lock:
+            if _requested is not None:
+                repos, _requested = _requested, None
+                return repos
+        remaining = (when - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return []
+        # Woken at least every minute, in case the clock is changed
+        _wake.wait(min(remaining, 60))
+        _wake.clear()
+    return None
+
+
+def run_backup(pool, repos):
+    """One backup of repos, or of every repo when empty, with its own
+    rundate, logfile and metrics"""
+    from .cli import run
+    with _lock:
+        status["state"] = "running"
+        last_run = status["last_run"] or {}
+    # Archive and log names go down to the minute - never reuse them
+    now = datetime.now()
+    if now.strftime("%Y-%m-%d-%H-%M") == last_run.get("rundate"):
+        _wake.wait(60 - now.second)
+        _wake.clear()
+    settings.start_run()
+    logging.info(logs.setup_logging())
+    serve_message = f"logfile is {settings.LOGFILE}"
+    logging.info(serve_message)
+    metrics.reset()
+    only = args.only
+    if repos:
+        args.only = repos
+        serve_message = f"Backup asked for - {', '.join(repos)}"
+    else:
+        serve_message = "Backup started"
+    logging.info(serve_message)
+    result = "failed"
+    try:
+        manifests = run(pool)
+        if all(i is not None for i in manifests) \
+                and not metrics.report().get("sets_failed"):
+            result = "success"
+    except Exception as error:
+        # The daemon carries on to the next run
+        logging.critical("serve - Backup failed")
+        logging.critical(error)
+    finally:
+        args.only = only
+    with _lock:
+        status["state"] = "idle"
+        status["runs"] += 1
+        status["last_run"] = {
+            "rundate": settings.rundate,
+            "repos": repos or "all",
+            "result": result,
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "sets_failed": metrics.report().get("sets_failed", 0),
+        }
+    serve_message = f"Backup {settings.rundate} finished - {result}"
+    logging.info(serve_message)
+
+
+def serve():
+    """Back up on the --schedule cron expression and on POST /run until
+    SIGTERM or Ctrl-C, answering on --listen meanwhile
+    Returns the exit status"""
+    try:
+        cron = Cron(args.schedule)
+        cron.next_time(datetime.now())
+        host, _, port = args.listen.rpartition(":")
+        server = ThreadingHTTPServer(
+            (host or "127.0.0.1", int(port)), Handler
+        )
+    except (ValueError, OSError) as error:
+        logging.critical("serve - Could not start")
+        logging.critical(error)
+        return 1
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, stop)
+    threading.Thread(
+        target=server.serve_forever, name="serve", daemon=True
+    ).start()
+    with _lock:
+        status["started"] = datetime.now().isoformat(timespec="seconds")
+    serve_message = f"Serving health, progress and metrics on \
+http://{args.listen}"
+    logging.info(serve_message)
+
+    # Transfer threads, and the Drive connection each keeps, stay up
+    with ThreadPoolExecutor(
+        max_workers=args.workers,
+        thread_name_prefix="transfer"
+    ) as pool:
+        try:
+            while True:
+                next_run = cron.next_time(datetime.now())
+                with _lock:
+                    status["next_run"] = next_run.isoformat()
+                serve_message = f"Next scheduled backup at {next_run}"
+                logging.info(serve_message)
+                repos = wait_until(next_run)
+                if repos is None:
+                    break
+                run_backup(pool, repos)
+                if _stopping:
+                    break
+        except KeyboardInterrupt:
+            logging.info("serve - Interrupted")
+    server.shutdown()
+    logging.info("serve - Stopped")
+    return 0
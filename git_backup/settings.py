@@ -0,0 +1,603 @@
+"""Command line arguments, config and constants shared by every module
+Nothing is read at import - configure() parses the command line and
+reads the config file when main() runs"""
+
+import argparse
+import configparser
+import contextvars
+from datetime import datetime
+from importlib.util import find_spec
+from os import getcwd
+
+
+# Setup command line arguments - parsed by configure()
+argparser = argparse.ArgumentParser(prog="git_backup")
+argparser.add_argument(
+    "--config",
+    "-c",
+    help="Specify alternate config file",
+    type=str,
+    default="config.ini",
+)
+argparser.add_argument(
+    "--gitenv",
+    "-g",
+    help="The section of the config file \
+        that contains GitHub login information",
+    type=str,
+    default="git-prod",
+)
+argparser.add_argument(
+    "--googledrive",
+    "-o",
+    help="The section of the config file that\
+         contains Google Drive folder information",
+    type=str,
+    default="drive-prod",
+)
+argparser.add_argument(
+    "--org",
+    help="GITENV:GOOGLEDRIVE config sections of an org to back up. \
+        Give it once for each org - they are backed up at the same \
+        time. Replaces --gitenv and --googledrive",
+    type=str,
+    action="append",
+    dest="orgs",
+    metavar="GITENV:GOOGLEDRIVE",
+)
+argparser.add_argument(
+    "--level",
+    "-l",
+    help="Set log level. Accepted values: \
+        DEBUG, INFO or WARN. Default value is INFO",
+    type=str,
+    default="INFO",
+)
+argparser.add_argument(
+    "--driveauth",
+    "-d",
+    help="Specify alternate Google Auth file",
+    type=str,
+    default="client_secret.json",
+)
+argparser.add_argument(
+    "--unlock",
+    "-u",
+    help="Perform Github repo unlock only",
+    type=bool,
+    default=False
+)
+argparser.add_argument(
+    "--stream",
+    "-s",
+    help="Stream archives from GitHub straight into Google Drive \
+        without saving them to local disk",
+    action="store_true",
+)
+argparser.add_argument(
+    "--incremental",
+    "-i",
+    help="Only archive repos pushed or updated since their last backup",
+    action="store_true",
+)
+argparser.add_argument(
+    "--full-every",
+    "-f",
+    help="Days between full backups when running incrementally. \
+        Default value is 7",
+    type=int,
+    default=7,
+)
+argparser.add_argument(
+    "--graphql",
+    help="List repos with the GitHub GraphQL API instead of REST",
+    action="store_true",
+)
+argparser.add_argument(
+    "--set-size",
+    help="Target size in GB of each archive set. Default value is 5",
+    type=float,
+    default=5,
+)
+argparser.add_argument(
+    "--set-repos",
+    help="Maximum number of repos in each archive set. \
+        Default value is 100",
+    type=int,
+    default=100,
+)
+argparser.add_argument(
+    "--tier",
+    help="Config section of a migration tier - the repos it covers, the \
+        days it is used and what their exports leave out. Give it once \
+        for each tier, the first covering a repo is used. Repos no tier \
+        covers get full exports",
+    type=str,
+    action="append",
+    dest="tiers",
+    metavar="SECTION",
+)
+argparser.add_argument(
+    "--only",
+    help="Only back up repos matching this owner/name. * matches any \
+        characters. Can be given more than once",
+    type=str,
+    action="append",
+    metavar="REPO",
+)
+argparser.add_argument(
+    "--engine",
+    help="How repos are backed up - GitHub migration archives, or git \
+        bundles of only what is new since the last bundle, made from a \
+        local cache of mirrors. Default value is migrations",
+    type=str,
+    choices=["migrations", "mirror"],
+    default="migrations",
+)
+argparser.add_argument(
+    "--mirror-cache",
+    help="Directory of the git mirrors kept by --engine mirror. \
+        Default value is mirrors",
+    type=str,
+    default="mirrors",
+)
+argparser.add_argument(
+    "--fetch-workers",
+    help="Number of processes cloning, fetching and bundling mirrors \
+        for --engine mirror. Default value is 8",
+    type=int,
+    default=8,
+)
+argparser.add_argument(
+    "--dry-run",
+    "-n",
+    help="List repos and print the planned archive sets without \
+        starting any exports",
+    action="store_true",
+)
+argparser.add_argument(
+    "--resume",
+    "-r",
+    help="Carry on the last unfinished run from the journal, reusing \
+        its exports. Without a journal, reuse matching exports GitHub \
+        still holds",
+    action="store_true",
+)
+argparser.add_argument(
+    "--journal",
+    help="Specify alternate run journal file",
+    type=str,
+    default="git_backup_journal.jsonl",
+)
+argparser.add_argument(
+    "--catalog",
+    help="Specify alternate backup catalog file",
+    type=str,
+    default="git_backup_catalog.db",
+)
+argparser.add_argument(
+    "--workers",
+    "-w",
+    help="Number of archive sets to download and upload in parallel, \
+        shared by every org",
+    type=int,
+    default=4,
+)
+argparser.add_argument(
+    "--drive-uploads",
+    help="Most uploads to Google Drive in flight at once, parts \
+        included, across every org. Default value is 0, no limit",
+    type=int,
+    default=0,
+)
+argparser.add_argument(
+    "--drive-mbps",
+    help="Cap on the upload rate to Google Drive in MB/s across every \
+        org. Default value is 0, no cap",
+    type=float,
+    default=0,
+)
+argparser.add_argument(
+    "--parts",
+    "-p",
+    help="Upload each archive as this many parts in parallel. \
+        Default value is 1, upload archives whole",
+    type=int,
+    default=1,
+)
+argparser.add_argument(
+    "--sink",
+    help="Config section of another place to copy every archive to, \
+        such as a local directory or an S3 bucket. Give it once for \
+        each. Not used with --stream",
+    type=str,
+    action="append",
+    dest="sinks",
+    metavar="SECTION",
+)
+argparser.add_argument(
+    "--recompress",
+    help="Recompress each archive from gzip to zstd or xz before upload. \
+        Not used with --stream",
+    choices=["zstd", "xz"],
+)
+argparser.add_argument(
+    "--recompress-level",
+    help="Compression level for --recompress. \
+        Default value is 3 for zstd and 6 for xz",
+    type=int,
+)
+argparser.add_argument(
+    "--keep-daily",
+    help="Number of days to keep backups for in Google Drive. \
+        Default value is 30",
+    type=int,
+    default=30,
+)
+argparser.add_argument(
+    "--keep-weekly",
+    help="Number of calendar weeks, counting back from this one, to \
+        keep the last backup of beyond the daily ones. Default value is 0",
+    type=int,
+    default=0,
+)
+argparser.add_argument(
+    "--keep-monthly",
+    help="Number of calendar months, counting back from this one, to \
+        keep the last backup of beyond the daily ones. Default value is 0",
+    type=int,
+    default=0,
+)
+argparser.add_argument(
+    "--report",
+    help="Specify alternate JSON run report file. \
+        Default is git_backup_report_<rundate>.json",
+    type=str,
+)
+argparser.add_argument(
+    "--prometheus",
+    help="Also write the run metrics to this Prometheus textfile",
+    type=str,
+)
+argparser.add_argument(
+    "--pushgateway",
+    help="Also push the run metrics to this Prometheus Pushgateway URL",
+    type=str,
+)
+argparser.add_argument(
+    "--profile",
+    help="Run under cProfile and tracemalloc - the profile is saved as \
+        git_backup_<rundate>.prof and the top entries are logged",
+    action="store_true",
+)
+commands = argparser.add_subparsers(
+    dest="command",
+    metavar="command",
+    help="Default is to run a backup",
+)
+restore_parser = commands.add_parser(
+    "restore",
+    help="Extract repos or files from an archive in Google Drive",
+)
+restore_parser.add_argument(
+    "paths",
+    help="Archive members or directories to restore",
+    nargs="*",
+)
+restore_parser.add_argument(
+    "--archive",
+    "-a",
+    help="Name of the archive in Google Drive",
+    type=str,
+)
+restore_parser.add_argument(
+    "--repo",
+    help="Restore this repo, as owner/name. Its archive is taken from \
+        the backup manifest unless --archive is given",
+    type=str,
+)
+restore_parser.add_argument(
+    "--output",
+    "-O",
+    help="Directory to restore to. Default value is restore",
+    type=str,
+    default="restore",
+)
+restore_parser.add_argument(
+    "--list",
+    help="List the matching members instead of restoring them",
+    action="store_true",
+)
+catalog_parser = commands.add_parser(
+    "catalog",
+    help="Look up archive sets in the backup catalog",
+)
+catalog_commands = catalog_parser.add_subparsers(
+    dest="catalog_command",
+    metavar="command",
+    required=True,
+)
+query_parser = catalog_commands.add_parser(
+    "query",
+    help="List the archive sets holding repos, newest run first",
+)
+query_parser.add_argument(
+    "--repo",
+    help="Repo as owner/name. * matches any characters",
+    type=str,
+)
+query_parser.add_argument(
+    "--since",
+    help="Only runs on or after this date, as YYYY-MM-DD",
+    type=str,
+)
+query_parser.add_argument(
+    "--until",
+    help="Only runs on or before this date, as YYYY-MM-DD",
+    type=str,
+)
+query_parser.add_argument(
+    "--archive",
+    "-a",
+    help="Only this archive, by name or Google Drive file ID",
+    type=str,
+)
+query_parser.add_argument(
+    "--latest",
+    help="Only the newest match for each repo",
+    action="store_true",
+)
+query_parser.add_argument(
+    "--json",
+    help="Print each match as a JSON object",
+    action="store_true",
+)
+query_parser.add_argument(
+    "--refresh",
+    help="Fetch the catalog from Google Drive if its copy is newer. \
+        The local catalog is used as it is otherwise",
+    action="store_true",
+)
+serve_parser = commands.add_parser(
+    "serve",
+    help="Stay running, backing up on a schedule and on request",
+)
+serve_parser.add_argument(
+    "--schedule",
+    help="Cron expression of the backup times, in local time. \
+        Default value is 0 23 * * *",
+    type=str,
+    default="0 23 * * *",
+)
+serve_parser.add_argument(
+    "--listen",
+    help="HOST:PORT of the health, progress and metrics endpoint. \
+        Default value is 127.0.0.1:8080",
+    type=str,
+    default="127.0.0.1:8080",
+)
+
+# Filled in place by configure(), so modules can import them up front
+args = argparse.Namespace()
+config = configparser.ConfigParser()
+# One Org for each --org, or for --gitenv and --googledrive
+orgs = []
+# Org the current thread is working on - set by in_org()
+working_org = contextvars.ContextVar("working_org")
+
+# Set by configure() - read as settings.rundate
+today = None
+rundate = None
+retention = None
+LOGFILE = None
+
+# Drive batch requests are limited to 100 calls
+DELETE_BATCH = 100
+# Size of each chunk pulled from GitHub and the first sent to Google Drive
+# Google Drive requires a multiple of 256KB
+CHUNK_SIZE = 512 * 1024 * 10
+UPLOAD_QUANTUM = 256 * 1024
+# Bounds on the upload chunk size picked by ChunkTuner
+MIN_CHUNK_SIZE = UPLOAD_QUANTUM
+MAX_CHUNK_SIZE = 256 * UPLOAD_QUANTUM
+# Upload chunks are sized to take at least this many seconds
+# and this many round trips, so request overhead stays small
+CHUNK_SECONDS = 4
+CHUNK_RTTS = 20
+# Archives are only split with --parts into parts of at least this size
+MIN_PART_SIZE = 64 * 1048576
+# Uncompressed bytes in each block compressed on its own by --recompress
+RECOMPRESS_BLOCK = 8 * 1048576
+# Archive extension for each --recompress codec
+ARCHIVE_EXTENSIONS = {None: ".tar.gz", "zstd": ".tar.zst", "xz": ".tar.xz"}
+# Kinds of --sink with the config keys each needs, and the largest part
+# sent to an S3 sink in one request
+# S3 allows 10,000 parts, so archives of up to 640GB
+SINK_TYPES = {
+    "local": ("path",),
+    "s3": ("bucket", "access_key", "secret_key"),
+}
+SINK_PART_SIZE = 64 * 1048576
+# Migration options a --tier can set, and the days it can be used
+EXCLUDES = (
+    "exclude_attachments", "exclude_releases", "exclude_metadata",
+    "exclude_git_data", "exclude_owner_projects"
+)
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+# Number of downloaded chunks held in memory while streaming, and the
+# largest upload chunk of a streamed archive, which is held in memory too
+STREAM_BUFFER_CHUNKS = 4
+MAX_STREAM_CHUNK_SIZE = 32 * UPLOAD_QUANTUM
+# Bounds in seconds on the wait between status checks of one archive set
+# Planned checks reach the POLL_SHARE quantile of earlier exports' time
+# over the predicted time
+MIN_POLL = 15
+MAX_POLL = 600
+POLL_SHARE = 0.9
+# Transfer progress is logged at most this often, in seconds or percent
+PROGRESS_SECONDS = 30
+PROGRESS_PERCENT = 10
+# Set logfile location as the root of project
+ROOT_DIR = getcwd()
+
+
+class Org:
+    """A GitHub org and the Google Drive folders it is backed up to
+    The gitenv and googledrive config sections of one --org, plus the
+    journal and archive digests of its run. name keeps the archives and
+    state files of orgs given with --org apart"""
+
+    def __init__(self, gitenv, googledrive, name=""):
+        self.gitenv = gitenv
+        self.googledrive = googledrive
+        self.name = name
+        # Date in the org's archive names - set by start_run(), and by
+        # --resume to the date of the run it carries on
+        self.rundate = None
+        # Set by cli.main() for a backup
+        self.journal = None
+        # Archive name to the digests of every archive verified this run
+        self.digests = {}
+        # Archive set counts by state, for the serve progress endpoint
+        self.progress = {}
+
+    def file(self, name):
+        """name of a file of this org, with the org's name put before
+        the first dot, as in git_backup_journal-<org>.jsonl"""
+        if not self.name:
+            return name
+        stem, dot, extension = name.partition(".")
+        return f"{stem}-{self.name}{dot}{extension}"
+
+    def label(self, key):
+        """Archive set key as shown in the run report"""
+        return f"{self.name}/{key}" if self.name else str(key)
+
+
+def current_org():
+    """Org the current thread is working on, or the first org"""
+    return working_org.get(orgs[0])
+
+
+def git_config():
+    """Config section with the current org's GitHub login"""
+    return config[current_org().gitenv]
+
+
+def drive_config():
+    """Config section with the current org's Google Drive folders"""
+    return config[current_org().googledrive]
+
+
+def logfolder_orgs():
+    """One org for each distinct Drive log folder, the first to use it
+    Orgs sharing a log folder get its run log and report only once"""
+    logfolders = {}
+    for org in orgs:
+        logfolder = config.get(org.googledrive, "logfolder", fallback=None)
+        logfolders.setdefault(logfolder, org)
+    return list(logfolders.values())
+
+
+def in_org(function, org=None):
+    """function wrapped to run for org, by default the current org
+    Threads do not share context variables, so work handed to a
+    thread pool is wrapped to carry the org with it"""
+    org = org or current_org()
+
+    def run(*args, **kwargs):
+        token = working_org.set(org)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            working_org.reset(token)
+    return run
+
+
+def split_list(value):
+    """Items of a comma separated config value"""
+    return [i.strip() for i in value.split(",") if i.strip()]
+
+
+def start_run():
+    """Set the run date, logfile and retention for a new run, and clear
+    what the orgs kept of the last one"""
+    global today, rundate, retention, LOGFILE
+    # Set run date for filename
+    today = datetime.now()
+    rundate = today.strftime("%Y-%m-%d-%H-%M")
+    # Set retention period in days for logs and archives
+    retention = args.keep_daily
+    LOGFILE = f"{ROOT_DIR}/git_backup_{rundate}.log"
+    for org in orgs:
+        org.rundate = rundate
+        org.digests = {}
+        org.progress = {}
+
+
+def configure(argv=None):
+    """Parse the command line, None for sys.argv, and read the config file
+    Returns the path of the config file"""
+    argparser.parse_args(argv, namespace=args)
+    if args.recompress and args.stream:
+        argparser.error("--recompress can not be used with --stream")
+    if args.sinks and args.stream:
+        argparser.error("--sink can not be used with --stream")
+    if args.engine == "mirror":
+        for option, value in (
+            ("--stream", args.stream),
+            ("--recompress", args.recompress),
+            ("--tier", args.tiers),
+        ):
+            if value:
+                argparser.error(f"{option} can not be used with --engine \
+mirror")
+    if args.recompress == "zstd" and find_spec("zstandard") is None:
+        argparser.error("--recompress zstd needs the zstandard package")
+
+    orgs.clear()
+    if not args.orgs:
+        orgs.append(Org(args.gitenv, args.googledrive))
+    for pair in args.orgs or []:
+        gitenv, colon, googledrive = pair.partition(":")
+        if not colon or not gitenv or not googledrive:
+            argparser.error(f"--org {pair} is not GITENV:GOOGLEDRIVE")
+        name = gitenv.removeprefix("git-")
+        if name in [i.name for i in orgs]:
+            argparser.error(f"--org {gitenv} is given more than once")
+        orgs.append(Org(gitenv, googledrive, name))
+    start_run()
+
+    # Read config file
+    configfile = ROOT_DIR + "/" + (args.config)
+    config.clear()
+    config.read(configfile)
+    for section in args.sinks or []:
+        kind = config.get(section, "type", fallback=None)
+        if kind not in SINK_TYPES:
+            argparser.error(f"--sink {section} needs a config section \
+with type {' or '.join(SINK_TYPES)}")
+        missing = [
+            i for i in SINK_TYPES[kind] if not config[section].get(i)
+        ]
+        if missing:
+            argparser.error(f"--sink {section} is type {kind} and needs \
+{', '.join(missing)}")
+        try:
+            config.getint(section, "part_mb", fallback=0)
+        except ValueError:
+            argparser.error(f"--sink {section} part_mb must be a number")
+    for section in args.tiers or []:
+        if not config.has_section(section):
+            argparser.error(f"--tier {section} has no config section")
+        days = split_list(config[section].get("days", "").lower())
+        if not set(days) <= set(WEEKDAYS):
+            argparser.error(f"--tier {section} days must be from \
+{', '.join(WEEKDAYS)}")
+        for option in EXCLUDES:
+            try:
+                config.getboolean(section, option, fallback=False)
+            except ValueError:
+                argparser.error(f"--tier {section} {option} must be true \
+or false")
+    return configfile
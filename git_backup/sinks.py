@@ -0,0 +1,352 @@
+"""Copies of every archive outside Google Drive - a local directory or an
+S3 compatible bucket, each given as a --sink config section
+Sinks read the archive pull_archive() saved to local disk while it is
+uploaded to Drive, so it is fetched from GitHub once however many copies
+are made. Each sink copies at its own pace and retries on its own"""
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import hashlib
+import hmac
+import logging
+from os import fsync, makedirs, path, remove, replace
+import random
+import threading
+from time import sleep
+from urllib.parse import quote, urlparse
+from xml.etree import ElementTree
+
+import requests
+
+from .metrics import metrics
+from .settings import args, config, in_org, ROOT_DIR
+from .settings import CHUNK_SIZE, SINK_PART_SIZE
+from .transfers import ArchiveDigest, index_file
+from .transfers import load_checkpoint, save_checkpoint, clear_checkpoint
+
+
+class SinkError(Exception):
+    """A sink refused a request, or its copy does not match the archive"""
+
+
+class Sink:
+    """Somewhere archives are copied to besides Google Drive
+    put() copies a local file there and checks the copy against its
+    digest. Called again with the same checkpoint it carries on where a
+    failed call stopped"""
+
+    def __init__(self, name, section):
+        self.name = name
+
+    def put(self, file, digest, checkpoint):
+        """Returns where the copy is"""
+        raise NotImplementedError
+
+
+class LocalSink(Sink):
+    """A directory, such as a DR volume mounted in the container"""
+
+    def __init__(self, name, section):
+        super().__init__(name, section)
+        self.path = path.join(ROOT_DIR, section["path"])
+
+    def put(self, file, digest, checkpoint):
+        makedirs(self.path, exist_ok=True)
+        target = path.join(self.path, path.basename(file))
+        with open(file, "rb") as source, \
+                open(target + ".partial", "wb") as copy:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                copy.write(chunk)
+                metrics.add_bytes("sinks", len(chunk))
+            copy.flush()
+            fsync(copy.fileno())
+        # Read back, so the check covers what was written
+        written = ArchiveDigest.from_file(target + ".partial")
+        if written.sha256.hexdigest() != digest.sha256.hexdigest():
+            remove(target + ".partial")
+            raise SinkError(f"{target} has SHA-256 \
+{written.sha256.hexdigest()} but {digest.sha256.hexdigest()} was written")
+        replace(target + ".partial", target)
+        return {"path": target, "sha256": digest.sha256.hexdigest()}
+
+
+def xml_text(content, tag):
+    """Text of the first tag element of an S3 XML response, or None"""
+    for element in ElementTree.fromstring(content).iter():
+        if element.tag.rsplit("}", 1)[-1] == tag:
+            return element.text
+    return None
+
+
+class S3Sink(Sink):
+    """A bucket of Amazon S3 or an S3 compatible store such as MinIO
+    Requests are signed with AWS Signature Version 4. Each request sends
+    the Content-MD5 of its bytes for S3 to check. Archives larger than
+    part_mb go up as a multipart upload, with the parts done checkpointed
+    and the whole archive's MD5 checked before the upload is completed"""
+
+    def __init__(self, name, section):
+        super().__init__(name, section)
+        self.region = section.get("region", "us-east-1")
+        self.endpoint = section.get(
+            "endpoint", f"https://s3.{self.region}.amazonaws.com"
+        ).rstrip("/")
+        self.bucket = section["bucket"]
+        self.prefix = section.get("prefix", "")
+        self.access_key = section["access_key"]
+        self.secret_key = section["secret_key"]
+        self.part_size = section.getint(
+            "part_mb", SINK_PART_SIZE // 1048576
+        ) * 1048576
+        self.session = requests.Session()
+
+    def sign(self, method, url, query, headers):
+        """Add the Signature Version 4 headers for a request
+        The body is not hashed - Content-MD5 covers it instead"""
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        headers["x-amz-date"] = stamp
+        headers["x-amz-content-sha256"] = "UNSIGNED-PAYLOAD"
+        signed = {k.lower(): str(v).strip() for k, v in headers.items()}
+        signed["host"] = urlparse(url).netloc
+        names = ";".join(sorted(signed))
+        canonical = "\n".join([
+            method,
+            urlparse(url).path,
+            query,
+            "".join(f"{k}:{signed[k]}\n" for k in sorted(signed)),
+            names,
+            "UNSIGNED-PAYLOAD",
+        ])
+        scope = f"{stamp[:8]}/{self.region}/s3/aws4_request"
+        key = ("AWS4" + self.secret_key).encode("utf-8")
+        for part in scope.split("/"):
+            key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+        signature = hmac.new(key, "\n".join([
+            "AWS4-HMAC-SHA256",
+            stamp,
+            scope,
+            hashlib.sha256(canonical.encode("utf-8")).hexdigest(),
+        ]).encode("utf-8"), hashlib.sha256).hexdigest()
+        headers["Authorization"] = f"AWS4-HMAC-SHA256 \
+Credential={self.access_key}/{scope}, SignedHeaders={names}, \
+Signature={signature}"
+
+    def request(self, method, name, operation, query=None, data=b""):
+        """Send a signed request for the object name
+        Returns the response whatever its status"""
+        url = f"{self.endpoint}/{quote(self.bucket)}/\
+{quote(self.prefix + name, safe='/-_.~')}"
+        query = "&".join(
+            f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}"
+            for k, v in sorted((query or {}).items())
+        )
+        headers = {}
+        if data:
+            headers["Content-MD5"] = base64.b64encode(
+                hashlib.md5(data, usedforsecurity=False).digest()
+            ).decode("ascii")
+        self.sign(method, url, query, headers)
+        metrics.count("requests", f"s3 {operation}")
+        return self.session.request(
+            method,
+            url + ("?" + query if query else ""),
+            data=data,
+            headers=headers,
+            timeout=(10, 300)
+        )
+
+    def check(self, response, operation):
+        """Raise SinkError for a refused request - S3 can also answer
+        200 with an error when it completes a multipart upload"""
+        if response.ok and b"<Error>" not in response.content[:200]:
+            return response
+        metrics.count("errors", f"s3 {operation}")
+        raise SinkError(f"S3 {operation} failed - {response.status_code} \
+{response.text[:200]}")
+
+    def put(self, file, digest, checkpoint):
+        name = path.basename(file)
+        if digest.bytes <= self.part_size:
+            with open(file, "rb") as source:
+                data = source.read()
+            if hashlib.md5(data, usedforsecurity=False).hexdigest() != \
+                    digest.md5.hexdigest():
+                raise SinkError(f"{file} does not match its MD5")
+            self.check(self.request("PUT", name, "put", data=data), "put")
+            metrics.add_bytes("sinks", len(data))
+            return self.location(name, digest.md5.hexdigest())
+
+        saved = load_checkpoint(checkpoint)
+        upload_id = saved.get("upload_id")
+        parts = saved.get("parts", [])
+        if not upload_id or saved.get("part_size") != self.part_size:
+            upload_id = xml_text(self.check(
+                self.request("POST", name, "start", {"uploads": ""}),
+                "start"
+            ).content, "UploadId")
+            parts = []
+            save_checkpoint(
+                checkpoint,
+                upload_id=upload_id,
+                part_size=self.part_size,
+                parts=parts
+            )
+        whole = hashlib.md5(usedforsecurity=False)
+        with open(file, "rb") as source:
+            number = 0
+            while True:
+                data = source.read(self.part_size)
+                if not data:
+                    break
+                number += 1
+                whole.update(data)
+                md5 = hashlib.md5(data, usedforsecurity=False).hexdigest()
+                if number <= len(parts) and parts[number - 1]["md5"] == md5:
+                    continue
+                response = self.request("PUT", name, "part", {
+                    "partNumber": str(number), "uploadId": upload_id
+                }, data)
+                if response.status_code == 404:
+                    # The upload was aborted or has expired
+                    save_checkpoint(checkpoint, upload_id=None)
+                etag = self.check(response, "part").headers["ETag"]
+                parts = parts[:number - 1] + [{"etag": etag, "md5": md5}]
+                save_checkpoint(checkpoint, parts=parts)
+                metrics.add_bytes("sinks", len(data))
+        if whole.hexdigest() != digest.md5.hexdigest():
+            raise SinkError(f"{file} does not match its MD5")
+        parts = parts[:number]
+        body = "<CompleteMultipartUpload>" + "".join(
+            f"<Part><PartNumber>{n}</PartNumber><ETag>{i['etag']}</ETag>\
+</Part>"
+            for n, i in enumerate(parts, 1)
+        ) + "</CompleteMultipartUpload>"
+        response = self.request(
+            "POST", name, "complete", {"uploadId": upload_id},
+            body.encode("utf-8")
+        )
+        if response.status_code == 404:
+            save_checkpoint(checkpoint, upload_id=None)
+        etag = xml_text(self.check(response, "complete").content, "ETag")
+        # Completed, so a later put() starts a new upload
+        save_checkpoint(checkpoint, upload_id=None)
+        # S3's ETag of a multipart upload is the MD5 of the part MD5s
+        expected = hashlib.md5(
+            b"".join(bytes.fromhex(i["md5"]) for i in parts),
+            usedforsecurity=False
+        ).hexdigest() + f"-{len(parts)}"
+        if str(etag).strip('"') != expected:
+            raise SinkError(f"S3 has ETag {etag} for {name} but \
+{expected} was sent")
+        return self.location(name, digest.md5.hexdigest())
+
+    def location(self, name, md5):
+        return {
+            "bucket": self.bucket,
+            "key": self.prefix + name,
+            "md5": md5,
+        }
+
+
+KINDS = {"local": LocalSink, "s3": S3Sink}
+
+# Made from the --sink config sections by the first archive copied
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def sinks():
+    """The --sink sinks and the threads that copy to them
+    Every archive being transferred can be copying to every sink"""
+    with _sinks_lock:
+        if not _sinks:
+            _sinks["sinks"] = [
+                KINDS[config[i]["type"]](i, config[i])
+                for i in args.sinks or []
+            ]
+            _sinks["pool"] = ThreadPoolExecutor(
+                max_workers=max(args.workers * len(_sinks["sinks"]), 1),
+                thread_name_prefix="sink"
+            )
+        return _sinks["sinks"], _sinks["pool"]
+
+
+def sink_checkpoint(file, sink):
+    """Name the checkpoint of a copy of file is kept under"""
+    return f"{file}.{sink.name}"
+
+
+def copy_archive(sink, archive_key, file, digest):
+    """Copy an archive, and its index if it has one, to one sink
+    Tried four times, each carrying on from the sink's checkpoint. A copy
+    finished by an earlier attempt at the same archive is not made again
+    Returns where the archive is in the sink, or None if it failed"""
+    checkpoint = sink_checkpoint(file, sink)
+    saved = load_checkpoint(checkpoint)
+    if saved.get("sha256") != digest.sha256.hexdigest():
+        # Left by a copy of a different archive
+        clear_checkpoint(checkpoint)
+        clear_checkpoint(checkpoint + ".index")
+        save_checkpoint(checkpoint, sha256=digest.sha256.hexdigest())
+        saved = {}
+    elif saved.get("done"):
+        return saved["done"]
+    done = saved.get("copied")
+    for attempt in range(4):
+        try:
+            with metrics.timer("sink", archive_key):
+                if done is None:
+                    done = sink.put(file, digest, checkpoint)
+                    save_checkpoint(checkpoint, copied=done)
+                if path.exists(index_file(file)):
+                    sink.put(
+                        index_file(file),
+                        ArchiveDigest.from_file(index_file(file)),
+                        checkpoint + ".index"
+                    )
+            save_checkpoint(checkpoint, done=done)
+            sink_message = f"{file} copied to {sink.name} and verified"
+            logging.info(sink_message)
+            return done
+        except (
+            SinkError,
+            OSError,
+            requests.exceptions.RequestException
+        ) as error:
+            sink_message = f"Copy of {file} to {sink.name} failed - {error}"
+            if attempt == 3:
+                logging.error(sink_message)
+                return None
+            metrics.count("retries", f"sink {sink.name}")
+            logging.warning(
+                sink_message + f" - Retrying - Attempt {attempt + 1} of 3"
+            )
+            sleep(2 ** attempt + random.random())
+
+
+def copy_to_sinks(archive_key, file, digest):
+    """Start copying a local archive to every sink
+    Returns the copies, to wait for with sink_results()"""
+    targets, pool = sinks()
+    return {
+        sink.name: pool.submit(
+            in_org(copy_archive), sink, archive_key, file, digest
+        )
+        for sink in targets
+    }
+
+
+def sink_results(copies):
+    """Wait for the copies copy_to_sinks() started
+    Returns where each sink has the archive, None where it failed"""
+    return {name: future.result() for name, future in copies.items()}
+
+
+def clear_sink_checkpoints(file):
+    for sink in sinks()[0]:
+        clear_checkpoint(sink_checkpoint(file, sink))
+        clear_checkpoint(sink_checkpoint(file, sink) + ".index")
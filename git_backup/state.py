@@ -0,0 +1,469 @@
+"""State kept between runs - the run journal, the incremental
+manifest and the export timings behind the status check schedule"""
+
+from collections import deque
+from datetime import datetime, timedelta
+import heapq
+import io
+import json
+import logging
+from math import ceil
+from os import fsync
+import threading
+from time import monotonic
+
+from . import settings
+from .github import new_set
+from .settings import current_org, drive_config, MIN_POLL, MAX_POLL
+from .settings import POLL_SHARE
+
+
+def journal():
+    """Run journal of the org being worked on"""
+    return current_org().journal
+
+
+class Journal:
+    """Append-only record of a run's progress, one JSON object per line
+    Every entry is flushed to disk before returning so a run that is
+    killed part way can be carried on with --resume
+    Download and upload byte progress is in each archive's checkpoint"""
+
+    def __init__(self, file):
+        self.file = file
+        self._lock = threading.Lock()
+
+    def _append(self, entry, mode="a"):
+        with self._lock:
+            with open(self.file, mode, encoding="utf-8") as journal_file:
+                journal_file.write(json.dumps(entry) + "\n")
+                journal_file.flush()
+                fsync(journal_file.fileno())
+
+    def start(self, run_date, incremental):
+        """Begin a new run - earlier runs are dropped from the file"""
+        self._append(
+            {"event": "run", "rundate": run_date, "incremental": incremental},
+            mode="w"
+        )
+
+    def write(self, event, **values):
+        values["event"] = event
+        try:
+            self._append(values)
+        except OSError as error:
+            logging.warning("Run journal could not be written")
+            logging.warning(error)
+
+    def last_run(self):
+        """Replay the journal into the state of its run
+        Returns None if there is no journal"""
+        try:
+            with open(self.file, encoding="utf-8") as journal_file:
+                lines = journal_file.read().splitlines()
+        except FileNotFoundError:
+            return None
+        run = None
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line can be cut short by a crash
+                continue
+            event = entry.pop("event")
+            if event == "run":
+                entry.update(sets={}, finished=False)
+                run = entry
+            elif run is None:
+                continue
+            elif event == "finished":
+                run["finished"] = True
+            elif event == "set":
+                # Journals from before tiers hold full exports
+                run["sets"][entry["key"]] = {
+                    "records": entry["records"],
+                    "tier": entry.get("tier", "full"),
+                    "state": "listed",
+                }
+            elif entry.get("key") in run["sets"]:
+                run["sets"][entry["key"]].update(entry, state=event)
+        return run
+
+
+def resume_run(previous):
+    """Rebuild the archive sets of an unfinished run from its journal
+    Sets keep their migration URL so exports are not started again,
+    and sets that failed to start are started again
+    Returns the sets and the keys already uploaded"""
+    repos = {}
+    uploaded = []
+    for key, item in previous["sets"].items():
+        repos[key] = new_set(item["records"], item["tier"])
+        if "sha256" in item:
+            current_org().digests[item["archive"]] = {
+                i: item[i]
+                for i in ("sha256", "md5", "bytes", "file_id", "sinks")
+                if i in item
+            }
+        # Uploaded sets keep theirs for the backup catalog. Sets that
+        # were never started, or whose start returned an error code in
+        # older journals, are started again
+        mig_url = str(item.get("mig_url") or "")
+        repos[key]["mig_url"] = mig_url if mig_url.startswith("http") else ""
+        if item["state"] in ("verified", "uploaded"):
+            uploaded.append(key)
+    resume_message = f'Resuming run {previous["rundate"]} - \
+{len(uploaded)} of {len(repos)} sets already uploaded'
+    logging.info(resume_message)
+    return repos, uploaded
+
+
+class Manifest:
+    """Last backed up state of every repo, kept in the archive folder
+    Maps each repo to its pushed_at/updated_at and the archive that
+    holds its latest snapshot, plus the date of the last full backup"""
+
+    NAME = "git_backup_manifest.json"
+
+    def __init__(self, data=None, file_id=None):
+        data = data or {}
+        self.repos = data.get("repos", {})
+        self.last_full = data.get("last_full")
+        self.file_id = file_id
+
+    @classmethod
+    def load(cls):
+        """Fetch the manifest from Google Drive
+        A missing or unreadable manifest gives an empty one"""
+        from googleapiclient.http import MediaIoBaseDownload
+        from .drive import drive_service, GoogleErrors
+        folder = drive_config()["folder"]
+        try:
+            service = drive_service()
+            response = service.files().list(
+                q=f"name = '{current_org().file(cls.NAME)}' \
+and '{folder}' in parents and trashed = false",
+                orderBy="createdTime desc",
+                fields="files(id)",
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ).execute()
+            files = response.get("files", [])
+            if not files:
+                logging.info("No backup manifest found")
+                return cls()
+            buffer = io.BytesIO()
+            downloader = MediaIoBaseDownload(
+                buffer,
+                service.files().get_media(
+                    fileId=files[0]["id"], supportsAllDrives=True
+                )
+            )
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+            return cls(json.loads(buffer.getvalue()), files[0]["id"])
+        except (GoogleErrors.Error, ValueError) as error:
+            logging.warning("Backup manifest could not be read")
+            logging.warning(error)
+            return cls()
+
+    def full_due(self, days):
+        """True when the last full backup is more than days old"""
+        if self.last_full is None:
+            return True
+        last_full = datetime.strptime(self.last_full, "%Y-%m-%d-%H-%M")
+        return settings.today - last_full >= timedelta(days)
+
+    def changed(self, records):
+        """Repos that are new or pushed/updated since their last backup"""
+        changed = []
+        for i in records:
+            entry = self.repos.get(i["full_name"])
+            if entry is None \
+                    or entry["pushed_at"] != i["pushed_at"] \
+                    or entry["updated_at"] != i["updated_at"]:
+                changed.append(i)
+        return changed
+
+    def record(self, records, archive):
+        """Note that records were backed up to archive in this run"""
+        for i in records:
+            self.repos[i["full_name"]] = {
+                "pushed_at": i["pushed_at"],
+                "updated_at": i["updated_at"],
+                "archive": archive,
+                "rundate": current_org().rundate,
+            }
+
+    def save(self):
+        """Upload a new copy of the manifest and remove the old one
+        A fresh copy each run keeps it clear of retention cleanup"""
+        from .drive import drive_service, GoogleErrors, MediaIoBaseUpload
+        data = {"last_full": self.last_full, "repos": self.repos}
+        try:
+            service = drive_service()
+            media = MediaIoBaseUpload(
+                io.BytesIO(json.dumps(data).encode("utf-8")),
+                mimetype="application/json"
+            )
+            response = service.files().create(
+                body={
+                    "name": current_org().file(self.NAME),
+                    "parents": [drive_config()["folder"]]
+                },
+                media_body=media,
+                supportsAllDrives=True,
+                fields="id"
+            ).execute()
+            if self.file_id is not None:
+                service.files().delete(
+                    fileId=self.file_id, supportsAllDrives=True
+                ).execute()
+            self.file_id = response["id"]
+            manifest_message = f"Backup manifest saved with \
+{len(self.repos)} repos"
+            logging.info(manifest_message)
+        except GoogleErrors.Error as error:
+            logging.error("Backup manifest could not be saved")
+            logging.error(error)
+
+
+class ExportModel:
+    """Estimates how long GitHub takes to export an archive set
+    Fits seconds = a * repo count + b * size in MB + c to earlier exports
+    Timings are kept in a JSON file between runs"""
+
+    # Seconds per repo, per MB and per export used until there is history
+    DEFAULTS = (30.0, 0.5, 0.0)
+    SAMPLES = 100
+
+    def __init__(self, file):
+        self.file = file
+        self._lock = threading.Lock()
+        try:
+            with open(file, encoding="utf-8") as timings:
+                self.samples = json.load(timings)
+        except (FileNotFoundError, ValueError):
+            self.samples = []
+        self.coefficients = self._fit()
+
+    @staticmethod
+    def _slopes(samples):
+        """Least squares seconds per repo and per MB, None if they can't
+        be told apart"""
+        scc = sum(c * c for c, m, t in samples)
+        scm = sum(c * m for c, m, t in samples)
+        smm = sum(m * m for c, m, t in samples)
+        sct = sum(c * t for c, m, t in samples)
+        smt = sum(m * t for c, m, t in samples)
+        det = scc * smm - scm * scm
+        if det <= 1e-9 * scc * smm:
+            return None
+        return (sct * smm - smt * scm) / det, (scc * smt - scm * sct) / det
+
+    def _fit(self):
+        """Least squares fit with a fixed time per export, then without,
+        falling back to scaled defaults"""
+        if len(self.samples) < 3:
+            return self.DEFAULTS
+        count = len(self.samples)
+        mean = [sum(i) / count for i in zip(*self.samples)]
+        centred = [[v - mean[i] for i, v in enumerate(sample)]
+                   for sample in self.samples]
+        slopes = self._slopes(centred)
+        if slopes:
+            fixed = mean[2] - slopes[0] * mean[0] - slopes[1] * mean[1]
+            if min(slopes) >= 0 and fixed >= 0:
+                return (*slopes, fixed)
+        slopes = self._slopes(self.samples)
+        if slopes and min(slopes) >= 0:
+            return (*slopes, 0.0)
+        # Counts and sizes too alike to separate - scale the defaults
+        guess = sum(self._predict(self.DEFAULTS, c, m)
+                    for c, m, t in self.samples)
+        scale = sum(t for c, m, t in self.samples) / max(guess, 1)
+        return tuple(i * scale for i in self.DEFAULTS)
+
+    @staticmethod
+    def _predict(coefficients, count, size_mb):
+        return (coefficients[0] * count + coefficients[1] * size_mb
+                + coefficients[2])
+
+    def predict(self, count, size):
+        """Expected export seconds for a set - size is in KB"""
+        with self._lock:
+            return self._predict(self.coefficients, count, size / 1024)
+
+    def spread(self, shares):
+        """Quantiles at shares of earlier exports' time over the time
+        predicted for them, or None while the fit is only the defaults"""
+        with self._lock:
+            if len(self.samples) < 3:
+                return None
+            ratios = sorted(
+                t / self._predict(self.coefficients, c, m)
+                for c, m, t in self.samples
+                if self._predict(self.coefficients, c, m) > 0
+            )
+        if not ratios:
+            return None
+        quantiles = []
+        for share in shares:
+            index = share * (len(ratios) - 1)
+            low = int(index)
+            high = min(low + 1, len(ratios) - 1)
+            quantiles.append(
+                ratios[low] + (ratios[high] - ratios[low]) * (index - low)
+            )
+        return quantiles
+
+    def record(self, count, size, seconds):
+        """Add an observed export time and refit"""
+        with self._lock:
+            self.samples.append([count, size / 1024, seconds])
+            self.samples = self.samples[-self.SAMPLES:]
+            self.coefficients = self._fit()
+            try:
+                with open(self.file, "w", encoding="utf-8") as timings:
+                    json.dump(self.samples, timings)
+            except OSError as error:
+                logging.warning(error)
+
+
+class ExportScheduler:
+    """Priority queue of when each archive set is next checked
+    Checks get closer together as a set nears its expected export
+    time and back off again once it is overdue
+    Each set gets no more checks before it is due than halving the wait
+    down to MIN_POLL would make. They are placed where earlier exports
+    finished relative to their prediction rather than in a ramp, so
+    small sets are not left waiting MIN_POLL and fewer calls are spent
+    well before a set can be ready"""
+
+    def __init__(self, model):
+        self.model = model
+        self._heap = []
+        self._sets = {}
+        self._seq = 0
+
+    def add(self, key, count, size, resumed=False):
+        """Start tracking a migration
+        Resumed migrations started in an earlier run, so they are
+        checked straight away and their timing is not learnt from"""
+        now = monotonic()
+        expected = 0 if resumed else self.model.predict(count, size)
+        self._seq += 1
+        self._sets[key] = {
+            "count": count,
+            "size": size,
+            "started": now,
+            "checked": now,
+            "plan": deque(now + i for i in self.plan(expected)),
+            "overdue": 0,
+            "seq": self._seq,
+            "learn": not resumed,
+        }
+        if resumed:
+            heapq.heappush(self._heap, (now, self._seq, key))
+            return
+        scheduler_message = f'Archive set {key} expected to export \
+in {round(expected / 60)} minute(s)'
+        logging.info(scheduler_message)
+        self._push(key, now)
+
+    @staticmethod
+    def ramp(expected):
+        """Seconds from the start of each check up to the expected time
+        when the wait is halved each time, kept between MIN_POLL and
+        MAX_POLL"""
+        checks = []
+        elapsed = 0
+        while elapsed < expected:
+            elapsed += min(MAX_POLL, max(MIN_POLL, (expected - elapsed) / 2))
+            checks.append(elapsed)
+        return checks
+
+    def plan(self, expected):
+        """Seconds from the start of each check of a set before it is due
+        As many checks as ramp() makes, at evenly spaced quantiles of how
+        late earlier exports were, up to POLL_SHARE of them - no more than
+        MAX_POLL apart. A single check goes at the latest any export was,
+        but never after the ramp's. The ramp itself until there is
+        history to go on"""
+        ramp = self.ramp(expected)
+        if len(ramp) == 1:
+            spread = self.model.spread([1])
+            if spread is None:
+                return ramp
+            return [min(expected * spread[0], ramp[0])]
+        spread = self.model.spread(
+            [POLL_SHARE * (n + 1) / len(ramp) for n in range(len(ramp))]
+        )
+        if spread is None:
+            return ramp
+        checks = []
+        for ratio in spread:
+            when = expected * ratio
+            if checks and when - checks[-1] > MAX_POLL:
+                gaps = ceil((when - checks[-1]) / MAX_POLL)
+                last = checks[-1]
+                checks += [
+                    last + (when - last) * n / gaps for n in range(1, gaps)
+                ]
+            checks.append(when)
+        return checks
+
+    def _push(self, key, now):
+        item = self._sets[key]
+        plan = item["plan"]
+        # Checks that came late can skip the planned ones they overran
+        while plan and plan[0] <= now:
+            plan.popleft()
+        if plan:
+            heapq.heappush(self._heap, (plan.popleft(), item["seq"], key))
+            return
+        delay = min(MAX_POLL, MIN_POLL * 2 ** item["overdue"])
+        item["overdue"] += 1
+        heapq.heappush(self._heap, (now + delay, item["seq"], key))
+
+    def _stale(self, entry):
+        item = self._sets.get(entry[2])
+        return item is None or item["seq"] != entry[1]
+
+    def due(self):
+        """Pop every set whose next check is due"""
+        now = monotonic()
+        keys = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if not self._stale(entry):
+                keys.append(entry[2])
+        return keys
+
+    def checked(self, key):
+        """Schedule the next check of a set that is still exporting"""
+        now = monotonic()
+        self._sets[key]["checked"] = now
+        self._push(key, now)
+
+    def exported(self, key):
+        """Stop tracking a set and learn from how long it took
+        It finished somewhere between the last two checks
+        Returns the seconds since the set was added"""
+        item = self._sets.pop(key)
+        if item["learn"]:
+            seconds = (item["checked"] + monotonic()) / 2 - item["started"]
+            self.model.record(item["count"], item["size"], seconds)
+        return monotonic() - item["started"]
+
+    def remove(self, key):
+        self._sets.pop(key, None)
+
+    def next_in(self):
+        """Seconds until the next check is due, None if nothing is left"""
+        while self._heap and self._stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - monotonic())
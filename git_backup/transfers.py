@@ -0,0 +1,522 @@
+"""Archive downloads from GitHub and their handover to Google Drive"""
+
+import gzip
+import hashlib
+import json
+import logging
+from os import path, remove, replace
+import queue
+import threading
+import zlib
+
+import requests
+
+from . import state
+from .github import github_client
+from .logs import Progress
+from .metrics import metrics
+from .recompress import recompress_archive
+from .settings import args, CHUNK_SIZE, MIN_PART_SIZE, STREAM_BUFFER_CHUNKS
+from .settings import ARCHIVE_EXTENSIONS, current_org
+
+
+def archive_name(archive_key):
+    """Filename of an archive set for this run"""
+    org = current_org()
+    return org.file("git-archive") + "-" + org.rundate + "-set-" + \
+        str(archive_key) + ARCHIVE_EXTENSIONS[args.recompress]
+
+
+def checkpoint_file(file):
+    """Name of the checkpoint kept beside a local archive"""
+    return file + ".checkpoint.json"
+
+
+def load_checkpoint(file):
+    """Transfer state saved for a local archive, empty if there is none"""
+    try:
+        with open(checkpoint_file(file), encoding="utf-8") as checkpoint:
+            return json.load(checkpoint)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_checkpoint(file, **values):
+    """Merge values into the checkpoint of a local archive
+    Written to a temporary file first so a crash never leaves half a file"""
+    checkpoint = load_checkpoint(file)
+    checkpoint.update(values)
+    temp_file = checkpoint_file(file) + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as temp:
+        json.dump(checkpoint, temp)
+    replace(temp_file, checkpoint_file(file))
+
+
+def clear_checkpoint(file):
+    try:
+        remove(checkpoint_file(file))
+    except FileNotFoundError:
+        pass
+
+
+def pull_archive(archive_key, url):
+    """Download archive as tarball
+    Set to pull in chunks and upload from iostream
+    Returns None once the archive is in Google Drive and every sink,
+    otherwise the archive name and the reason it failed"""
+    arc_url = url + "/archive"
+    pull_message = f'Archive URL - {arc_url}'
+    logging.debug(pull_message)
+    local_filename = archive_name(archive_key)
+    pull_message = f'archive filename - {local_filename}'
+    logging.debug(pull_message)
+    try:
+        if args.stream:
+            return stream_pull(archive_key, arc_url, local_filename)
+
+        logging.info("Saving archive locally")
+        if args.recompress:
+            digest = recompressed_archive(
+                archive_key, arc_url, local_filename
+            )
+        else:
+            with metrics.timer("download", archive_key):
+                digest = download_archive(arc_url, local_filename)
+            state.journal().write(
+                "downloaded", key=archive_key, bytes=digest.bytes
+            )
+        return upload_local(archive_key, local_filename, digest)
+    except requests.exceptions.RequestException as error:
+        logging.error("An error occourred")
+        logging.error(error)
+        return local_filename, str(error)
+
+
+def upload_local(archive_key, local_filename, digest):
+    """Upload a local archive to Google Drive, copying it to every
+    --sink meanwhile, and remove it once everywhere
+    Returns None once the archive is in Google Drive and every sink,
+    otherwise the archive name and the reason it failed"""
+    import httplib2
+    from .drive import GoogleErrors, upload_archive, upload_parts
+    from .drive import verify_upload
+    from .sinks import copy_to_sinks, sink_results, clear_sink_checkpoints
+
+    copies = copy_to_sinks(archive_key, local_filename, digest)
+    with metrics.timer("upload", archive_key):
+        upload_retry = 0
+        while True:
+            try:
+                if args.parts > 1 and \
+                        digest.bytes >= 2 * MIN_PART_SIZE:
+                    uploaded = upload_parts(local_filename, digest)
+                    if uploaded is not None:
+                        break
+                else:
+                    uploaded = upload_archive(local_filename)
+                    if verify_upload(local_filename, uploaded, digest):
+                        break
+                reason = "Checksum mismatch"
+                # The next attempt needs a new upload session
+                save_checkpoint(local_filename, uri=None)
+            except (
+                GoogleErrors.Error,
+                httplib2.HttpLib2Error,
+                OSError
+            ) as error:
+                reason = str(error)
+            if upload_retry == 3:
+                upload_message = f'Maximim retries reached \
+for {local_filename} upload'
+                logging.error(upload_message)
+                sink_results(copies)
+                return local_filename, reason
+            upload_retry += 1
+            metrics.count("retries", "drive upload")
+            upload_retry_message = f'Upload failed - \
+Resuming - Attempt {upload_retry} of 3'
+            logging.warning(upload_retry_message)
+
+    copied = sink_results(copies)
+    failed = [name for name, done in copied.items() if done is None]
+    if failed:
+        # The archive stays on disk, so the copy is retried from it
+        return local_filename, f'Copy to {", ".join(failed)} failed'
+    record_digest(
+        archive_key, local_filename, uploaded["id"], digest, copied
+    )
+    upload_index(local_filename)
+    logging.info('Upload success - cleaning up local files')
+    remove(local_filename)
+    clear_checkpoint(local_filename)
+    clear_sink_checkpoints(local_filename)
+
+
+def stream_pull(archive_key, arc_url, file):
+    """Stream an archive from GitHub into Google Drive
+    Nothing is kept on disk, so a failed attempt starts again
+    from the beginning of the archive"""
+    from .drive import stream_archive, verify_upload
+    with metrics.timer("stream", archive_key):
+        for upload_retry in range(4):
+            if upload_retry:
+                metrics.count("retries", "drive stream upload")
+                upload_retry_message = f'Streaming upload failed - \
+Retrying - Attempt {upload_retry} of 3'
+                logging.warning(upload_retry_message)
+            response = github_client().get(
+                arc_url,
+                allow_redirects=True,
+                stream=True
+            )
+            response.raise_for_status()
+            logging.info("Streaming archive to Google Drive")
+            digest = ArchiveDigest()
+            uploaded = stream_archive(response, file, digest)
+            if uploaded is not None and \
+                    verify_upload(file, uploaded, digest):
+                record_digest(archive_key, file, uploaded["id"], digest)
+                logging.info('Upload success')
+                return
+
+    upload_message = f'Maximim retries reached for {file} upload'
+    logging.error(upload_message)
+    return file, "Streaming upload failed"
+
+
+class ArchiveDigest:
+    """SHA-256 and MD5 of an archive, updated from the chunks as they
+    pass through so the archive never has to be read twice"""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5(usedforsecurity=False)
+        self.bytes = 0
+
+    def update(self, chunk):
+        self.sha256.update(chunk)
+        self.md5.update(chunk)
+        self.bytes += len(chunk)
+
+    def read(self, file, start, length):
+        """Add length bytes of a local file starting at start"""
+        with open(file, "rb") as local_file:
+            local_file.seek(start)
+            while length > 0:
+                chunk = local_file.read(min(length, CHUNK_SIZE))
+                if not chunk:
+                    break
+                self.update(chunk)
+                length -= len(chunk)
+
+    @classmethod
+    def from_file(cls, file):
+        """Digest of what is already on disk - only needed when a
+        download resumes from a file written by an earlier attempt"""
+        digest = cls()
+        digest.read(file, 0, path.getsize(file))
+        return digest
+
+    def result(self):
+        return {
+            "sha256": self.sha256.hexdigest(),
+            "md5": self.md5.hexdigest(),
+            "bytes": self.bytes,
+        }
+
+
+def expected_length(response):
+    """Full archive size from a 200 or 206 response, if the server says"""
+    if response.status_code == 206:
+        total = response.headers.get("Content-Range", "").split("/")[-1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("Content-Length", "")
+    if length.isdigit() and "Content-Encoding" not in response.headers:
+        return int(length)
+    return None
+
+
+def download_archive(arc_url, file):
+    """Download an archive to local disk
+    A partial file left by an interrupted attempt or an earlier run
+    is continued with an HTTP Range request instead of starting again
+    A download that ends short of the advertised size is resumed
+    Returns the ArchiveDigest of the archive"""
+    if load_checkpoint(file).get("source") != arc_url:
+        # Anything on disk belongs to a different export
+        clear_checkpoint(file)
+        if path.exists(file):
+            remove(file)
+        save_checkpoint(file, source=arc_url)
+
+    digest = ArchiveDigest()
+    for attempt in range(4):
+        offset = path.getsize(file) if path.exists(file) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            response = github_client().get(
+                arc_url,
+                headers=headers,
+                allow_redirects=True,
+                stream=True
+            )
+            if offset and response.status_code == 416:
+                # Nothing past offset - the file is already complete
+                response.close()
+                return ArchiveDigest.from_file(file)
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                logging.warning("Range request ignored - \
+Downloading archive from the start")
+                offset = 0
+            if offset:
+                pull_message = f'Resuming download of {file} \
+from {round(offset / 1048576)} MB'
+                logging.info(pull_message)
+            if digest.bytes != offset:
+                digest = ArchiveDigest.from_file(file) if offset \
+                    else ArchiveDigest()
+            expected = expected_length(response)
+            progress = Progress(file, "download", expected)
+
+            with open(file, "ab" if offset else "wb") as local_file:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if chunk:
+                        local_file.write(chunk)
+                        progress.update(digest.bytes + len(chunk))
+                        digest.update(chunk)
+                        metrics.add_bytes("downloaded", len(chunk))
+            if expected is not None and digest.bytes != expected:
+                raise requests.exceptions.ChunkedEncodingError(
+                    f"Download ended at {digest.bytes} of {expected} bytes"
+                )
+            return digest
+        except (
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout
+        ) as error:
+            if attempt == 3:
+                raise
+            metrics.count("retries", "github archive download")
+            pull_message = f'Download of {file} interrupted - {error} - \
+Resuming - Attempt {attempt + 1} of 3'
+            logging.warning(pull_message)
+
+
+def recompressed_archive(archive_key, arc_url, file):
+    """Download the gzip archive beside file and recompress it to file
+    An archive already recompressed from the same export is reused
+    Returns the ArchiveDigest of file"""
+    if load_checkpoint(file).get("recompressed") == arc_url \
+            and path.exists(file):
+        return ArchiveDigest.from_file(file)
+    source = file.rsplit(".", 2)[0] + ".tar.gz"
+    with metrics.timer("download", archive_key):
+        source_digest = download_archive(arc_url, source)
+    state.journal().write(
+        "downloaded", key=archive_key, bytes=source_digest.bytes
+    )
+
+    # Any upload session or index saved for file was for other bytes
+    clear_checkpoint(file)
+    if path.exists(index_file(file)):
+        remove(index_file(file))
+    digest = ArchiveDigest()
+    try:
+        with metrics.timer("recompress", archive_key):
+            result, index = recompress_archive(source, file, digest)
+    except (gzip.BadGzipFile, EOFError, zlib.error):
+        # The next attempt downloads the archive again
+        remove(source)
+        clear_checkpoint(source)
+        raise
+    result["gzip_bytes"] = source_digest.bytes
+    metrics.recompressed(archive_key, result)
+    recompress_message = f'{file} recompressed with {result["codec"]} - \
+{round(source_digest.bytes / 1048576)} MB to \
+{round(digest.bytes / 1048576)} MB in {round(result["cpu_seconds"])} \
+CPU seconds'
+    logging.info(recompress_message)
+    if index is not None:
+        with open(index_file(file), "w", encoding="utf-8") as index_json:
+            json.dump(index, index_json)
+    save_checkpoint(file, recompressed=arc_url)
+    remove(source)
+    clear_checkpoint(source)
+    return digest
+
+
+def index_file(file):
+    """Name of the member index of a --recompress archive"""
+    return file + ".index.json"
+
+
+def upload_index(file):
+    """Upload the member index of an archive beside it, if it has one
+    Without it restore still works, by reading the archive from the
+    start, so a failure is only a warning"""
+    from .drive import upload_json, GoogleErrors
+    if not path.exists(index_file(file)):
+        return
+    try:
+        with open(index_file(file), encoding="utf-8") as index_json:
+            index = json.load(index_json)
+        upload_json(index_file(file), index, indent=None)
+        remove(index_file(file))
+        index_message = f'Index of {len(index["members"])} members \
+uploaded as {index_file(file)}'
+        logging.info(index_message)
+    except (GoogleErrors.Error, OSError, ValueError) as error:
+        logging.warning("Archive index could not be uploaded")
+        logging.warning(error)
+
+
+_digests_lock = threading.Lock()
+
+
+def record_digest(archive_key, file, file_id, digest, sinks=None):
+    """Keep the digests of a verified archive for the run's manifest,
+    with where each --sink has its copy"""
+    entry = dict(digest.result(), file_id=file_id)
+    if sinks:
+        entry["sinks"] = sinks
+    with _digests_lock:
+        current_org().digests[file] = entry
+    state.journal().write("verified", key=archive_key, archive=file, **entry)
+
+
+def upload_digests():
+    """Upload the run's archive digests beside the archives"""
+    from .drive import upload_json, GoogleErrors
+    org = current_org()
+    name = org.file("git-archive") + "-" + org.rundate + "-digests.json"
+    with _digests_lock:
+        data = dict(sorted(org.digests.items()))
+    try:
+        upload_json(name, data)
+        digest_message = f'Digests for {len(data)} archives \
+uploaded as {name}'
+        logging.info(digest_message)
+    except GoogleErrors.Error as error:
+        logging.error("Archive digests could not be uploaded")
+        logging.error(error)
+
+
+class ArchiveStream:
+    """Bounded in-memory pipe between a GitHub download and a Drive upload
+    The download thread blocks in put() once the queue is full, so memory
+    stays at a few chunk sizes however large the archive is.
+    The last chunk handed to Drive is kept in case it has to be resent
+    Chunks are handed out as memoryview slices of the buffer rather than
+    copies. Drive asks for the size while it still holds the last one,
+    so bytes read ahead wait in a list until the next getbytes()"""
+
+    def __init__(self, max_chunks=STREAM_BUFFER_CHUNKS):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._aborted = threading.Event()
+        self._buffer = bytearray()
+        # Downloaded chunks read past the end of self._buffer
+        self._pending = []
+        self._pending_bytes = 0
+        # Archive offset of the first byte held in self._buffer
+        self._offset = 0
+        # Archive offset Drive is expected to ask for next
+        self._next = 0
+        self._eof = False
+        self._error = None
+
+    def put(self, chunk):
+        """Producer side - returns False once the upload has given up"""
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self, error=None):
+        """Producer side - mark the end of the download"""
+        self._error = error
+        self.put(None)
+
+    def abort(self):
+        """Consumer side - release a producer blocked on a full queue"""
+        self._aborted.set()
+
+    def _end(self):
+        """Archive offset after the last byte read from the download"""
+        return self._offset + len(self._buffer) + self._pending_bytes
+
+    def _fill(self, end):
+        """Block until the archive has been read up to end or EOF"""
+        while not self._eof and self._end() < end:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+                if self._error is not None:
+                    raise IOError(
+                        f"Archive download failed - {self._error}"
+                    )
+            else:
+                self._pending.append(chunk)
+                self._pending_bytes += len(chunk)
+
+    def getbytes(self, begin, length):
+        """Return a view of length bytes of the archive starting at begin"""
+        if begin < self._offset:
+            raise IOError(
+                f"Drive asked for byte {begin} which is no longer buffered"
+            )
+        try:
+            del self._buffer[:begin - self._offset]
+        except BufferError:
+            # Drive still holds the last chunk - copy what is left instead
+            self._buffer = self._buffer[begin - self._offset:]
+        self._offset = begin
+        self._fill(begin + length)
+        for chunk in self._pending:
+            self._buffer += chunk
+        self._pending = []
+        self._pending_bytes = 0
+        data = memoryview(self._buffer)[:length]
+        self._next = begin + len(data)
+        return data
+
+    def size(self, chunksize):
+        """Total archive size, or None while more than one chunk is left
+        Drive needs the total no later than the request for the last chunk"""
+        self._fill(self._next + chunksize + 1)
+        if self._eof:
+            return self._end()
+        return None
+
+    def tell(self):
+        """Number of bytes handed to Drive so far"""
+        return self._next
+
+
+def pump_archive(response, stream, digest):
+    """Feed a streamed GitHub download into an ArchiveStream
+    Run in its own thread by stream_archive()
+    A download that ends short fails the stream so the upload
+    is never completed with a truncated archive. Any other error
+    fails it too, or the upload would wait for the next chunk forever"""
+    try:
+        expected = expected_length(response)
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                digest.update(chunk)
+                metrics.add_bytes("downloaded", len(chunk))
+                if not stream.put(chunk):
+                    return
+        if expected is not None and digest.bytes != expected:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Download ended at {digest.bytes} of {expected} bytes"
+            )
+        stream.close()
+    except Exception as error:
+        stream.close(error)
+    finally:
+        response.close()